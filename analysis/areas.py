@@ -0,0 +1,157 @@
+""" Assignment of points (e.g. geotagged statuses) to areas, such as the
+LSOAs or electoral divisions the council publishes its data by (see
+analysis.datafetch.northants.DataFetcher._GEO_IDS).
+
+An AreaIndex holds the boundary of each area as a PolygonGrid, and a
+uniform grid over all of them, listing for each of its cells the areas
+whose bounding box overlaps it. To assign an array of points, each point
+is paired with the candidate areas of its cell, and the pairs are tested
+one area at a time, each area testing all of its candidate points in one
+vectorized call. There is no Python loop over the points.
+
+Boundaries are tested in WGS84 longitude/latitude, the same as tweets:
+from_shapefile reprojects British National Grid shapefiles, such as the
+ONS LSOA boundaries, and refuses other projections (see
+analysis.geofence.lon_lat_rings).
+"""
+import numpy as np
+import pandas as pd
+import logging
+
+from analysis.geofence import PolygonGrid, read_shapefile_rings
+
+LOG = logging.getLogger(__name__)
+
+# Index of a point in no area
+NO_AREA = -1
+
+
+class AreaIndex(object):
+    ''' Spatial index of a set of areas, each a (code, rings) pair, for
+    assigning points to the area they are in. Areas may share a code
+    (e.g. the parts of one area, listed separately)
+    '''
+
+    def __init__(self, areas, grid_size=128, area_grid_size=16):
+        self.codes = np.array([code for (code, _) in areas], dtype=object)
+        self.polygons = [PolygonGrid(rings, area_grid_size)
+                         for (_, rings) in areas]
+        if not self.polygons:
+            raise ValueError("No areas to index")
+        self.min_x = min(polygon.min_x for polygon in self.polygons)
+        self.min_y = min(polygon.min_y for polygon in self.polygons)
+        self.max_x = max(polygon.max_x for polygon in self.polygons)
+        self.max_y = max(polygon.max_y for polygon in self.polygons)
+        self.grid_size = grid_size
+        self.cell_w = (self.max_x - self.min_x) / grid_size or 1.0
+        self.cell_h = (self.max_y - self.min_y) / grid_size or 1.0
+        self._build_grid()
+
+    @classmethod
+    def from_shapefile(cls, path, code_field, name=None, name_field=None,
+                       grid_size=128):
+        ''' Load the areas of a shapefile (those matching name, if given,
+        as for analysis.geofence.read_shapefile_rings), identified by the
+        value of their code_field, e.g. 'LSOA11CD'
+        '''
+        areas = [(record[code_field], rings) for (record, rings)
+                 in read_shapefile_rings(path, name, name_field)]
+        LOG.info("Loaded %d areas from %s", len(areas), path)
+        return cls(areas, grid_size)
+
+    def __len__(self):
+        return len(self.polygons)
+
+    def _cells(self, xs, ys):
+        ''' Get the grid cell (row * grid_size + column) of each point
+        '''
+        cols = np.clip(((xs - self.min_x) / self.cell_w).astype(np.intp),
+                       0, self.grid_size - 1)
+        rows = np.clip(((ys - self.min_y) / self.cell_h).astype(np.intp),
+                       0, self.grid_size - 1)
+        return rows * self.grid_size + cols
+
+    def _build_grid(self):
+        ''' List the candidate areas of each cell, in CSR form: those of
+        cell i are cell_areas[cell_starts[i]:cell_starts[i + 1]]
+        '''
+        size = self.grid_size
+        cells = []
+        areas = []
+        for (i, polygon) in enumerate(self.polygons):
+            (first, last) = self._cells(
+                np.array([polygon.min_x, polygon.max_x]),
+                np.array([polygon.min_y, polygon.max_y]))
+            (row1, col1) = divmod(first, size)
+            (row2, col2) = divmod(last, size)
+            rows = np.arange(row1, row2 + 1)
+            cols = np.arange(col1, col2 + 1)
+            covered = (rows[:, None] * size + cols[None, :]).ravel()
+            cells.append(covered)
+            areas.append(np.repeat(i, len(covered)))
+        cells = np.concatenate(cells)
+        areas = np.concatenate(areas)
+        order = np.argsort(cells, kind='mergesort')
+        self.cell_areas = areas[order]
+        self.cell_starts = np.zeros(size * size + 1, dtype=np.intp)
+        np.cumsum(np.bincount(cells, minlength=size * size),
+                  out=self.cell_starts[1:])
+
+    def assign(self, lons, lats):
+        ''' Get the index of the area each point is in, or NO_AREA (for
+        points outside every area, or without coordinates)
+        '''
+        lons = np.asarray(lons, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+        result = np.empty(len(lons), dtype=np.intp)
+        result.fill(NO_AREA)
+
+        with np.errstate(invalid='ignore'):
+            points = np.flatnonzero((lons >= self.min_x) &
+                                    (lons <= self.max_x) &
+                                    (lats >= self.min_y) &
+                                    (lats <= self.max_y))
+        if len(points) == 0:
+            return result
+        cells = self._cells(lons[points], lats[points])
+
+        # Pair each point with each candidate area of its cell
+        starts = self.cell_starts[cells]
+        counts = self.cell_starts[cells + 1] - starts
+        pair_points = np.repeat(points, counts)
+        offsets = np.arange(counts.sum()) - np.repeat(
+            np.cumsum(counts) - counts, counts)
+        pair_areas = self.cell_areas[np.repeat(starts, counts) + offsets]
+        if len(pair_areas) == 0:
+            return result
+
+        # Test the pairs area by area
+        order = np.argsort(pair_areas, kind='mergesort')
+        (pair_points, pair_areas) = (pair_points[order], pair_areas[order])
+        bounds = np.flatnonzero(np.diff(pair_areas)) + 1
+        for (start, end) in zip(np.r_[0, bounds],
+                                np.r_[bounds, len(pair_areas)]):
+            area = pair_areas[start]
+            candidates = pair_points[start:end]
+            candidates = candidates[result[candidates] == NO_AREA]
+            inside = self.polygons[area].contains_many(lons[candidates],
+                                                       lats[candidates])
+            result[candidates[inside]] = area
+        return result
+
+    def assign_codes(self, lons, lats):
+        ''' Get the code of the area each point is in (None if none), as
+        a pandas Categorical
+        '''
+        areas = self.assign(lons, lats)
+        categories = pd.unique(self.codes)
+        code_index = pd.Index(categories).get_indexer(self.codes)
+        return pd.Categorical.from_codes(
+            np.where(areas == NO_AREA, -1, code_index[areas]), categories)
+
+    def assign_frame(self, dataframe):
+        ''' Get the area codes of the rows of a DataFrame from the
+        Processor, from their latitude and longitude
+        '''
+        return self.assign_codes(dataframe["longitude"].values,
+                                 dataframe["latitude"].values)
@@ -0,0 +1,246 @@
+""" Community detection on the interaction graph (analysis.graph).
+
+Communities are found on the undirected weighted graph of interactions
+(the adjacency matrix plus its transpose), by a Louvain-style method
+working directly on its CSR matrix:
+    - local moving: every node takes the community of its neighbours
+    with the greatest modularity gain, w_iC - resolution * k_i * tot_C / 2m
+    (w_iC being the weight of its edges into community C, k_i its degree,
+    tot_C the total degree of C and m the total weight). The gains of all
+    the (node, neighbouring community) pairs are summed in one sparse
+    matrix conversion, and the best per node picked with reduceat, so an
+    iteration is a few vectorized passes over the edges. A random half of
+    the nodes that would gain move each time, which keeps neighbours from
+    swapping communities forever, until only a tol fraction would
+    - aggregation: each community becomes a node of a smaller graph,
+    P' W P (P being the node -> community membership matrix), and the
+    moves are repeated on it until no communities merge
+With resolution 0 the moves are plain label propagation.
+
+Communities keeps the labels of each run by user id, and starts the next
+run from them: only the nodes around new edges have anything to move,
+so an update converges in a few iterations.
+"""
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import logging
+
+LOG = logging.getLogger(__name__)
+
+
+def symmetrize(adjacency):
+    ''' Get the undirected weights of a directed adjacency matrix, as a
+    float CSR matrix (without self loops)
+    '''
+    adjacency = sp.csr_matrix(adjacency, dtype=np.float64)
+    weights = (adjacency + adjacency.T).tocoo()
+    keep = weights.row != weights.col
+    return sp.csr_matrix((weights.data[keep],
+                          (weights.row[keep], weights.col[keep])),
+                         shape=weights.shape)
+
+
+def compact_labels(labels):
+    ''' Renumber labels to 0, 1, ..., keeping their order
+    '''
+    return np.unique(labels, return_inverse=True)[1]
+
+
+def degrees(weights):
+    return weights.dot(np.ones(weights.shape[1]))
+
+
+def modularity(weights, labels, resolution=1.0):
+    ''' Get the modularity of a partition of an undirected graph (weights
+    being symmetric)
+    '''
+    labels = compact_labels(labels)
+    total = weights.data.sum()
+    if total == 0:
+        return 0.0
+    coo = weights.tocoo()
+    internal = coo.data[labels[coo.row] == labels[coo.col]].sum()
+    community_degrees = np.bincount(labels, degrees(weights))
+    return (internal - resolution * (community_degrees ** 2).sum() /
+            total) / total
+
+
+def move_nodes(weights, labels, resolution=1.0, max_iter=50, tol=1e-3,
+               random_state=None):
+    ''' Move the nodes of an undirected graph between communities, from
+    the labels given (numbered 0 to n - 1), until at most a tol fraction
+    of them would gain from moving. Returns the new labels
+    '''
+    size = weights.shape[0]
+    labels = np.array(labels, dtype=np.int64)
+    random_state = random_state if random_state is not None \
+        else np.random.RandomState(0)
+    weights = weights.tocsr()
+    node_degrees = degrees(weights)
+    total = node_degrees.sum()
+    if size == 0 or total == 0:
+        return labels
+
+    rows = np.repeat(np.arange(size), np.diff(weights.indptr))
+    cols = weights.indices
+    not_loop = rows != cols
+    (rows, cols, data) = (rows[not_loop], cols[not_loop],
+                          weights.data[not_loop])
+    # A zero weight pair of each node and its own community, so staying
+    # is always a candidate
+    rows = np.concatenate([rows, np.arange(size)])
+    data = np.concatenate([data, np.zeros(size)])
+
+    for iteration in range(max_iter):
+        pair_labels = np.concatenate([labels[cols], labels])
+        pairs = sp.csr_matrix((data, (rows, pair_labels)),
+                              shape=(size, size))
+        pairs.sum_duplicates()
+        pair_rows = np.repeat(np.arange(size), np.diff(pairs.indptr))
+        candidates = pairs.indices
+        own = candidates == labels[pair_rows]
+
+        community_degrees = np.bincount(labels, node_degrees,
+                                        minlength=size)
+        others = community_degrees[candidates] - \
+            np.where(own, node_degrees[pair_rows], 0)
+        gains = pairs.data - \
+            resolution * node_degrees[pair_rows] * others / total
+
+        # Best candidate of each node (every row has one, its own
+        # community): greatest gain, then lowest label
+        starts = pairs.indptr[:-1]
+        best_gains = np.maximum.reduceat(gains, starts)
+        best = np.minimum.reduceat(
+            np.where(gains >= best_gains[pair_rows], candidates, size),
+            starts)
+        stay = np.empty(size)
+        stay[pair_rows[own]] = gains[own]
+        improving = best_gains > stay + 1e-12
+        unsettled = improving.sum()
+        LOG.debug("Iteration %d: %d of %d nodes to move", iteration,
+                  unsettled, size)
+        if unsettled <= tol * size:
+            # Too few left to swap back and forth: move them all
+            labels[improving] = best[improving]
+            break
+        moving = improving & (random_state.random_sample(size) < 0.5)
+        labels[moving] = best[moving]
+    return labels
+
+
+def aggregate(weights, labels):
+    ''' Get the graph of the communities of a graph: the weights between
+    (and, on the diagonal, within) communities
+    '''
+    size = weights.shape[0]
+    membership = sp.csr_matrix(
+        (np.ones(size), (np.arange(size), labels)),
+        shape=(size, labels.max() + 1 if size else 0))
+    return (membership.T.dot(weights).dot(membership)).tocsr()
+
+
+def louvain(weights, labels=None, resolution=1.0, max_levels=10,
+            max_iter=50, tol=1e-3, random_state=None):
+    ''' Find the communities of an undirected graph, starting from labels
+    (by default, a community per node). Returns the (compact) labels
+    '''
+    size = weights.shape[0]
+    random_state = random_state if random_state is not None \
+        else np.random.RandomState(0)
+    labels = compact_labels(np.arange(size) if labels is None else labels)
+    result = np.arange(size)
+    level_weights = weights
+    for level in range(max_levels):
+        labels = compact_labels(move_nodes(
+            level_weights, labels, resolution, max_iter, tol, random_state))
+        result = labels[result]
+        count = labels.max() + 1 if len(labels) else 0
+        LOG.debug("Level %d: %d nodes in %d communities", level,
+                  len(labels), count)
+        if count == len(labels):
+            break
+        level_weights = aggregate(level_weights, labels)
+        labels = np.arange(count)
+    return compact_labels(result)
+
+
+class Communities(object):
+    ''' The communities of the users of an analysis.graph.InteractionGraph,
+    updated as the graph grows
+    '''
+
+    def __init__(self, resolution=1.0, kinds=None, max_levels=10,
+                 max_iter=50, tol=1e-3, seed=0):
+        self.resolution = resolution
+        self.kinds = kinds
+        self.max_levels = max_levels
+        self.max_iter = max_iter
+        self.tol = tol
+        self.seed = seed
+        self.reset()
+
+    def reset(self):
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.labels = np.zeros(0, dtype=np.int64)
+        self.modularity = None
+
+    def initial_labels(self, ids):
+        ''' Get the labels of the last run for users ids, new users each
+        getting a community of their own
+        '''
+        previous = pd.Index(self.ids).get_indexer(ids)
+        known = previous >= 0
+        labels = np.empty(len(ids), dtype=np.int64)
+        labels[known] = self.labels[previous[known]]
+        first = self.labels.max() + 1 if len(self.labels) else 0
+        labels[~known] = first + np.arange((~known).sum())
+        return labels
+
+    def update(self, graph):
+        ''' Find the communities of a graph, starting from those found
+        last time. Returns the label of each of its nodes
+        '''
+        weights = symmetrize(graph.adjacency(self.kinds))
+        ids = np.array(graph.ids, dtype=np.int64)
+        self.labels = louvain(weights, self.initial_labels(ids),
+                              self.resolution, self.max_levels,
+                              self.max_iter, self.tol,
+                              np.random.RandomState(self.seed))
+        self.ids = ids
+        self.modularity = modularity(weights, self.labels, self.resolution)
+        LOG.info("Found %d communities of %d users (modularity %.3f)",
+                 len(self), len(ids), self.modularity)
+        return self.labels
+
+    def __len__(self):
+        return self.labels.max() + 1 if len(self.labels) else 0
+
+    def sizes(self):
+        ''' Get the number of users in each community
+        '''
+        return np.bincount(self.labels, minlength=len(self))
+
+    def members(self, label):
+        ''' Get the ids of the users in a community
+        '''
+        return self.ids[self.labels == label]
+
+    def label_of(self, ids):
+        ''' Get the communities of users ids (-1 for those unknown)
+        '''
+        index = pd.Index(self.ids).get_indexer(ids)
+        return np.where(index >= 0, self.labels[index], -1)
+
+    def get_state(self):
+        return {
+            "ids": self.ids.tolist(),
+            "labels": self.labels.tolist(),
+            "modularity": self.modularity,
+        }
+
+    def set_state(self, state):
+        self.ids = np.array(state["ids"], dtype=np.int64)
+        self.labels = np.array(state["labels"], dtype=np.int64)
+        self.modularity = state["modularity"]
@@ -0,0 +1,163 @@
+""" Incremental backfill of search/tweets results.
+
+Each query is paged backwards through max_id, until a page comes back
+short (fewer than the count asked for), so that the end of the results
+costs no extra request, or max_id stops moving. The newest id seen is
+saved as the query's since_id checkpoint, so that the next scheduled run
+only fetches tweets it has not seen before. If a run stops before it
+reaches the checkpoint (e.g. on its page limit), the position it got to
+is saved too, and the next run carries on from there first. A request
+refused on the way (e.g. rate limited, HTTP 429) stops the query in the
+same way, keeping the pages already fetched; a rate limited run stops
+there, as the other queries would be refused too.
+"""
+import json
+import os
+import logging
+
+from analysis.datafetch.twitter_stream import status_line, StreamError
+
+LOG = logging.getLogger(__name__)
+
+
+def query_key(query):
+    ''' Make a stable checkpoint key for a dict of query args
+    '''
+    return json.dumps(query, sort_keys=True)
+
+
+class Checkpoints(object):
+    ''' Per query backfill checkpoints, saved to a JSON file
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.queries = {}
+        if os.path.exists(path):
+            with open(path, "r") as checkpoint_file:
+                self.queries = json.load(checkpoint_file)
+
+    def get(self, key):
+        ''' Get the checkpoint of a query, as a dict with the since_id, and
+        the max_id/newest id of an unfinished run
+        '''
+        return dict(self.queries.get(key, {}))
+
+    def set(self, key, state):
+        self.queries[key] = state
+
+    def save(self):
+        ''' Save the checkpoints, atomically replacing the file
+        '''
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, "w") as checkpoint_file:
+            json.dump(self.queries, checkpoint_file, indent=4,
+                      sort_keys=True)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.rename(tmp_path, self.path)
+
+
+class SearchBackfill(object):
+    ''' Pages through search results newer than each query's checkpoint.
+
+    search is a callable taking the search args as keyword args, and
+    returning the decoded response and its headers, e.g.
+        lambda **kwargs: fetcher.get_json(DataFetcher.Cmd.search, **kwargs)
+    write is called with each status, as a JSON line (from status_line(),
+    so its id can be read without parsing it), and may return False to
+    refuse it (e.g. as a duplicate): only the statuses it accepts count as
+    written.
+    error is the StreamError that stopped the last query, if any.
+    '''
+
+    def __init__(self, search, checkpoints, write, count=100, max_pages=None):
+        self.search = search
+        self.checkpoints = checkpoints
+        self.write = write
+        self.count = count
+        self.max_pages = max_pages
+        self.requests = 0
+        self.error = None
+
+    def run_query(self, query, key=None, search=None, max_pages=None):
+        ''' Fetch the new results of one query, with search and up to
+        max_pages pages if given, instead of the backfill's own. Returns
+        the number of statuses written
+        '''
+        key = key if key is not None else query_key(query)
+        search = search if search is not None else self.search
+        max_pages = max_pages if max_pages is not None else self.max_pages
+        self.error = None
+        state = self.checkpoints.get(key)
+        since_id = state.get('since_id')
+        max_id = state.get('max_id')
+        newest = state.get('newest')
+
+        pages = 0
+        statuses_written = 0
+        finished = False
+        while max_pages is None or pages < max_pages:
+            args = dict(query)
+            args['count'] = self.count
+            args['result_type'] = 'recent'
+            args['include_entities'] = 1
+            args['since_id'] = since_id
+            args['max_id'] = max_id
+
+            try:
+                (result, headers) = search(**args)
+            except StreamError as exc:
+                LOG.error("Query %s refused: %s", key, exc)
+                self.error = exc
+                break
+            pages += 1
+            self.requests += 1
+
+            page = result.get('statuses', [])
+            statuses = page
+            if since_id is not None:
+                statuses = [s for s in statuses if s['id'] > since_id]
+            if not statuses:
+                finished = True
+                break
+
+            for status in statuses:
+                if self.write(status_line(status)) is not False:
+                    statuses_written += 1
+
+            ids = [s['id'] for s in statuses]
+            newest = max(ids) if newest is None else max(newest, max(ids))
+            next_max_id = min(ids) - 1
+            if len(page) < self.count or \
+                    (max_id is not None and next_max_id >= max_id):
+                # The last page, or the same one again
+                finished = True
+                break
+            max_id = next_max_id
+
+        if finished:
+            state = {'since_id': newest if newest is not None else since_id}
+        else:
+            state = {'since_id': since_id, 'max_id': max_id, 'newest': newest}
+        self.checkpoints.set(key, state)
+        self.checkpoints.save()
+
+        LOG.info("Query %s: %d statuses in %d pages%s",
+                 key, statuses_written, pages,
+                 "" if finished else " (unfinished)")
+        return statuses_written
+
+    def run(self, queries):
+        ''' Backfill each of a list of queries, given as dicts of search
+        args, optionally with an "id" to key their checkpoints by
+        '''
+        total = 0
+        for query in queries:
+            query = dict(query)
+            key = query.pop('id', None)
+            total += self.run_query(query, key)
+            if self.error is not None and self.error.status in (420, 429):
+                LOG.warn("Rate limited, stopping the backfill")
+                break
+        return total
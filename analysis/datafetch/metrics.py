@@ -0,0 +1,343 @@
+""" Live ingestion metrics for the twitter daemon.
+
+Metrics holds the daemon's counters and gauges in-process. Any callable
+can also be registered as a metric, so counts already kept elsewhere
+(e.g. a StreamSupervisor's reconnects) are read when they are reported.
+The metrics are reported in two ways:
+    - MetricsServer serves them in the Prometheus text exposition format
+    on a local HTTP port (GET /metrics)
+    - StatsReporter appends a JSON snapshot every interval to a stats
+    file, which is rolled over by size, and keeps the per-second rates
+    (tweets/sec, bytes/sec...) over the last interval up to date
+"""
+import BaseHTTPServer
+import calendar
+import json
+import os
+import re
+import threading
+import time
+import logging
+
+from analysis.geofence import status_coordinates
+
+LOG = logging.getLogger(__name__)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+
+CREATED_AT_FORMAT = '%a %b %d %H:%M:%S +0000 %Y'
+
+RE_METRIC_NAME = re.compile(r'^[a-zA-Z_][a-zA-Z0-9_]*$')
+
+
+def format_value(value):
+    if value is None:
+        return 'NaN'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Metrics(object):
+    ''' Thread safe registry of named counters and gauges
+    '''
+
+    def __init__(self, prefix='twitterd'):
+        self.prefix = prefix
+        self.values = {}
+        self.kinds = {}
+        self.helps = {}
+        self.funcs = {}
+        self._lock = threading.Lock()
+
+    def _declare(self, name, kind, help_text):
+        if not RE_METRIC_NAME.match(name):
+            raise ValueError("Bad metric name: %s" % name)
+        if name in self.kinds and self.kinds[name] != kind:
+            raise ValueError("Metric %s is a %s" % (name, self.kinds[name]))
+        self.kinds[name] = kind
+        if help_text is not None:
+            self.helps[name] = help_text
+
+    def counter(self, name, help_text=None):
+        ''' Declare a counter, starting at 0
+        '''
+        with self._lock:
+            self._declare(name, COUNTER, help_text)
+            self.values.setdefault(name, 0)
+
+    def gauge(self, name, help_text=None, value=None):
+        ''' Declare a gauge, with no value (NaN) until it is set
+        '''
+        with self._lock:
+            self._declare(name, GAUGE, help_text)
+            self.values.setdefault(name, value)
+
+    def register(self, name, func, kind=GAUGE, help_text=None):
+        ''' Register a callable, returning the metric's current value
+        '''
+        with self._lock:
+            self._declare(name, kind, help_text)
+            self.funcs[name] = func
+
+    def inc(self, name, value=1):
+        with self._lock:
+            if name not in self.kinds:
+                self._declare(name, COUNTER, None)
+            self.values[name] = self.values.get(name, 0) + value
+
+    def set(self, name, value):
+        with self._lock:
+            if name not in self.kinds:
+                self._declare(name, GAUGE, None)
+            self.values[name] = value
+
+    def get(self, name):
+        if name in self.funcs:
+            return self.funcs[name]()
+        return self.values.get(name)
+
+    def snapshot(self):
+        ''' Get the current value of every metric, as a dict
+        '''
+        with self._lock:
+            values = dict(self.values)
+            funcs = dict(self.funcs)
+        for (name, func) in funcs.items():
+            try:
+                values[name] = func()
+            except Exception:
+                LOG.exception("Unable to read metric %s", name)
+                values[name] = None
+        return values
+
+    def exposition(self):
+        ''' Format the metrics in the Prometheus text exposition format
+        '''
+        values = self.snapshot()
+        lines = []
+        for name in sorted(values):
+            full_name = '%s_%s' % (self.prefix, name) if self.prefix \
+                else name
+            if name in self.helps:
+                lines.append('# HELP %s %s' % (full_name, self.helps[name]))
+            lines.append('# TYPE %s %s' % (full_name, self.kinds[name]))
+            lines.append('%s %s' % (full_name, format_value(values[name])))
+        return '\n'.join(lines) + '\n'
+
+
+def parse_created_at(created_at):
+    ''' Convert a status' created_at to seconds since the epoch
+    '''
+    return calendar.timegm(time.strptime(created_at, CREATED_AT_FORMAT))
+
+
+class IngestMetrics(object):
+    ''' Counts the lines read from the API as they arrive: statuses,
+    other messages (limit notices, deletions...), parse errors, geotagged
+    statuses and the lag between a status' creation and its arrival
+    '''
+
+    def __init__(self, metrics, clock=time.time):
+        self.metrics = metrics
+        self.clock = clock
+        metrics.counter('lines_total', 'Lines read')
+        metrics.counter('bytes_total', 'Bytes of lines read')
+        metrics.counter('tweets_total', 'Statuses read')
+        metrics.counter('notices_total',
+                        'Other messages read (limits, deletions...)')
+        metrics.counter('parse_errors_total', 'Lines that are not JSON')
+        metrics.counter('geotagged_total', 'Geotagged statuses read')
+        metrics.counter('lag_seconds_sum',
+                        'Total seconds from creation to arrival')
+        metrics.counter('lag_seconds_count', 'Statuses with a known lag')
+        metrics.gauge('last_lag_seconds',
+                      'Seconds from creation to arrival, of the last status')
+
+    def observe(self, line):
+        ''' Count a line read from the API. Returns the decoded message,
+        or None if it could not be parsed
+        '''
+        metrics = self.metrics
+        metrics.inc('lines_total')
+        metrics.inc('bytes_total', len(line) + 1)
+        try:
+            message = json.loads(line)
+        except ValueError:
+            metrics.inc('parse_errors_total')
+            return None
+        if not isinstance(message, dict) or 'id' not in message:
+            metrics.inc('notices_total')
+            return message
+
+        metrics.inc('tweets_total')
+        if status_coordinates(message) is not None:
+            metrics.inc('geotagged_total')
+        lag = self.get_lag(message)
+        if lag is not None:
+            metrics.inc('lag_seconds_sum', lag)
+            metrics.inc('lag_seconds_count')
+            metrics.set('last_lag_seconds', lag)
+        return message
+
+    def get_lag(self, status):
+        ''' Seconds between the creation and arrival of a status, from its
+        timestamp_ms (stream) or created_at (search), or None
+        '''
+        try:
+            if 'timestamp_ms' in status:
+                created = int(status['timestamp_ms']) / 1000.0
+            else:
+                created = parse_created_at(status['created_at'])
+        except (KeyError, ValueError, TypeError):
+            return None
+        return self.clock() - created
+
+
+class StatsReporter(object):
+    ''' Every interval seconds, updates the rate gauges over the interval
+    and appends a snapshot of the metrics to a stats file (if path is
+    given), which is rolled over to path.1 at max_bytes.
+
+    rates maps the name of each rate gauge to the counter it is the rate
+    of, and ratios maps a gauge to the (numerator, denominator) counters
+    it is the ratio of, over the interval
+    '''
+
+    RATES = {
+        'tweets_per_second': 'tweets_total',
+        'bytes_per_second': 'bytes_total',
+    }
+    RATIOS = {
+        'geotagged_ratio': ('geotagged_total', 'tweets_total'),
+        'lag_seconds': ('lag_seconds_sum', 'lag_seconds_count'),
+    }
+
+    def __init__(self,
+                 metrics,
+                 path=None,
+                 interval=60,
+                 max_bytes=16 * 1024 * 1024,
+                 rates=None,
+                 ratios=None,
+                 clock=time.time):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.rates = rates if rates is not None else self.RATES
+        self.ratios = ratios if ratios is not None else self.RATIOS
+        self.clock = clock
+        for name in self.rates:
+            metrics.gauge(name, 'Per second, over the last interval')
+        for name in self.ratios:
+            metrics.gauge(name, 'Over the last interval')
+
+        self._last = metrics.snapshot()
+        self._last_time = clock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def report(self):
+        ''' Update the rates, and write a snapshot. Returns the snapshot
+        '''
+        now = self.clock()
+        values = self.metrics.snapshot()
+        elapsed = now - self._last_time
+
+        def delta(name):
+            return (values.get(name) or 0) - (self._last.get(name) or 0)
+
+        for (name, counter) in self.rates.items():
+            if elapsed > 0:
+                values[name] = delta(counter) / float(elapsed)
+                self.metrics.set(name, values[name])
+        for (name, (numerator, denominator)) in self.ratios.items():
+            if delta(denominator) > 0:
+                values[name] = delta(numerator) / float(delta(denominator))
+            else:
+                values[name] = None
+            self.metrics.set(name, values[name])
+
+        self._last = values
+        self._last_time = now
+        values['time'] = now
+        if self.path is not None:
+            self.write(values)
+        return values
+
+    def write(self, values):
+        if os.path.exists(self.path) and \
+                os.path.getsize(self.path) >= self.max_bytes:
+            os.rename(self.path, self.path + '.1')
+        with open(self.path, "a") as stats_file:
+            stats_file.write(json.dumps(values, sort_keys=True) + '\n')
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.report()
+            except Exception:
+                LOG.exception("Unable to report stats")
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name='stats')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        ''' Stop reporting, after a last report
+        '''
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.report()
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    ''' Serves the server's metrics at /metrics
+    '''
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def log_message(self, fmt, *args):
+        LOG.debug(fmt, *args)
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.exposition()
+        self.send_response(200)
+        self.send_header('Content-Type', self.CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MetricsServer(object):
+    ''' HTTP server for the metrics, in a background thread. Listens on
+    localhost only by default
+    '''
+
+    def __init__(self, metrics, port, host='127.0.0.1'):
+        self.server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+        self.server.metrics = metrics
+        self.port = self.server.server_address[1]
+        self._thread = None
+
+    def start(self):
+        LOG.info("Serving metrics on port %d", self.port)
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        name='metrics')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,232 @@
+""" Rate-limit aware scheduling of geocode searches over a bounding box.
+
+The box (e.g. DataFetcher.Locations.NORTHAMPTONSHIRE) is tiled with
+overlapping geocode circles, each searched as its own backfill query.
+Requests go through a token bucket which is kept in step with the
+x-rate-limit-* response headers, and each request goes to the tile that
+has been yielding the most new tweets lately, so a rate-limit window is
+spent where it returns the most unique tweets. A request refused as rate
+limited empties the bucket until the window resets.
+"""
+import json
+import math
+import os
+import time
+import logging
+
+from analysis.datafetch.twitter_stream import StreamError
+
+LOG = logging.getLogger(__name__)
+
+KM_PER_DEGREE = 111.32
+
+
+def tile_geocodes(bbox, radius_km):
+    ''' Cover bbox ('lon1,lat1,lon2,lat2', as used by the stream's
+    locations arg) with overlapping circles of radius_km, laid out on a
+    hexagonal grid. Returns search geocode args ('lat,lon,Rkm')
+    '''
+    (lon1, lat1, lon2, lat2) = [float(v) for v in bbox.split(',')]
+    # Hexagonal covering: rows 1.5r apart, centres sqrt(3)r apart, with
+    # every other row shifted by half a step
+    row_step = 1.5 * radius_km / KM_PER_DEGREE
+    geocodes = []
+    row = 0
+    lat = lat1
+    while True:
+        km_per_lon = KM_PER_DEGREE * math.cos(math.radians(lat))
+        col_step = math.sqrt(3) * radius_km / km_per_lon
+        lon = lon1 - (col_step / 2.0 if row % 2 else 0.0)
+        while True:
+            geocodes.append('%.6f,%.6f,%gkm' % (lat, lon, radius_km))
+            if lon >= lon2:
+                break
+            lon += col_step
+        if lat >= lat2:
+            break
+        lat += row_step
+        row += 1
+    return geocodes
+
+
+class RateLimiter(object):
+    ''' Token bucket for one rate limited endpoint, e.g. 180 requests per
+    15 minute window for search/tweets. Tokens refill at the average
+    rate, and update() resets the bucket from the rate limit headers:
+    until the reset time they give, only the remaining requests they
+    allow can be made
+    '''
+
+    def __init__(self, limit=180, window=900, clock=time.time,
+                 sleep=time.sleep):
+        self.limit = limit
+        self.window = window
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = float(limit)
+        self.updated_at = clock()
+        self.reset_at = None
+
+    def _refill(self):
+        now = self.clock()
+        if self.reset_at is not None:
+            if now >= self.reset_at:
+                self.tokens = float(self.limit)
+                self.reset_at = None
+        else:
+            self.tokens = min(float(self.limit),
+                              self.tokens +
+                              (now - self.updated_at) * self.limit /
+                              float(self.window))
+        self.updated_at = now
+
+    def wait_time(self):
+        ''' Seconds until a request may be made
+        '''
+        self._refill()
+        if self.tokens >= 1.0:
+            return 0.0
+        if self.reset_at is not None:
+            return max(0.0, self.reset_at - self.clock())
+        return (1.0 - self.tokens) * self.window / float(self.limit)
+
+    def acquire(self):
+        ''' Wait for, and take, a token. Returns the time waited
+        '''
+        waited = 0.0
+        delay = self.wait_time()
+        while delay > 0:
+            LOG.info("Rate limited, waiting %.1f seconds", delay)
+            self.sleep(delay)
+            waited += delay
+            delay = self.wait_time()
+        self.tokens -= 1.0
+        return waited
+
+    def update(self, headers):
+        ''' Sync the bucket with the x-rate-limit-* headers of a response
+        '''
+        try:
+            remaining = int(headers['x-rate-limit-remaining'])
+        except (KeyError, ValueError):
+            return
+        if 'x-rate-limit-limit' in headers:
+            self.limit = int(headers['x-rate-limit-limit'])
+        self.tokens = float(remaining)
+        self.updated_at = self.clock()
+        if 'x-rate-limit-reset' in headers:
+            self.reset_at = float(headers['x-rate-limit-reset'])
+
+    def refused(self):
+        ''' Empty the bucket after a request refused as rate limited, until
+        the known reset time or else for a whole window
+        '''
+        now = self.clock()
+        self.tokens = 0.0
+        self.updated_at = now
+        if self.reset_at is None or self.reset_at <= now:
+            self.reset_at = now + self.window
+
+
+class TileScheduler(object):
+    ''' Spends a request budget on the geocode tiles, one search page at a
+    time, always picking the tile with the best recent yield.
+
+    A tile's yield is a moving average of the new tweets per request; a
+    tile's priority also grows with the time since it was last searched,
+    so quiet tiles still get searched now and then. Tweets are only new if
+    the backfill's write accepts them, so with a de-duplicating write, a
+    tile overlapping a busy one is not credited with its tweets again. The
+    scores are saved after every search, so an interrupted run loses none
+    of them.
+    '''
+
+    def __init__(self,
+                 geocodes,
+                 backfill,
+                 limiter,
+                 query=None,
+                 decay=0.5,
+                 staleness_weight=1.0,
+                 scores_path=None,
+                 clock=time.time):
+        self.geocodes = geocodes
+        self.backfill = backfill
+        self.limiter = limiter
+        self.query = query if query is not None else {'q': ''}
+        self.decay = decay
+        self.staleness_weight = staleness_weight
+        self.scores_path = scores_path
+        self.clock = clock
+        self.searches = 0
+
+        # geocode: [yield, last searched at]
+        self.scores = {}
+        if scores_path is not None and os.path.exists(scores_path):
+            with open(scores_path, "r") as scores_file:
+                self.scores = json.load(scores_file)
+
+    def limited_search(self, **kwargs):
+        ''' Make a search request of the backfill's through the limiter
+        '''
+        self.limiter.acquire()
+        try:
+            (result, headers) = self.backfill.search(**kwargs)
+        except StreamError as exc:
+            if exc.status in (420, 429):
+                self.limiter.refused()
+            raise
+        self.limiter.update(headers)
+        return (result, headers)
+
+    def priority(self, geocode, now):
+        if geocode not in self.scores:
+            return float('inf')
+        (score, last_run) = self.scores[geocode]
+        staleness = (now - last_run) / float(self.limiter.window)
+        return score + self.staleness_weight * staleness
+
+    def next_geocode(self):
+        ''' Get the tile to search next
+        '''
+        now = self.clock()
+        return max(self.geocodes, key=lambda g: self.priority(g, now))
+
+    def run(self, max_requests):
+        ''' Make up to max_requests searches. Returns the number of new
+        statuses written
+        '''
+        total = 0
+        searches = 0
+        for _ in range(max_requests):
+            geocode = self.next_geocode()
+            query = dict(self.query)
+            query['geocode'] = geocode
+            # Each scheduling decision should cost exactly one request
+            requests = self.backfill.requests
+            statuses = self.backfill.run_query(query,
+                                               key='geocode:' + geocode,
+                                               search=self.limited_search,
+                                               max_pages=1)
+            total += statuses
+            if self.backfill.requests == requests:
+                # Not searched: the next request waits for the limiter
+                continue
+            searches += 1
+            (score, _) = self.scores.get(geocode, [statuses, None])
+            score = self.decay * score + (1.0 - self.decay) * statuses
+            self.scores[geocode] = [score, self.clock()]
+            self.save()
+        self.searches += searches
+        LOG.info("Searched %d tiles: %d new statuses", searches, total)
+        return total
+
+    def save(self):
+        ''' Save the scores, atomically replacing the file
+        '''
+        if self.scores_path is None:
+            return
+        tmp_path = self.scores_path + '.tmp'
+        with open(tmp_path, "w") as scores_file:
+            json.dump(self.scores, scores_file, indent=4, sort_keys=True)
+        os.rename(tmp_path, self.scores_path)
@@ -0,0 +1,270 @@
+""" Segmented, rotating, compressed output for collected statuses.
+
+Statuses are written one per line to a series of gzipped segment files,
+named like twitter_data-YYYYMMDDHH-NNN.jsonl.gz, which are rolled over
+by size or age. When a segment is closed it is flushed and fsync'ed, and
+an entry describing it is appended to the manifest, so downstream jobs
+can pick up just the segments they have not processed yet.
+
+A segment left open by a crash is missing from the manifest (and may
+end in a partial line, or a partial gzip block). When a writer starts,
+it recovers its segments which are not listed: their complete lines are
+rewritten into a sound file in place, which is then added to the
+manifest, marked as recovered.
+"""
+import calendar
+import gzip
+import json
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+import logging
+
+from analysis.datafetch.twitter_stream import get_tweet_id
+
+LOG = logging.getLogger(__name__)
+
+MANIFEST_NAME = 'manifest.jsonl'
+
+SEGMENT_PATTERN = r'^%s-(\d{10})-\d{3,}\.jsonl(\.gz)?$'
+
+
+def read_manifest(outdir, manifest_name=MANIFEST_NAME):
+    ''' Read the list of closed segments (as dicts) in write order
+    '''
+    manifest_path = os.path.join(outdir, manifest_name)
+    entries = []
+    if not os.path.exists(manifest_path):
+        return entries
+    with open(manifest_path, "r") as manifest_file:
+        for line in manifest_file:
+            line = line.strip()
+            if line == "":
+                continue
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                LOG.warn("Skipping bad manifest entry: %s", line)
+    return entries
+
+
+def open_segment(path):
+    ''' Open a segment, or any other results file, for reading
+    '''
+    if path.endswith('.gz'):
+        return gzip.open(path, "rb")
+    return open(path, "r")
+
+
+class SegmentWriter(object):
+    ''' Writes status lines to a rolling series of segment files.
+    Safe to share between the threads of several streams. Only one writer
+    at a time may use a prefix in an outdir, as each recovers the unlisted
+    segments of its prefix on starting.
+    '''
+
+    def __init__(self,
+                 outdir,
+                 prefix='twitter_data',
+                 max_bytes=256 * 1024 * 1024,
+                 max_seconds=3600,
+                 compress=True,
+                 manifest_name=MANIFEST_NAME):
+        self.outdir = outdir
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.compress = compress
+        self.manifest_path = os.path.join(outdir, manifest_name)
+
+        self.segment_name = None
+        self._raw_file = None
+        self._out_file = None
+        self._opened_at = None
+        self._lines = 0
+        self._bytes = 0
+        self._first_line = None
+        self._last_line = None
+        self._lock = threading.Lock()
+        if os.path.isdir(outdir):
+            self.recover()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _make_segment_name(self, now):
+        ''' Make the name of a new segment, never reusing an existing file
+        so that restarts do not truncate earlier data
+        '''
+        stamp = time.strftime('%Y%m%d%H', time.gmtime(now))
+        suffix = '.jsonl.gz' if self.compress else '.jsonl'
+        seq = 0
+        while True:
+            name = '%s-%s-%03d%s' % (self.prefix, stamp, seq, suffix)
+            if not os.path.exists(os.path.join(self.outdir, name)):
+                return name
+            seq += 1
+
+    def _open_segment(self):
+        now = time.time()
+        self.segment_name = self._make_segment_name(now)
+        path = os.path.join(self.outdir, self.segment_name)
+        LOG.info("Opening segment %s", path)
+
+        self._raw_file = open(path, "wb")
+        if self.compress:
+            self._out_file = gzip.GzipFile(filename=self.segment_name,
+                                           fileobj=self._raw_file,
+                                           mode="wb")
+        else:
+            self._out_file = self._raw_file
+        self._opened_at = now
+        self._lines = 0
+        self._bytes = 0
+        self._first_line = None
+        self._last_line = None
+
+    def _close_segment(self):
+        if self._out_file is None:
+            return
+
+        if self._out_file is not self._raw_file:
+            self._out_file.close()
+        self._raw_file.flush()
+        os.fsync(self._raw_file.fileno())
+        self._raw_file.close()
+
+        path = os.path.join(self.outdir, self.segment_name)
+        self._add_to_manifest({
+            'segment': self.segment_name,
+            'lines': self._lines,
+            'bytes': self._bytes,
+            'compressed_bytes': os.path.getsize(path),
+            'first_id': get_tweet_id(self._first_line or ''),
+            'last_id': get_tweet_id(self._last_line or ''),
+            'opened_at': int(self._opened_at),
+            'closed_at': int(time.time()),
+        })
+
+        LOG.info("Closed segment %s: %d lines, %d bytes",
+                 self.segment_name, self._lines, self._bytes)
+        self._out_file = None
+        self._raw_file = None
+        self.segment_name = None
+
+    def _add_to_manifest(self, entry):
+        with open(self.manifest_path, "a") as manifest_file:
+            manifest_file.write(json.dumps(entry, sort_keys=True) + '\n')
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+
+    def recover(self):
+        ''' Add the segments of this writer's prefix which are missing
+        from the manifest (left open by a crash) to it, in name order.
+        Returns their names
+        '''
+        listed = set(entry['segment']
+                     for entry in read_manifest(
+                         self.outdir, os.path.basename(self.manifest_path)))
+        pattern = re.compile(SEGMENT_PATTERN % re.escape(self.prefix))
+        recovered = [name for name in sorted(os.listdir(self.outdir))
+                     if pattern.match(name) and name not in listed]
+        for name in recovered:
+            self._recover_segment(name, pattern.match(name).group(1))
+        return recovered
+
+    def _recover_segment(self, name, stamp):
+        ''' Rewrite the complete lines of an unlisted segment, and add it
+        to the manifest
+        '''
+        path = os.path.join(self.outdir, name)
+        tmp_path = path + '.tmp'
+        closed_at = int(os.path.getmtime(path))
+        (lines, size, first_line, last_line) = (0, 0, None, None)
+        with open(tmp_path, "wb") as raw_file:
+            out_file = gzip.GzipFile(filename=name, fileobj=raw_file,
+                                     mode="wb") \
+                if name.endswith('.gz') else raw_file
+            in_file = open_segment(path)
+            try:
+                for line in in_file:
+                    if not line.endswith('\n'):
+                        break
+                    out_file.write(line)
+                    lines += 1
+                    size += len(line)
+                    if first_line is None:
+                        first_line = line
+                    last_line = line
+            except (IOError, EOFError, struct.error, zlib.error) as exc:
+                LOG.warn("Segment %s is damaged after %d lines: %s",
+                         path, lines, exc)
+            finally:
+                in_file.close()
+            if out_file is not raw_file:
+                out_file.close()
+            raw_file.flush()
+            os.fsync(raw_file.fileno())
+        os.rename(tmp_path, path)
+
+        self._add_to_manifest({
+            'segment': name,
+            'lines': lines,
+            'bytes': size,
+            'compressed_bytes': os.path.getsize(path),
+            'first_id': get_tweet_id(first_line or ''),
+            'last_id': get_tweet_id(last_line or ''),
+            'opened_at': calendar.timegm(time.strptime(stamp, '%Y%m%d%H')),
+            'closed_at': closed_at,
+            'recovered': True,
+        })
+        LOG.warn("Recovered segment %s: %d lines", path, lines)
+
+    def roll(self):
+        ''' Close the current segment (if any); the next write opens a
+        new one
+        '''
+        with self._lock:
+            self._close_segment()
+
+    def write(self, line):
+        ''' Write a status line (without its line terminator)
+        '''
+        with self._lock:
+            self._write(line)
+
+    def write_many(self, lines):
+        ''' Write a batch of status lines in one go. The batch all goes to
+        the same segment, so a segment may run over max_bytes by a batch
+        '''
+        if not lines:
+            return
+        with self._lock:
+            self._write('\n'.join(lines), len(lines), lines[0], lines[-1])
+
+    def _write(self, data, lines=1, first_line=None, last_line=None):
+        if self._out_file is not None and \
+                (self._bytes >= self.max_bytes or
+                 time.time() - self._opened_at >= self.max_seconds):
+            self._close_segment()
+        if self._out_file is None:
+            self._open_segment()
+
+        self._out_file.write(data + '\n')
+        self._lines += lines
+        self._bytes += len(data) + 1
+        if self._first_line is None:
+            self._first_line = first_line if first_line is not None else data
+        self._last_line = last_line if last_line is not None else data
+
+    def close(self):
+        ''' Close the current segment
+        '''
+        with self._lock:
+            self._close_segment()
@@ -0,0 +1,227 @@
+""" Keeps a streaming connection alive for the twitter daemon.
+
+StreamSupervisor reconnects whenever the stream ends, stalls or fails,
+backing off between attempts as the streaming API asks clients to:
+    - network errors (and stalls, corrupt chunks, and connections the
+    server closes) back off linearly, 250ms at a time, up to 16 seconds
+    - HTTP errors back off exponentially, starting at 5 seconds, up to
+    320 seconds
+    - rate limiting (HTTP 420/429) backs off exponentially, starting at
+    1 minute
+Stalls are detected by the stream client's socket timeout, which fires
+when no bytes (statuses or keep-alive newlines) arrive for that long.
+"""
+import errno
+import httplib
+import os
+import random
+import signal
+import socket
+import threading
+import time
+import zlib
+import logging
+
+from analysis.datafetch.twitter_stream import StreamError
+
+LOG = logging.getLogger(__name__)
+
+
+class Backoff(object):
+    ''' Reconnect delays for each kind of failure, with random jitter
+    added on top of the delays the API asks for.
+    '''
+
+    NETWORK = 'network'
+    HTTP = 'http'
+    RATE_LIMITED = 'rate_limited'
+
+    # kind: (first delay, growth, max delay, exponential?)
+    POLICY = {
+        NETWORK: (0.25, 0.25, 16.0, False),
+        HTTP: (5.0, 2.0, 320.0, True),
+        RATE_LIMITED: (60.0, 2.0, 960.0, True),
+    }
+
+    def __init__(self, jitter=0.25, rand=random.random):
+        self.jitter = jitter
+        self.rand = rand
+        self.failures = 0
+        self.kind = None
+
+    def reset(self):
+        ''' Forget earlier failures, after a successful connection
+        '''
+        self.failures = 0
+        self.kind = None
+
+    def next_delay(self, kind):
+        ''' Get the delay (in seconds) before the next reconnect attempt
+        '''
+        if kind != self.kind:
+            self.failures = 0
+            self.kind = kind
+        (first, growth, max_delay, exponential) = self.POLICY[kind]
+        if exponential:
+            delay = first * (growth ** self.failures)
+        else:
+            delay = first + growth * self.failures
+        self.failures += 1
+        delay = min(delay, max_delay)
+        return delay * (1.0 + self.jitter * self.rand())
+
+
+class StreamSupervisor(object):
+    ''' Runs a stream, passing each line to handle_line, and reconnects
+    until stopped.
+
+    open_stream is a callable returning a fresh iterator of lines for
+    each connection, e.g. a DataFetcher.iter_stream generator. abort, if
+    given, is called by stop() to unblock a connection waiting for data.
+    '''
+
+    def __init__(self,
+                 open_stream,
+                 handle_line,
+                 backoff=None,
+                 wait=None,
+                 abort=None,
+                 name='stream'):
+        self.open_stream = open_stream
+        self.handle_line = handle_line
+        self.abort = abort
+        self.name = name
+        self.backoff = backoff if backoff is not None else Backoff()
+        self._stop_event = threading.Event()
+        self.wait = wait if wait is not None else self._stop_event.wait
+
+        self.connections = 0
+        self.reconnects = 0
+        self.stalls = 0
+        self.errors = 0
+
+    @property
+    def running(self):
+        return not self._stop_event.is_set()
+
+    def stop(self):
+        ''' Ask the supervisor to stop after the current line
+        '''
+        LOG.info("Stopping stream supervisor %s", self.name)
+        self._stop_event.set()
+        if self.abort is not None:
+            self.abort()
+
+    def _run_once(self):
+        ''' Run a single connection until it ends. Returns the kind of
+        failure to back off for. A connection which ends is backed off
+        from like a network error, so a server closing connections as soon
+        as they are made is not hammered (the delay only grows while no
+        line arrives)
+        '''
+        stream = self.open_stream()
+        self.connections += 1
+        try:
+            for line in stream:
+                if self.backoff.failures:
+                    self.backoff.reset()
+                self.handle_line(line)
+                if not self.running:
+                    break
+            LOG.info("Stream %s ended", self.name)
+            return Backoff.NETWORK
+        except StreamError as exc:
+            LOG.error("Stream %s refused: %s", self.name, exc)
+            self.errors += 1
+            return Backoff.RATE_LIMITED if exc.status in (420, 429) \
+                else Backoff.HTTP
+        except socket.timeout:
+            LOG.warn("Stream %s stalled, reconnecting", self.name)
+            self.stalls += 1
+            return Backoff.NETWORK
+        except (socket.error, httplib.HTTPException, IOError, zlib.error,
+                ValueError) as exc:
+            # zlib.error and ValueError: a corrupt gzip body or chunk size
+            if self.running:
+                LOG.error("Stream %s failed: %s", self.name, exc)
+                self.errors += 1
+            return Backoff.NETWORK
+        finally:
+            close = getattr(stream, 'close', None)
+            if close is not None:
+                close()
+
+    def run(self):
+        ''' Keep the stream running until stop() is called
+        '''
+        while self.running:
+            kind = self._run_once()
+            if not self.running:
+                break
+            self.reconnects += 1
+            delay = self.backoff.next_delay(kind)
+            LOG.info("Reconnecting %s in %.2f seconds", self.name, delay)
+            self.wait(delay)
+        LOG.info("Stream supervisor %s stopped after %d connections",
+                 self.name,
+                 self.connections)
+
+
+class PidFile(object):
+    ''' A pid file for the daemon, so that it can be stopped/restarted
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def read_pid(self):
+        ''' Get the pid in the file, or None
+        '''
+        try:
+            with open(self.path, "r") as pid_file:
+                return int(pid_file.read().strip())
+        except (IOError, ValueError):
+            return None
+
+    @classmethod
+    def is_alive(cls, pid):
+        try:
+            os.kill(pid, 0)
+        except OSError as exc:
+            return exc.errno == errno.EPERM
+        return True
+
+    def acquire(self):
+        ''' Write our pid, unless another live process holds the file
+        '''
+        pid = self.read_pid()
+        if pid is not None and pid != os.getpid() and self.is_alive(pid):
+            raise RuntimeError("Already running with pid %d" % pid)
+        with open(self.path, "w") as pid_file:
+            pid_file.write("%d\n" % os.getpid())
+
+    def release(self):
+        ''' Remove the pid file, if it is ours
+        '''
+        if self.read_pid() == os.getpid():
+            os.remove(self.path)
+
+    def stop(self, timeout=60, poll=0.5):
+        ''' Send SIGTERM to the process in the pid file and wait for it to
+        exit. Returns False if it is still running after timeout seconds
+        '''
+        pid = self.read_pid()
+        if pid is None or not self.is_alive(pid):
+            LOG.info("Not running")
+            return True
+        LOG.info("Stopping pid %d", pid)
+        os.kill(pid, signal.SIGTERM)
+        waited = 0.0
+        while self.is_alive(pid):
+            if waited >= timeout:
+                LOG.error("pid %d did not stop after %d seconds",
+                          pid, timeout)
+                return False
+            time.sleep(poll)
+            waited += poll
+        return True
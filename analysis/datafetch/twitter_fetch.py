@@ -11,6 +11,7 @@ from enum import Enum
 import subprocess
 import twitter as tw
 import logging
+from analysis.datafetch.twitter_stream import StreamClient
 
 LOG = logging.getLogger(__name__)
 
@@ -156,22 +157,38 @@ class DataFetcher(object):
             self.Cmd.stream_filter: [True,
                                      self.TWITTER_STR_STATUS_FILTER],
         }
+        # One signer, shared by every request and stream
+        self.signer = OAuthSigner()
         self.api = tw.Api(**self._settings)
         self.api.VerifyCredentials()
 
-    def generate_curl_cmdline(self,
-                              command,
-                              verbose,
-                              timeout,
-                              **kwargs):
-        ''' Generate the curl command needed to fetch twitter statuses
+    def get_command_url(self, command):
+        ''' Get the full URL for a twitter command
         '''
-        # The URL to query
         is_streaming = self.cmd_map[command][0]
         base_url = self.TWITTER_STR_API_URL if is_streaming else self.TWITTER_API_URL
         cmd_url = self.cmd_map[command][1]
-        filter_url = base_url + cmd_url
-        signer = OAuthSigner()
+        return base_url + cmd_url
+
+    @classmethod
+    def encode_request_args(cls, **kwargs):
+        ''' Convert request args to strings, dropping the ones set to None
+        '''
+        req_args = {}
+
+        for key in kwargs:
+            val = kwargs[key]
+            if val is not None:
+                arg_val = str(val).lower() if type(val) is bool else str(val)
+                req_args[key] = arg_val
+
+        return req_args
+
+    def generate_auth_header(self, req_type, url, req_args):
+        ''' Generate the value of the OAuth 'Authorization' header for a
+        request of req_type to url, with the (encoded) request args
+        '''
+        signer = self.signer
         twitter_keys = self._settings
 
         '''
@@ -203,15 +220,7 @@ class DataFetcher(object):
             'oauth_token': twitter_keys["access_token_key"],
             'oauth_version': "1.0",
         }
-
-        req_args = {}
-
-        for key in kwargs:
-            val = kwargs[key]
-            if val is not None:
-                arg_val = str(val).lower() if type(val) is bool else str(val)
-                argmap[key] = arg_val
-                req_args[key] = arg_val
+        argmap.update(req_args)
 
         # Parameters that constitute the siging key
         oauth_consumer_secret = twitter_keys["consumer_secret"]
@@ -220,28 +229,42 @@ class DataFetcher(object):
         # Generate the oauth request signature
         oauth_signature = signer.sign_request(oauth_consumer_secret,
                                               oauth_token_secret,
-                                              "GET",
-                                              filter_url,
+                                              req_type,
+                                              url,
                                               argmap)
 
-        # Generate the %-encoded request args
-        twdata = urllib.urlencode(req_args)
-
-        # Set up the request header
-        twheader = ('Authorization: OAuth ' +
-                    'oauth_consumer_key="%s", ' +
-                    'oauth_nonce="%s", ' +
-                    'oauth_signature="%s", ' +
-                    'oauth_signature_method="HMAC-SHA1", ' +
-                    'oauth_timestamp="%s", ' +
-                    'oauth_token="%s", ' +
-                    'oauth_version="1.0"') % \
+        return ('OAuth ' +
+                'oauth_consumer_key="%s", ' +
+                'oauth_nonce="%s", ' +
+                'oauth_signature="%s", ' +
+                'oauth_signature_method="HMAC-SHA1", ' +
+                'oauth_timestamp="%s", ' +
+                'oauth_token="%s", ' +
+                'oauth_version="1.0"') % \
             (argmap['oauth_consumer_key'],
              argmap['oauth_nonce'],
              oauth_signature,
              argmap['oauth_timestamp'],
              argmap['oauth_token'])
 
+    def generate_curl_cmdline(self,
+                              command,
+                              verbose,
+                              timeout,
+                              **kwargs):
+        ''' Generate the curl command needed to fetch twitter statuses
+        '''
+        filter_url = self.get_command_url(command)
+        req_args = self.encode_request_args(**kwargs)
+
+        # Set up the request header
+        twheader = 'Authorization: ' + self.generate_auth_header("GET",
+                                                                  filter_url,
+                                                                  req_args)
+
+        # Generate the %-encoded request args
+        twdata = urllib.urlencode(req_args)
+
     # Generate the cURL command line
         verbose_str = "--verbose" if verbose else ""
 
@@ -281,6 +304,46 @@ class DataFetcher(object):
         # subprocess.call(curl_cmdline)
         return status
 
+    def create_stream_client(self, command, stall_timeout=90):
+        ''' Create an in-process client for a command
+        '''
+        return StreamClient(self.get_command_url(command),
+                            authorizer=self.generate_auth_header,
+                            stall_timeout=stall_timeout)
+
+    def iter_stream(self, command, timeout=None, stall_timeout=90, **kwargs):
+        ''' Stream data in-process over one persistent connection,
+        yielding each status line as it arrives
+        '''
+        client = self.create_stream_client(command, stall_timeout)
+        req_args = self.encode_request_args(**kwargs)
+
+        for line in client.stream(req_args, max_time=timeout):
+            yield line
+
+        LOG.info("Received %d statuses, %d bytes",
+                 client.lines_read,
+                 client.bytes_read)
+
+    def get_json(self, command, **kwargs):
+        ''' Run a (non-streaming) command in-process, returning the
+        decoded JSON response and the response headers
+        '''
+        client = self.create_stream_client(command)
+        req_args = self.encode_request_args(**kwargs)
+        (body, headers) = client.fetch(req_args)
+        return (json.loads(body), headers)
+
+    def stream_data(self, stdout, command, timeout=None, **kwargs):
+        ''' Stream data in-process, writing each status line to stdout.
+        Returns the number of statuses received.
+        '''
+        statuses = 0
+        for line in self.iter_stream(command, timeout, **kwargs):
+            stdout.write(line + '\n')
+            statuses += 1
+        return statuses
+
     def fetch_data(self, *args, **kwargs):
         ''' Fetch data using cURL
         '''
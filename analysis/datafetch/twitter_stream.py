@@ -0,0 +1,257 @@
+""" In-process client for the Twitter streaming API.
+
+Keeps one persistent HTTP connection open and splits the (chunked,
+optionally gzipped) response body into status lines as they arrive, so
+the caller sees every status and can react to a stalled connection.
+"""
+import httplib
+import json
+import re
+import socket
+import time
+import urllib
+import urlparse
+import zlib
+import logging
+
+LOG = logging.getLogger(__name__)
+
+# The first "id" key of a status line is the status' own id: the API
+# puts it before the user's, and status_line() puts it first
+RE_TWEET_ID = re.compile(r'"id":\s*(\d+)')
+
+
+def get_tweet_id(line):
+    ''' Get the id of a status line without parsing it, or None
+    '''
+    match = RE_TWEET_ID.search(line)
+    return int(match.group(1)) if match is not None else None
+
+
+def status_line(status):
+    ''' Serialize a decoded status as a compact JSON line, with its own id
+    first (dict order is arbitrary, so json.dumps could put the user's id,
+    or any nested one, before it), for get_tweet_id
+    '''
+    rest = dict(status)
+    if 'id' not in rest:
+        return json.dumps(rest, separators=(',', ':'))
+    head = '{"id":' + json.dumps(rest.pop('id'))
+    if not rest:
+        return head + '}'
+    return head + ',' + json.dumps(rest, separators=(',', ':'))[1:]
+
+
+def tag_line(line, **fields):
+    ''' Add fields to the front of a JSON object line, without parsing
+    (and re-serializing) the rest of it
+    '''
+    if not fields or not line.startswith('{'):
+        return line
+    tags = ','.join(json.dumps(key) + ':' + json.dumps(fields[key])
+                    for key in sorted(fields))
+    rest = line[1:].lstrip()
+    sep = '' if rest.startswith('}') else ','
+    return '{' + tags + sep + rest
+
+
+class StreamError(Exception):
+    ''' Raised when the streaming endpoint refuses or drops the connection
+    '''
+    def __init__(self, message, status=None, body=None):
+        Exception.__init__(self, message)
+        self.status = status
+        self.body = body
+
+
+class StreamClient(object):
+    ''' Persistent, line oriented HTTP client for a streaming endpoint.
+    It can also make one-off requests to the REST API, see fetch().
+
+    authorizer is a callable (req_type, url, req_args) returning the value
+    of the 'Authorization' header, e.g. DataFetcher.generate_auth_header,
+    so every (re)connection is signed afresh with the OAuthSigner.
+    '''
+
+    USER_AGENT = 'northants-twitterd'
+
+    def __init__(self,
+                 url,
+                 authorizer=None,
+                 stall_timeout=90,
+                 compressed=True):
+        self.url = url
+        self.authorizer = authorizer
+        self.stall_timeout = stall_timeout
+        self.compressed = compressed
+
+        self.conn = None
+        self.response = None
+        self.connected_at = None
+        self.last_activity = None
+        self.bytes_read = 0
+        self.lines_read = 0
+        self.keep_alives = 0
+
+    def _make_connection(self):
+        parsed = urlparse.urlparse(self.url)
+        conn_class = httplib.HTTPSConnection if parsed.scheme == 'https' \
+            else httplib.HTTPConnection
+        return conn_class(parsed.netloc, timeout=self.stall_timeout)
+
+    def connect(self, req_args):
+        ''' Open the connection and send the GET request for req_args.
+        Raises StreamError if the server answers with anything but 200
+        '''
+        self.close()
+        headers = {
+            'User-Agent': self.USER_AGENT,
+        }
+        if self.authorizer is not None:
+            headers['Authorization'] = self.authorizer("GET",
+                                                       self.url,
+                                                       req_args)
+        if self.compressed:
+            headers['Accept-Encoding'] = 'deflate, gzip'
+
+        path = urlparse.urlparse(self.url).path
+        if req_args:
+            path += '?' + urllib.urlencode(req_args)
+
+        self.conn = self._make_connection()
+        LOG.info("Connecting to %s", self.url)
+        self.conn.request("GET", path, headers=headers)
+        # buffered, otherwise httplib reads the socket a byte at a time
+        self.response = self.conn.getresponse(buffering=True)
+        self.connected_at = time.time()
+        self.last_activity = self.connected_at
+
+        if self.response.status != 200:
+            body = self.response.read()
+            status = self.response.status
+            reason = self.response.reason
+            self.close()
+            raise StreamError("HTTP %d: %s" % (status, reason),
+                              status=status,
+                              body=body)
+
+    def close(self):
+        ''' Close the connection, if open
+        '''
+        if self.response is not None:
+            try:
+                self.response.close()
+            except:
+                LOG.exception("Error closing stream response")
+            self.response = None
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except:
+                LOG.exception("Error closing stream connection")
+            self.conn = None
+
+    def abort(self):
+        ''' Shut down the socket of an open connection, from any thread,
+        so that a read blocked on it returns straight away
+        '''
+        conn = self.conn
+        sock = conn.sock if conn is not None else None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def _iter_chunks(self):
+        ''' Yield the raw body of the response as it arrives, without
+        waiting for a fixed number of bytes to accumulate
+        '''
+        fp = self.response.fp
+        chunked = self.response.getheader('transfer-encoding', '') \
+            .lower() == 'chunked'
+        while True:
+            if chunked:
+                size_line = fp.readline()
+                if not size_line:
+                    return
+                size = int(size_line.split(';', 1)[0].strip(), 16)
+                if size == 0:
+                    return
+                data = fp.read(size)
+                fp.readline()  # CRLF trailing the chunk
+            else:
+                # Not chunked: the body runs until the server closes
+                data = fp.readline()
+            if not data:
+                return
+            self.bytes_read += len(data)
+            self.last_activity = time.time()
+            yield data
+
+    def _iter_body(self):
+        encoding = self.response.getheader('content-encoding', '').lower()
+        if encoding in ('gzip', 'deflate'):
+            wbits = 16 + zlib.MAX_WBITS if encoding == 'gzip' \
+                else zlib.MAX_WBITS
+            decompressor = zlib.decompressobj(wbits)
+            for data in self._iter_chunks():
+                yield decompressor.decompress(data)
+        else:
+            for data in self._iter_chunks():
+                yield data
+
+    def iter_lines(self, max_time=None):
+        ''' Yield each status line (without the line terminator) as it
+        is received. Keep-alive newlines are counted, but not yielded.
+        Returns when the server closes the stream or after max_time
+        seconds; socket.timeout is raised if the stream stalls.
+        '''
+        pending = ''
+        for data in self._iter_body():
+            lines = (pending + data).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                line = line.rstrip('\r')
+                if line == '':
+                    self.keep_alives += 1
+                    continue
+                self.lines_read += 1
+                yield line
+            if max_time is not None and \
+                    time.time() - self.connected_at >= max_time:
+                LOG.info("Stream reached max time of %d seconds", max_time)
+                return
+        if pending.strip() != '':
+            LOG.warn("Discarding truncated line at end of stream")
+
+    def fetch(self, req_args):
+        ''' Make a single, non-streaming request (e.g. a search). Returns
+        the (decompressed) body, and a dict of the response headers with
+        lower case names
+        '''
+        self.connect(req_args)
+        try:
+            body = self.response.read()
+            headers = dict(self.response.getheaders())
+        finally:
+            self.close()
+        self.bytes_read += len(body)
+        self.last_activity = time.time()
+
+        encoding = headers.get('content-encoding', '').lower()
+        if encoding == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            body = zlib.decompress(body)
+        return (body, headers)
+
+    def stream(self, req_args, max_time=None):
+        ''' Connect, and yield status lines until the stream ends
+        '''
+        self.connect(req_args)
+        try:
+            for line in self.iter_lines(max_time):
+                yield line
+        finally:
+            self.close()
@@ -0,0 +1,289 @@
+""" Bounded queue between the stream readers and the disk writer.
+
+The stream threads only put lines on the queue, and a writer thread
+takes them off in batches, so a slow disk does not stall reading from
+the socket (and the server does not drop us for falling behind). When
+the queue is full, the policy decides what happens to a line:
+    - 'spill': append it to a local spill file, which the writer
+    replays, in order, once the queue is down to its low water mark
+    - 'drop': count it and drop it
+    - 'block': wait for room, pushing back on the reader
+A batch the writer fails to write is spilled too, to be retried (after
+the lines already queued). Spill files left in spill_dir by a writer
+which did not finish (e.g. killed, or unable to write when closed) are
+replayed when the next one starts.
+"""
+import glob
+import os
+import tempfile
+import threading
+import Queue
+import logging
+
+LOG = logging.getLogger(__name__)
+
+SPILL_PREFIX = 'twitterd-spill-'
+SPILL_SUFFIX = '.jsonl'
+
+SPILL = 'spill'
+DROP = 'drop'
+BLOCK = 'block'
+POLICIES = [SPILL, DROP, BLOCK]
+
+
+class QueuedWriter(object):
+    ''' Queues lines for write_many, a callable writing a batch (list) of
+    lines, and calls it from its own thread. put() is safe to call from
+    several threads. Only a given spill_dir is searched for spill files
+    left over, as the system temp directory may be shared.
+    '''
+
+    def __init__(self,
+                 write_many,
+                 maxsize=10000,
+                 batch_size=500,
+                 policy=SPILL,
+                 spill_dir=None,
+                 poll_interval=0.5,
+                 low_water=None):
+        if policy not in POLICIES:
+            raise ValueError("Unknown queue policy: %s" % policy)
+        self.write_many = write_many
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.policy = policy
+        self.spill_dir = spill_dir
+        self.poll_interval = poll_interval
+        self.low_water = low_water if low_water is not None \
+            else max(1, maxsize // 4)
+        self.queue = Queue.Queue(maxsize)
+
+        self.max_depth = 0
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.spill_depth = 0
+        self.write_errors = 0
+
+        self._spill_lock = threading.Lock()
+        self._spill_file = None
+        self._spill_path = None
+        self._closed = threading.Event()
+        self._thread = None
+        # Found before this writer spills any of its own
+        self._leftovers = self._find_leftovers()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def depth(self):
+        ''' Number of lines waiting in the queue
+        '''
+        return self.queue.qsize()
+
+    def put(self, line):
+        ''' Queue a line for writing, applying the policy if the queue is
+        full. Returns False if the line was dropped, True otherwise
+        '''
+        accepted = True
+        if self.policy == BLOCK:
+            self.queue.put(line)
+        elif self.policy == DROP:
+            try:
+                self.queue.put_nowait(line)
+            except Queue.Full:
+                with self._spill_lock:
+                    self.dropped += 1
+                accepted = False
+        else:
+            with self._spill_lock:
+                # Once spilling, keep spilling until the writer takes the
+                # spill file, so lines are written in the order received
+                if self._spill_file is None:
+                    try:
+                        self.queue.put_nowait(line)
+                        line = None
+                    except Queue.Full:
+                        self._open_spill()
+                if line is not None:
+                    self._spill_file.write(line + '\n')
+                    self.spilled += 1
+                    self.spill_depth += 1
+        depth = self.queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+        return accepted
+
+    def _open_spill(self):
+        (handle, self._spill_path) = tempfile.mkstemp(
+            prefix=SPILL_PREFIX, suffix=SPILL_SUFFIX, dir=self.spill_dir)
+        self._spill_file = os.fdopen(handle, "w")
+        LOG.warn("Write queue full, spilling to %s", self._spill_path)
+
+    def _take_spill(self):
+        ''' Close the spill file (if any) to new lines. Returns its path,
+        and the number of lines queued before it was opened (as the spill
+        policy queues none while it is open), or None
+        '''
+        with self._spill_lock:
+            if self._spill_file is None:
+                return None
+            self._spill_file.close()
+            path = self._spill_path
+            (self._spill_file, self._spill_path) = (None, None)
+            return (path, self.queue.qsize())
+
+    def _respill(self, batch):
+        ''' Spill the lines of a batch which could not be written
+        '''
+        with self._spill_lock:
+            if self._spill_file is None:
+                self._open_spill()
+            self._spill_file.write('\n'.join(batch) + '\n')
+            self._spill_file.flush()
+            self.spill_depth += len(batch)
+
+    def _write_batch(self, batch):
+        ''' Write a batch of lines, or else spill them to be retried
+        '''
+        self.batches += 1
+        try:
+            self.write_many(batch)
+        except Exception:
+            LOG.exception("Unable to write %d lines, spilling them",
+                          len(batch))
+            self.write_errors += 1
+            self._respill(batch)
+            return
+        self.written += len(batch)
+
+    def _write_spilled(self, batch):
+        with self._spill_lock:
+            self.spill_depth -= len(batch)
+        self._write_batch(batch)
+
+    def _replay_spill(self, path):
+        LOG.info("Replaying spill file %s", path)
+        with open(path, "r") as spill_file:
+            batch = []
+            for line in spill_file:
+                batch.append(line.rstrip('\n'))
+                if len(batch) >= self.batch_size:
+                    self._write_spilled(batch)
+                    batch = []
+            if batch:
+                self._write_spilled(batch)
+        os.remove(path)
+
+    def _write_queued(self, count):
+        ''' Write the next count lines of the queue
+        '''
+        while count > 0:
+            batch = []
+            try:
+                while len(batch) < min(count, self.batch_size):
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            if not batch:
+                return
+            self._write_batch(batch)
+            count -= len(batch)
+
+    def _find_leftovers(self):
+        ''' Get the spill files left in spill_dir, oldest first
+        '''
+        if self.spill_dir is None:
+            return []
+        paths = glob.glob(os.path.join(self.spill_dir,
+                                       SPILL_PREFIX + '*' + SPILL_SUFFIX))
+        return sorted(paths, key=os.path.getmtime)
+
+    def _replay_leftovers(self):
+        while self._leftovers:
+            path = self._leftovers.pop(0)
+            with open(path, "r") as spill_file:
+                lines = sum(1 for _ in spill_file)
+            with self._spill_lock:
+                self.spill_depth += lines
+            self._replay_spill(path)
+
+    def _abandon(self):
+        ''' Spill everything still queued, and leave the spill file for
+        the next writer to replay
+        '''
+        batch = []
+        try:
+            while True:
+                batch.append(self.queue.get_nowait())
+        except Queue.Empty:
+            pass
+        if batch:
+            self._respill(batch)
+        taken = self._take_spill()
+        if taken is not None:
+            LOG.error("Unable to write, leaving %d lines in %s",
+                      self.spill_depth, taken[0])
+
+    def _next_batch(self):
+        try:
+            batch = [self.queue.get(timeout=self.poll_interval)]
+        except Queue.Empty:
+            return []
+        try:
+            while len(batch) < self.batch_size:
+                batch.append(self.queue.get_nowait())
+        except Queue.Empty:
+            pass
+        return batch
+
+    def run(self):
+        ''' Write queued lines until closed and drained, catching up with
+        the spilled lines whenever the queue is down to its low water mark
+        '''
+        self._replay_leftovers()
+        while True:
+            errors = self.write_errors
+            taken = self._take_spill() \
+                if self.queue.qsize() < self.low_water else None
+            if taken is not None:
+                # The lines queued before the spill file go first
+                (spill_path, queued) = taken
+                self._write_queued(queued)
+                self._replay_spill(spill_path)
+            else:
+                batch = self._next_batch()
+                if batch:
+                    self._write_batch(batch)
+                elif self._closed.is_set() and self.queue.empty() and \
+                        self._spill_file is None:
+                    break
+            if self.write_errors > errors:
+                if self._closed.is_set():
+                    self._abandon()
+                    break
+                # Give the disk a moment before retrying
+                self._closed.wait(self.poll_interval)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name='writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        ''' Write out everything queued or spilled, and stop the writer
+        '''
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        LOG.info("Write queue closed: written=%d, batches=%d, max_depth=%d, "
+                 "spilled=%d, dropped=%d, write_errors=%d",
+                 self.written, self.batches, self.max_depth,
+                 self.spilled, self.dropped, self.write_errors)
@@ -0,0 +1,402 @@
+""" De-duplication index of seen tweet ids.
+
+The same tweet shows up more than once when stream and search output are
+combined, or when daemon runs overlap. SeenIndex remembers every id it has
+been given: the ids live in a few sorted uint64 runs (memory-mapped from
+.npy files when persistent), recent additions in a small set, and an
+in-memory Bloom filter in front answers "never seen" - the common case -
+without touching them.
+
+Deduplicator puts a SeenIndex in front of a stream of status lines (as
+the daemon writes them), dropping the lines of statuses already seen.
+"""
+import glob
+import os
+import re
+import threading
+import numpy as np
+import logging
+
+from analysis.datafetch.twitter_stream import get_tweet_id
+
+LOG = logging.getLogger(__name__)
+
+_MASK64 = (1 << 64) - 1
+
+RE_RUN_PATH = re.compile(r'\.run(\d+)\.npy$')
+
+
+def _mix(tid):
+    ''' splitmix64 finalizer, for a python int (snowflake ids keep most of
+    their entropy in a few bits, so they need mixing before hashing)
+    '''
+    tid = (tid ^ (tid >> 30)) * 0xbf58476d1ce4e5b9 & _MASK64
+    tid = (tid ^ (tid >> 27)) * 0x94d049bb133111eb & _MASK64
+    return tid ^ (tid >> 31)
+
+
+def _mix_array(tids):
+    ''' splitmix64 finalizer, for a uint64 array
+    '''
+    tids = np.asarray(tids, dtype=np.uint64)
+    tids = (tids ^ (tids >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    tids = (tids ^ (tids >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return tids ^ (tids >> np.uint64(31))
+
+
+class BloomFilter(object):
+    ''' Bloom filter over integer ids, sized for capacity ids at the given
+    false positive rate
+    '''
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = error_rate
+        self.num_bits = int(-self.capacity * np.log(error_rate) /
+                            (np.log(2) ** 2)) + 1
+        self.num_hashes = max(1, int(round(self.num_bits / float(self.capacity) *
+                                           np.log(2))))
+        self.bits = np.zeros(self.num_bits // 8 + 1, dtype=np.uint8)
+        self.count = 0
+
+    def _positions(self, tid):
+        hashed = _mix(tid)
+        (h1, h2) = (hashed & 0xffffffff, (hashed >> 32) | 1)
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def _positions_array(self, tids):
+        hashed = _mix_array(tids)
+        h1 = hashed & np.uint64(0xffffffff)
+        h2 = (hashed >> np.uint64(32)) | np.uint64(1)
+        hashes = np.arange(self.num_hashes, dtype=np.uint64)
+        return (h1[:, None] + hashes[None, :] * h2[:, None]) % \
+            np.uint64(self.num_bits)
+
+    def add(self, tid):
+        for pos in self._positions(tid):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, tid):
+        bits = self.bits
+        for pos in self._positions(tid):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def add_many(self, tids):
+        positions = self._positions_array(tids).ravel()
+        np.bitwise_or.at(self.bits,
+                         (positions >> np.uint64(3)).astype(np.intp),
+                         (np.uint8(1) << (positions & np.uint64(7))
+                          .astype(np.uint8)))
+        self.count += len(tids)
+
+    def contains_many(self, tids):
+        ''' Get a bool array, True where the id may have been added
+        '''
+        positions = self._positions_array(tids)
+        bytes_ = self.bits[(positions >> np.uint64(3)).astype(np.intp)]
+        masks = np.uint8(1) << (positions & np.uint64(7)).astype(np.uint8)
+        return np.all(bytes_ & masks, axis=1)
+
+
+class SeenIndex(object):
+    ''' Index of seen tweet ids, optionally persisted to path (a .npy file
+    of sorted ids, alongside its newer runs).
+
+    add() and check() are O(1) expected for unseen ids, which the Bloom
+    filter answers alone; resident memory is the Bloom filter plus up to
+    merge_threshold recent ids, as the sorted ids are memory-mapped.
+
+    The recent ids are written out as a new sorted run, and the newest
+    runs merged while a run is less than twice the size of the one after
+    it, so the runs shrink geometrically: there are O(log n) of them to
+    search, and each id is rewritten O(log n) times in all, rather than
+    on every merge. With merge_threshold None, the recent ids are only
+    written out by merge() or save(), so the files change only then.
+    '''
+
+    MERGE_CHUNK = 1 << 20
+
+    def __init__(self,
+                 path=None,
+                 capacity=10000000,
+                 error_rate=0.01,
+                 merge_threshold=100000):
+        if path is not None and not path.endswith('.npy'):
+            path += '.npy'
+        self.path = path
+        self.error_rate = error_rate
+        self.merge_threshold = merge_threshold
+        self.pending = set()
+
+        # Sorted runs of ids, oldest (and largest) first, and their files:
+        # the first is path, the others numbered in the order written
+        self.runs = []
+        self.run_paths = []
+        self.next_run = 1
+        # Files of runs dropped by clear(), removed by the next merge
+        self._stale_paths = []
+        if path is not None:
+            self._load_runs()
+
+        self.bloom = None
+        self._build_bloom(max(capacity, 2 * self.merged_count()))
+
+    def _run_path(self, number):
+        return '%s.run%06d.npy' % (self.path[:-len('.npy')], number)
+
+    def _load_runs(self):
+        if not os.path.exists(self.path):
+            return
+        numbers = []
+        for run_path in glob.glob(self.path[:-len('.npy')] + '.run*.npy'):
+            match = RE_RUN_PATH.search(run_path)
+            if match is not None:
+                numbers.append(int(match.group(1)))
+        for run_path in [self.path] + [self._run_path(number)
+                                       for number in sorted(numbers)]:
+            self.runs.append(np.load(run_path, mmap_mode='r'))
+            self.run_paths.append(run_path)
+        self.next_run = max(numbers) + 1 if numbers else 1
+
+    def merged_count(self):
+        return sum(len(run) for run in self.runs)
+
+    def __len__(self):
+        return self.merged_count() + len(self.pending)
+
+    @property
+    def ids(self):
+        ''' All the merged ids, sorted (read into memory)
+        '''
+        if not self.runs:
+            return np.zeros(0, dtype=np.uint64)
+        return np.sort(np.concatenate(self.runs))
+
+    def _build_bloom(self, capacity):
+        LOG.info("Building Bloom filter for %d ids", capacity)
+        self.bloom = BloomFilter(capacity, self.error_rate)
+        for run in self.runs:
+            for start in range(0, len(run), self.MERGE_CHUNK):
+                self.bloom.add_many(run[start:start + self.MERGE_CHUNK])
+        for tid in self.pending:
+            self.bloom.add(tid)
+
+    def _in_runs(self, tid):
+        tid = np.uint64(tid)
+        for run in self.runs:
+            pos = np.searchsorted(run, tid)
+            if pos < len(run) and run[pos] == tid:
+                return True
+        return False
+
+    def check(self, tid):
+        ''' True if tid has been seen
+        '''
+        tid = int(tid)
+        if tid not in self.bloom:
+            return False
+        return tid in self.pending or self._in_runs(tid)
+
+    __contains__ = check
+
+    def add(self, tid):
+        ''' Record tid as seen. Returns True if it had not been seen before
+        '''
+        tid = int(tid)
+        if self.check(tid):
+            return False
+        self.bloom.add(tid)
+        self.pending.add(tid)
+        if self.merge_threshold is not None and \
+                len(self.pending) >= self.merge_threshold:
+            self.merge()
+        return True
+
+    def add_many(self, tids):
+        ''' Record an array of ids as seen. Returns a bool array, True for
+        each id that had not been seen before (including earlier in tids)
+        '''
+        tids = np.asarray(tids, dtype=np.uint64)
+        is_new = np.ones(len(tids), dtype=bool)
+        if len(tids) == 0:
+            return is_new
+
+        maybe_seen = self.bloom.contains_many(tids)
+        for i in np.flatnonzero(maybe_seen):
+            tid = int(tids[i])
+            if tid in self.pending:
+                is_new[i] = False
+        for run in self.runs:
+            candidates = np.flatnonzero(maybe_seen & is_new)
+            if not len(candidates) or not len(run):
+                continue
+            pos = np.searchsorted(run, tids[candidates])
+            pos = np.minimum(pos, len(run) - 1)
+            is_new[candidates[run[pos] == tids[candidates]]] = False
+
+        # Only the first copy of an id within tids is new
+        (_, first) = np.unique(tids, return_index=True)
+        first_mask = np.zeros(len(tids), dtype=bool)
+        first_mask[first] = True
+        is_new &= first_mask
+
+        new_ids = tids[is_new]
+        self.bloom.add_many(new_ids)
+        self.pending.update(int(tid) for tid in new_ids)
+        if self.merge_threshold is not None and \
+                len(self.pending) >= self.merge_threshold:
+            self.merge()
+        return is_new
+
+    def _new_run(self, size, path):
+        ''' Make an array for a run: a memory-mapped .npy file at a
+        temporary path next to path, if the index is persistent
+        '''
+        if path is None:
+            return (np.empty(size, dtype=np.uint64), None)
+        tmp_path = path[:-len('.npy')] + '.tmp.npy'
+        return (np.lib.format.open_memmap(tmp_path, mode='w+',
+                                          dtype=np.uint64, shape=(size,)),
+                tmp_path)
+
+    def _finish_run(self, run, tmp_path, path):
+        ''' Move a run made by _new_run into place. Returns the run
+        '''
+        if path is None:
+            return run
+        run.flush()
+        del run
+        os.rename(tmp_path, path)
+        return np.load(path, mmap_mode='r')
+
+    def _merge_last_runs(self):
+        ''' Merge the two newest runs into one, in bounded memory
+        '''
+        (older, newer) = self.runs[-2:]
+        (older_path, newer_path) = self.run_paths[-2:]
+        (merged, tmp_path) = self._new_run(len(older) + len(newer),
+                                           older_path)
+
+        # Each id goes after the ids of the other run smaller than it (and
+        # those of the older run equal to it)
+        for start in range(0, len(newer), self.MERGE_CHUNK):
+            chunk = newer[start:start + self.MERGE_CHUNK]
+            merged[np.arange(start, start + len(chunk)) +
+                   np.searchsorted(older, chunk, side='right')] = chunk
+        for start in range(0, len(older), self.MERGE_CHUNK):
+            chunk = older[start:start + self.MERGE_CHUNK]
+            merged[np.arange(start, start + len(chunk)) +
+                   np.searchsorted(newer, chunk, side='left')] = chunk
+
+        del self.runs[-2:]
+        del self.run_paths[-2:]
+        self.runs.append(self._finish_run(merged, tmp_path, older_path))
+        self.run_paths.append(older_path)
+        if newer_path is not None:
+            os.remove(newer_path)
+
+    def merge(self):
+        ''' Write the recent ids out as a new sorted run (to a file of its
+        own, if the index is persistent), and merge the newest runs while
+        each run is at least twice the size of the next
+        '''
+        if not self.pending:
+            return
+        new = np.array(sorted(self.pending), dtype=np.uint64)
+        path = self.path
+        if path is not None and self.runs:
+            path = self._run_path(self.next_run)
+            self.next_run += 1
+        (run, tmp_path) = self._new_run(len(new), path)
+        run[:] = new
+        self.runs.append(self._finish_run(run, tmp_path, path))
+        self.run_paths.append(path)
+        self.pending = set()
+
+        while len(self.runs) > 1 and \
+                len(self.runs[-2]) < 2 * len(self.runs[-1]):
+            self._merge_last_runs()
+
+        if self.merged_count() > self.bloom.capacity:
+            self._build_bloom(2 * self.merged_count())
+        self._remove_stale()
+
+    def _remove_stale(self):
+        for stale_path in self._stale_paths:
+            if stale_path not in self.run_paths and \
+                    os.path.exists(stale_path):
+                os.remove(stale_path)
+        self._stale_paths = []
+
+    def clear(self):
+        ''' Forget every id. The files of a persistent index are replaced
+        by the next merge() or save(), not straight away
+        '''
+        self._stale_paths.extend(path for path in self.run_paths
+                                 if path is not None)
+        self.runs = []
+        self.run_paths = []
+        self.pending = set()
+        self._build_bloom(self.bloom.capacity)
+
+    def save(self):
+        ''' Persist the index
+        '''
+        if self.path is None:
+            return
+        self.merge()
+        if not self.runs:
+            (run, tmp_path) = self._new_run(0, self.path)
+            self.runs.append(self._finish_run(run, tmp_path, self.path))
+            self.run_paths.append(self.path)
+            self._remove_stale()
+
+
+class Deduplicator(object):
+    ''' Tells the status lines to keep from those already in a SeenIndex,
+    counting the duplicates. Thread safe
+    '''
+
+    def __init__(self, seen_index):
+        self.seen_index = seen_index
+        self.duplicates = 0
+        self._lock = threading.Lock()
+
+    def is_new(self, line, tweet_id=None):
+        ''' Record the status of a line (whose id is tweet_id, or read from
+        the line) as seen. Returns False if it had been seen before. Lines
+        without an id (e.g. limit notices) are always new
+        '''
+        if tweet_id is None:
+            tweet_id = get_tweet_id(line)
+        if tweet_id is None:
+            return True
+        with self._lock:
+            is_new = self.seen_index.add(tweet_id)
+            if not is_new:
+                self.duplicates += 1
+        return is_new
+
+    def write_new(self, line, write, tweet_id=None):
+        ''' Write a line, with write, unless its status (whose id is
+        tweet_id, or read from the line) has been seen. The status is only
+        recorded as seen once write accepts the line, i.e. does not return
+        False (as QueuedWriter.put does for a line it drops), so a line
+        lost on the way does not keep its status out for good. Returns the
+        result of write, or False for a duplicate
+        '''
+        if tweet_id is None:
+            tweet_id = get_tweet_id(line)
+        if tweet_id is None:
+            return write(line)
+        with self._lock:
+            if tweet_id in self.seen_index:
+                self.duplicates += 1
+                return False
+            accepted = write(line)
+            if accepted is not False:
+                self.seen_index.add(tweet_id)
+        return accepted
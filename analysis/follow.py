@@ -0,0 +1,312 @@
+""" Incremental processing of a results file as it grows, like tail -f.
+
+A Follower parses the complete lines appended to a results file (e.g.
+the twitter_data.json the daemon is writing) since it last looked, and
+hands the new rows, as a DataFrame, to each of its aggregators. A line
+still being written is left for the next poll. Given the output
+directory of a SegmentWriter instead, it follows its manifest, and
+processes each segment as it is closed: the segment being written is not
+read, so following segments is not near-real-time, but lags by up to the
+writer's rotation interval (an hour by default, see --segment-time).
+
+Its position (byte offset, or segments done) and the state of its
+aggregators are saved together in a state file after every poll (or
+segment), so after a restart it carries on from where it stopped,
+without reading the file from the start again. If the file or manifest
+has been truncated or replaced, it starts again from the beginning
+(resetting the aggregators).
+
+A persistent seen index is saved with the state: the state file holds
+the ids added since the index was last saved, and the index is saved
+after it, so that a restart never finds the index ahead of the state
+(dropping the statuses it reads again as duplicates). Starting again
+from the beginning clears the index too.
+"""
+import collections
+import json
+import os
+import threading
+import numpy as np
+import logging
+
+from analysis.datafetch.segments import read_manifest, open_segment, \
+    MANIFEST_NAME
+from analysis.twitter_processor import Processor, RangeReader, \
+    typed_frame, DEFAULT_CHUNK_SIZE
+from analysis.table_cache import last_line_end, fingerprint
+
+LOG = logging.getLogger(__name__)
+
+STATE_SUFFIX = '.follow'
+
+
+class StatusCounts(object):
+    ''' Incremental counts of statuses: in total, geotagged, per user and
+    per hour of creation (as 'YYYY-MM-DDTHH')
+
+    An aggregator has an update(dataframe) method, taking each chunk of new
+    rows, and get_state() and set_state(state) methods, which save and
+    restore its state as something JSON can encode
+    '''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.statuses = 0
+        self.geotagged = 0
+        self.users = collections.Counter()
+        self.hours = collections.Counter()
+
+    def update(self, dataframe):
+        self.statuses += len(dataframe)
+        self.geotagged += int(dataframe["latitude"].notnull().sum())
+        counts = dataframe["user"].value_counts()
+        self.users.update(dict((user, int(count))
+                               for (user, count) in counts.iteritems()
+                               if count))
+        hours = dataframe["created_at"].dropna().values.astype(
+            "datetime64[h]")
+        (names, inverse) = np.unique(hours, return_inverse=True)
+        counts = np.bincount(inverse, minlength=len(names))
+        self.hours.update(dict((str(hour)[:13], int(count))
+                               for (hour, count) in zip(names, counts)))
+
+    def get_state(self):
+        return {
+            "statuses": self.statuses,
+            "geotagged": self.geotagged,
+            "users": dict(self.users),
+            "hours": dict(self.hours),
+        }
+
+    def set_state(self, state):
+        self.statuses = state["statuses"]
+        self.geotagged = state["geotagged"]
+        self.users = collections.Counter(state["users"])
+        self.hours = collections.Counter(state["hours"])
+
+
+class Follower(object):
+    ''' Follows a growing results file, or the segments of an output
+    directory, feeding the rows of the complete lines added to it to the
+    registered aggregators. The position and the aggregators' states are
+    saved in state_path (by default, beside the results file or the
+    manifest).
+
+    Segments are only read once closed, so their rows arrive up to a
+    rotation interval late. A seen_index with a path is saved with the
+    state, and must have a merge_threshold of None, so that its files only
+    change then.
+    '''
+
+    def __init__(self,
+                 path,
+                 state_path=None,
+                 processor=None,
+                 poll_interval=1.0,
+                 chunk_size=DEFAULT_CHUNK_SIZE,
+                 seen_index=None):
+        self.path = path
+        self.segmented = os.path.isdir(path)
+        if state_path is None:
+            state_path = os.path.join(path, MANIFEST_NAME) + STATE_SUFFIX \
+                if self.segmented else path + STATE_SUFFIX
+        self.state_path = state_path
+        self.processor = processor if processor is not None else Processor()
+        self.poll_interval = poll_interval
+        self.chunk_size = chunk_size
+        if seen_index is not None and seen_index.path is not None and \
+                seen_index.merge_threshold is not None:
+            raise ValueError("A followed seen index must only be merged "
+                             "when saved (merge_threshold=None)")
+        self.seen_index = seen_index
+        self.aggregators = collections.OrderedDict()
+
+        self.offset = 0
+        self.fingerprint = None
+        self.segments = 0
+        self.segment = None
+        self.lines_read = 0
+        self.errors = 0
+        self.rows = 0
+        self._saved_states = {}
+        self._stop_event = threading.Event()
+        self.load_state()
+
+    def register(self, name, aggregator):
+        ''' Add an aggregator, restoring its saved state, if any
+        '''
+        self.aggregators[name] = aggregator
+        if name in self._saved_states:
+            aggregator.set_state(self._saved_states.pop(name))
+        return aggregator
+
+    def file_changed(self, offset, file_fingerprint):
+        ''' True if the file is no longer the one followed up to offset
+        '''
+        size = os.path.getsize(self.path) if os.path.exists(self.path) \
+            else 0
+        return offset > size or (
+            offset and fingerprint(self.path, offset) != file_fingerprint)
+
+    def manifest_changed(self, entries, segments, segment):
+        ''' True if the manifest no longer starts with the segments done
+        '''
+        return segments > len(entries) or (
+            segments and entries[segments - 1]["segment"] != segment)
+
+    def load_state(self):
+        if not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path, "r") as state_file:
+                state = json.load(state_file)
+        except ValueError:
+            LOG.warn("Ignoring bad follow state %s", self.state_path)
+            return
+        if self.seen_index is not None and state.get("seen_pending"):
+            # Ids the index may not have been saved with
+            self.seen_index.add_many(state["seen_pending"])
+        if self.segmented:
+            changed = self.manifest_changed(read_manifest(self.path),
+                                            state.get("segments", 0),
+                                            state.get("segment"))
+        else:
+            changed = self.file_changed(state["offset"],
+                                        state["fingerprint"])
+        if changed:
+            LOG.warn("%s has changed since it was followed, starting again",
+                     self.path)
+            if self.seen_index is not None:
+                self.seen_index.clear()
+            return
+        self.offset = state["offset"]
+        self.fingerprint = state["fingerprint"]
+        self.segments = state.get("segments", 0)
+        self.segment = state.get("segment")
+        self.lines_read = state["lines_read"]
+        self.errors = state["errors"]
+        self.rows = state["rows"]
+        self._saved_states = state["aggregators"]
+
+    def save_state(self):
+        ''' Save the state, atomically replacing the file, then the seen
+        index (if persistent)
+        '''
+        seen_index = self.seen_index
+        persistent = seen_index is not None and seen_index.path is not None
+        state = {
+            "path": os.path.abspath(self.path),
+            "offset": self.offset,
+            "fingerprint": self.fingerprint,
+            "segments": self.segments,
+            "segment": self.segment,
+            "lines_read": self.lines_read,
+            "errors": self.errors,
+            "rows": self.rows,
+            "aggregators": dict((name, aggregator.get_state())
+                                for (name, aggregator)
+                                in self.aggregators.items()),
+            "seen_pending": sorted(seen_index.pending) if persistent
+            else None,
+        }
+        with open(self.state_path + '.tmp', "w") as state_file:
+            json.dump(state, state_file, sort_keys=True)
+            state_file.flush()
+            os.fsync(state_file.fileno())
+        os.rename(self.state_path + '.tmp', self.state_path)
+        if persistent:
+            seen_index.save()
+
+    def restart(self):
+        ''' Start again from the beginning of the file or manifest, with
+        an empty seen index, as the statuses read again are not duplicates
+        '''
+        (self.offset, self.lines_read, self.errors, self.rows) = (0, 0, 0, 0)
+        self.fingerprint = None
+        (self.segments, self.segment) = (0, None)
+        for aggregator in self.aggregators.values():
+            aggregator.reset()
+        if self.seen_index is not None:
+            self.seen_index.clear()
+
+    def process(self, reader):
+        ''' Feed the statuses read from reader to the aggregators. Returns
+        the number of rows
+        '''
+        rows = 0
+        processor = self.processor
+        for columns in processor.iter_column_chunks(
+                reader, None, self.chunk_size, self.seen_index):
+            if len(columns["id"]) == 0:
+                continue
+            dataframe = typed_frame(columns)
+            for aggregator in self.aggregators.values():
+                aggregator.update(dataframe)
+            rows += len(dataframe)
+        self.lines_read += processor.lines_read
+        self.errors += processor.errors
+        self.rows += rows
+        return rows
+
+    def poll(self):
+        ''' Process the complete lines added since the last poll (or the
+        segments closed since). Returns the number of new rows
+        '''
+        if self.segmented:
+            return self.poll_segments()
+        if not os.path.exists(self.path):
+            return 0
+        size = os.path.getsize(self.path)
+        if self.file_changed(self.offset, self.fingerprint):
+            LOG.warn("%s has been replaced, starting again", self.path)
+            self.restart()
+        end = last_line_end(self.path, self.offset, size)
+        if end == self.offset:
+            return 0
+
+        with open(self.path, "r") as results_file:
+            results_file.seek(self.offset)
+            rows = self.process(RangeReader(results_file, end))
+        self.offset = end
+        self.fingerprint = fingerprint(self.path, end)
+        self.save_state()
+        return rows
+
+    def poll_segments(self):
+        ''' Process the segments added to the manifest since the last poll,
+        saving the state after each. Returns the number of new rows
+        '''
+        entries = read_manifest(self.path)
+        if self.manifest_changed(entries, self.segments, self.segment):
+            LOG.warn("The manifest of %s has been replaced, starting again",
+                     self.path)
+            self.restart()
+        rows = 0
+        for entry in entries[self.segments:]:
+            segment_file = open_segment(os.path.join(self.path,
+                                                     entry["segment"]))
+            try:
+                rows += self.process(segment_file)
+            finally:
+                segment_file.close()
+            self.segments += 1
+            self.segment = entry["segment"]
+            self.save_state()
+            if self._stop_event.is_set():
+                break
+        return rows
+
+    def follow(self):
+        ''' Poll the file until stopped
+        '''
+        while not self._stop_event.is_set():
+            try:
+                self.poll()
+            except Exception:
+                LOG.exception("Unable to process %s", self.path)
+            self._stop_event.wait(self.poll_interval)
+
+    def stop(self):
+        self._stop_event.set()
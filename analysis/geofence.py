@@ -0,0 +1,351 @@
+""" Point-in-polygon tests against boundary polygons, e.g. the county's.
+
+A polygon (any number of rings: outer boundaries, holes and islands,
+combined with the even-odd rule) is held as flat NumPy edge arrays, plus
+a grid over its bounding box. Grid cells that no edge passes through are
+wholly inside or outside, so most points are settled by one lookup; the
+rest are ray-cast against only the edges in their row of the grid.
+
+Boundaries are tested in WGS84 longitude/latitude, the same as tweets.
+Shapefiles in the British National Grid (as the ONS boundaries are, per
+their .prj file) are reprojected when read; any other projection is
+refused rather than silently testing points against the wrong numbers.
+"""
+import os
+import numpy as np
+import logging
+
+try:
+    import shapefile
+except ImportError:
+    shapefile = None
+
+LOG = logging.getLogger(__name__)
+
+OUTSIDE = 0
+INSIDE = 1
+BOUNDARY = 2
+
+# Airy 1830 ellipsoid and the National Grid's transverse Mercator
+AIRY_A = 6377563.396
+AIRY_B = 6356256.909
+NG_F0 = 0.9996012717
+NG_LAT0 = np.radians(49.0)
+NG_LON0 = np.radians(-2.0)
+NG_E0 = 400000.0
+NG_N0 = -100000.0
+
+# GRS80/WGS84 ellipsoid, and the Helmert transformation from OSGB36 to
+# WGS84 (translation in metres, scale in ppm, rotations in arc seconds)
+WGS84_A = 6378137.0
+WGS84_B = 6356752.3141
+OSGB36_TO_WGS84 = (446.448, -125.157, 542.060, -20.4894,
+                   0.1502, 0.2470, 0.8421)
+
+
+def shape_rings(shape):
+    ''' Split a pyshp shape into its rings, as (N, 2) x/y arrays
+    '''
+    points = np.asarray(shape.points, dtype=np.float64)
+    starts = list(shape.parts) + [len(points)]
+    return [points[starts[i]:starts[i + 1]] for i in range(len(starts) - 1)]
+
+
+def osgb_to_lon_lat(eastings, northings):
+    ''' Convert British National Grid eastings/northings to WGS84 lon/lat
+    arrays (to within a few metres, by a Helmert transformation)
+    '''
+    eastings = np.asarray(eastings, dtype=np.float64)
+    northings = np.asarray(northings, dtype=np.float64)
+    (a, b, f0) = (AIRY_A, AIRY_B, NG_F0)
+    e2 = 1 - (b * b) / (a * a)
+    n = (a - b) / (a + b)
+
+    def meridional_arc(lat):
+        (d, s) = (lat - NG_LAT0, lat + NG_LAT0)
+        return b * f0 * (
+            (1 + n + 1.25 * n ** 2 + 1.25 * n ** 3) * d -
+            (3 * n + 3 * n ** 2 + 2.625 * n ** 3) * np.sin(d) * np.cos(s) +
+            (1.875 * n ** 2 + 1.875 * n ** 3) *
+            np.sin(2 * d) * np.cos(2 * s) -
+            35 / 24.0 * n ** 3 * np.sin(3 * d) * np.cos(3 * s))
+
+    # Latitude of the foot of the meridian through each point
+    lat = (northings - NG_N0) / (a * f0) + NG_LAT0
+    for _ in range(20):
+        error = northings - NG_N0 - meridional_arc(lat)
+        if np.all(np.abs(error) < 1e-5):
+            break
+        lat = lat + error / (a * f0)
+
+    sin_lat = np.sin(lat)
+    nu = a * f0 / np.sqrt(1 - e2 * sin_lat ** 2)
+    rho = a * f0 * (1 - e2) / (1 - e2 * sin_lat ** 2) ** 1.5
+    eta2 = nu / rho - 1
+    (tan, sec) = (np.tan(lat), 1 / np.cos(lat))
+    de = eastings - NG_E0
+    lat = (lat -
+           tan / (2 * rho * nu) * de ** 2 +
+           tan / (24 * rho * nu ** 3) *
+           (5 + 3 * tan ** 2 + eta2 - 9 * tan ** 2 * eta2) * de ** 4 -
+           tan / (720 * rho * nu ** 5) *
+           (61 + 90 * tan ** 2 + 45 * tan ** 4) * de ** 6)
+    lon = (NG_LON0 +
+           sec / nu * de -
+           sec / (6 * nu ** 3) * (nu / rho + 2 * tan ** 2) * de ** 3 +
+           sec / (120 * nu ** 5) *
+           (5 + 28 * tan ** 2 + 24 * tan ** 4) * de ** 5 -
+           sec / (5040 * nu ** 7) *
+           (61 + 662 * tan ** 2 + 1320 * tan ** 4 + 720 * tan ** 6) *
+           de ** 7)
+
+    # OSGB36 to WGS84, through cartesian coordinates
+    nu = a / np.sqrt(1 - e2 * np.sin(lat) ** 2)
+    x = nu * np.cos(lat) * np.cos(lon)
+    y = nu * np.cos(lat) * np.sin(lon)
+    z = (1 - e2) * nu * np.sin(lat)
+    (tx, ty, tz, scale, rx, ry, rz) = OSGB36_TO_WGS84
+    scale = 1 + scale * 1e-6
+    (rx, ry, rz) = np.radians(np.array([rx, ry, rz]) / 3600.0)
+    (x, y, z) = (tx + scale * (x - rz * y + ry * z),
+                 ty + scale * (rz * x + y - rx * z),
+                 tz + scale * (-ry * x + rx * y + z))
+
+    e2 = 1 - (WGS84_B * WGS84_B) / (WGS84_A * WGS84_A)
+    p = np.sqrt(x * x + y * y)
+    lat = np.arctan2(z, p * (1 - e2))
+    for _ in range(10):
+        nu = WGS84_A / np.sqrt(1 - e2 * np.sin(lat) ** 2)
+        lat = np.arctan2(z + e2 * nu * np.sin(lat), p)
+    return (np.degrees(np.arctan2(y, x)), np.degrees(lat))
+
+
+def lon_lat_rings(rings, projection=None, source='rings'):
+    ''' Get rings in WGS84 lon/lat, given the WKT of their projection
+    (from a .prj file) if known: British National Grid rings are
+    reprojected, and geographic ones kept. Raises ValueError for any other
+    projection, or for coordinates that are not valid lon/lat
+    '''
+    rings = [np.asarray(ring, dtype=np.float64) for ring in rings]
+    if projection is not None and projection.lstrip().startswith('PROJCS'):
+        if 'British_National_Grid' not in projection and \
+                'OSGB' not in projection:
+            raise ValueError("%s are projected (%s), and only the British "
+                             "National Grid can be reprojected" %
+                             (source, projection[:60]))
+        return [np.column_stack(osgb_to_lon_lat(ring[:, 0], ring[:, 1]))
+                for ring in rings]
+    for ring in rings:
+        if len(ring) and (np.abs(ring[:, 0]).max() > 180.0 or
+                          np.abs(ring[:, 1]).max() > 90.0):
+            raise ValueError("%s are not in lon/lat, and have no "
+                             "projection to convert them from" % source)
+    return rings
+
+
+def read_projection(path):
+    ''' Get the WKT of a shapefile's projection from its .prj file, or None
+    if it has none
+    '''
+    prj_path = os.path.splitext(path)[0] + '.prj'
+    if not os.path.exists(prj_path):
+        return None
+    with open(prj_path, "r") as prj_file:
+        return prj_file.read()
+
+
+def read_shapefile_rings(path, name=None, name_field=None):
+    ''' Read the rings of the shapes in a shapefile whose record matches
+    name (in name_field, or in any field if not given), in lon/lat (see
+    lon_lat_rings). Returns a list of (record, rings) tuples
+    '''
+    if shapefile is None:
+        raise ImportError("pyshp is needed to read shapefiles")
+    projection = read_projection(path)
+    reader = shapefile.Reader(path)
+    field_names = [field[0] for field in reader.fields[1:]]
+    matches = []
+    for shape_record in reader.shapeRecords():
+        record = list(shape_record.record)
+        if name is not None:
+            if name_field is not None:
+                values = [record[field_names.index(name_field)]]
+            else:
+                values = record
+            if name not in [str(v).strip() for v in values]:
+                continue
+        matches.append((dict(zip(field_names, record)),
+                        lon_lat_rings(shape_rings(shape_record.shape),
+                                      projection, "Shapes of " + path)))
+    return matches
+
+
+def crossings(px, py, x1, y1, x2, y2):
+    ''' Count (per point) the edges crossed by a ray from each point
+    towards +x. px, py are (N, 1) and the edges (1, E) arrays
+    '''
+    straddles = (y1 > py) != (y2 > py)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_cross = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+    return np.sum(straddles & (px < x_cross), axis=1)
+
+
+class PolygonGrid(object):
+    ''' A polygon, as a set of rings, with a grid for fast point tests
+    '''
+
+    # Cap on points x edges per ray casting block, to bound memory
+    BLOCK = 1 << 22
+
+    def __init__(self, rings, grid_size=64):
+        rings = [np.asarray(ring, dtype=np.float64) for ring in rings]
+        # Edges from each vertex to the next, closing every ring
+        starts = np.concatenate([ring for ring in rings])
+        ends = np.concatenate([np.roll(ring, -1, axis=0) for ring in rings])
+        keep = starts[:, 1] != ends[:, 1]  # horizontal edges never cross
+        (self.x1, self.y1) = (starts[keep, 0], starts[keep, 1])
+        (self.x2, self.y2) = (ends[keep, 0], ends[keep, 1])
+
+        allpoints = np.concatenate(rings)
+        (self.min_x, self.min_y) = allpoints.min(axis=0)
+        (self.max_x, self.max_y) = allpoints.max(axis=0)
+        self.grid_size = grid_size
+        self.cell_w = (self.max_x - self.min_x) / grid_size or 1.0
+        self.cell_h = (self.max_y - self.min_y) / grid_size or 1.0
+
+        self._build_grid()
+
+    def _cell_cols(self, xs):
+        return np.clip(((xs - self.min_x) / self.cell_w).astype(np.intp),
+                       0, self.grid_size - 1)
+
+    def _cell_rows(self, ys):
+        return np.clip(((ys - self.min_y) / self.cell_h).astype(np.intp),
+                       0, self.grid_size - 1)
+
+    def _build_grid(self):
+        size = self.grid_size
+        self.cells = np.zeros((size, size), dtype=np.uint8)
+
+        col1 = self._cell_cols(np.minimum(self.x1, self.x2))
+        col2 = self._cell_cols(np.maximum(self.x1, self.x2))
+        row1 = self._cell_rows(np.minimum(self.y1, self.y2))
+        row2 = self._cell_rows(np.maximum(self.y1, self.y2))
+
+        # Every cell an edge's bounding box touches is a boundary cell,
+        # and the edge is a candidate for rays cast from its rows
+        row_edges = [[] for _ in range(size)]
+        for i in range(len(self.x1)):
+            self.cells[row1[i]:row2[i] + 1, col1[i]:col2[i] + 1] = BOUNDARY
+            for row in range(row1[i], row2[i] + 1):
+                row_edges[row].append(i)
+        self.row_edges = [np.array(edges, dtype=np.intp)
+                          for edges in row_edges]
+
+        # Cells without edges are wholly inside or outside: test their
+        # centres against the whole polygon
+        (rows, cols) = np.nonzero(self.cells != BOUNDARY)
+        centre_x = self.min_x + (cols + 0.5) * self.cell_w
+        centre_y = self.min_y + (rows + 0.5) * self.cell_h
+        inside = self._ray_cast(centre_x, centre_y,
+                                np.arange(len(self.x1)))
+        self.cells[rows[inside], cols[inside]] = INSIDE
+
+    def _ray_cast(self, xs, ys, edges):
+        ''' Even-odd test of points against a subset of the edges
+        '''
+        result = np.zeros(len(xs), dtype=bool)
+        if len(edges) == 0 or len(xs) == 0:
+            return result
+        (x1, y1) = (self.x1[edges][None, :], self.y1[edges][None, :])
+        (x2, y2) = (self.x2[edges][None, :], self.y2[edges][None, :])
+        step = max(1, self.BLOCK // len(edges))
+        for start in range(0, len(xs), step):
+            px = xs[start:start + step, None]
+            py = ys[start:start + step, None]
+            result[start:start + step] = \
+                crossings(px, py, x1, y1, x2, y2) % 2 == 1
+        return result
+
+    def contains_many(self, lons, lats):
+        ''' Get a bool array, True for each point inside the polygon
+        '''
+        lons = np.asarray(lons, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+        result = np.zeros(len(lons), dtype=bool)
+
+        in_box = np.flatnonzero((lons >= self.min_x) & (lons <= self.max_x) &
+                                (lats >= self.min_y) & (lats <= self.max_y))
+        if len(in_box) == 0:
+            return result
+        rows = self._cell_rows(lats[in_box])
+        cols = self._cell_cols(lons[in_box])
+        status = self.cells[rows, cols]
+        result[in_box[status == INSIDE]] = True
+
+        boundary = status == BOUNDARY
+        (b_points, b_rows) = (in_box[boundary], rows[boundary])
+        for row in np.unique(b_rows):
+            points = b_points[b_rows == row]
+            result[points] = self._ray_cast(lons[points], lats[points],
+                                            self.row_edges[row])
+        return result
+
+    def contains(self, lon, lat):
+        ''' True if the point is inside the polygon
+        '''
+        if not (self.min_x <= lon <= self.max_x and
+                self.min_y <= lat <= self.max_y):
+            return False
+        row = int(self._cell_rows(np.array([lat]))[0])
+        col = int(self._cell_cols(np.array([lon]))[0])
+        status = self.cells[row, col]
+        if status != BOUNDARY:
+            return status == INSIDE
+        return bool(self._ray_cast(np.array([lon]), np.array([lat]),
+                                   self.row_edges[row])[0])
+
+
+def status_coordinates(status):
+    ''' Get the (lon, lat) of a geotagged status, or None
+    '''
+    coordinates = status.get("coordinates")
+    if coordinates is not None and coordinates.get("coordinates"):
+        (lon, lat) = coordinates["coordinates"][:2]
+        return (lon, lat)
+    geo = status.get("geo")
+    if geo is not None and geo.get("coordinates"):
+        # "geo" has the coordinates the other way round
+        (lat, lon) = geo["coordinates"][:2]
+        return (lon, lat)
+    return None
+
+
+class Geofence(object):
+    ''' Ingest-time filter of statuses geotagged outside a boundary
+    '''
+
+    def __init__(self, polygon):
+        self.polygon = polygon
+
+    @classmethod
+    def from_shapefile(cls, path, name=None, name_field=None, grid_size=64):
+        ''' Load the boundary of the shapes matching name from a shapefile,
+        e.g. the county and unitary boundaries read in TwitterMap.ipynb
+        '''
+        matches = read_shapefile_rings(path, name, name_field)
+        if not matches:
+            raise ValueError("No shape matching %s in %s" % (name, path))
+        rings = [ring for (_, shape_rings_) in matches
+                 for ring in shape_rings_]
+        LOG.info("Loaded %d rings for %s from %s", len(rings), name, path)
+        return cls(PolygonGrid(rings, grid_size))
+
+    def check(self, status):
+        ''' True if the status is geotagged inside the boundary, False if
+        outside, and None if it is not geotagged
+        '''
+        point = status_coordinates(status)
+        if point is None:
+            return None
+        return self.polygon.contains(float(point[0]), float(point[1]))
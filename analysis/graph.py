@@ -0,0 +1,283 @@
+""" Directed graph of the interactions between users.
+
+An InteractionGraph is built from statuses in one pass. It interns each
+user's id to a dense node number, and records an edge from the author
+to each user the status interacts with, by kind:
+    - 'mention': the users mentioned (entities.user_mentions), less the
+    user replied to, and not counting retweets, whose mentions are the
+    original's
+    - 'reply': the user replied to (in_reply_to_user_id)
+    - 'retweet': the author of the retweeted status
+Edges are buffered as (source, target) arrays, and folded into a
+weighted scipy.sparse CSR adjacency matrix per kind (the weight being
+the number of interactions) every COMPACT_EDGES edges, so memory stays
+bounded however many statuses are added.
+
+Graphs of different files (or byte ranges of one) can be built in worker
+processes and merged, the nodes of one being interned into the other.
+"""
+import array
+import multiprocessing
+import numpy as np
+import scipy.sparse as sp
+import logging
+
+from analysis.datafetch.segments import open_segment
+from analysis.table_cache import encode_strings, decode_strings
+from analysis.twitter_processor import Processor, RangeReader, \
+    newline_ranges
+
+LOG = logging.getLogger(__name__)
+
+MENTION = 'mention'
+REPLY = 'reply'
+RETWEET = 'retweet'
+INTERACTIONS = [MENTION, REPLY, RETWEET]
+
+
+def graph_range(args):
+    ''' Build the graph of the statuses in a byte range of a results file
+    (or all of a segment, if start and end are None), in a worker process
+    '''
+    (path, start, end) = args
+    graph = InteractionGraph()
+    graph.add_file(path, start=start, end=end)
+    graph.compact()
+    return graph
+
+
+class InteractionGraph(object):
+    ''' Weighted directed graph of the interactions between users, with a
+    sparse adjacency matrix per kind of interaction
+    '''
+
+    # Edges buffered before they are added to the matrices
+    COMPACT_EDGES = 1000000
+
+    def __init__(self):
+        self.ids = []
+        self.names = []
+        self.index = {}
+        self.activity = array.array('l')
+        self.statuses = 0
+        self._sources = dict((kind, array.array('l'))
+                             for kind in INTERACTIONS)
+        self._targets = dict((kind, array.array('l'))
+                             for kind in INTERACTIONS)
+        self._matrices = dict((kind, sp.csr_matrix((0, 0), dtype=np.int64))
+                              for kind in INTERACTIONS)
+        self._buffered = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_files(cls, paths, processes=None):
+        ''' Build the graph of the statuses in results files and segments,
+        in that many processes if given (each plain file being split into
+        byte ranges)
+        '''
+        graph = cls()
+        if processes is None:
+            for path in paths:
+                graph.add_file(path)
+            return graph
+        tasks = []
+        for path in paths:
+            if path.endswith('.gz'):
+                tasks.append((path, None, None))
+            else:
+                tasks.extend((path, start, end) for (start, end)
+                             in newline_ranges(path, processes * 4))
+        pool = multiprocessing.Pool(processes)
+        try:
+            for part in pool.imap(graph_range, tasks):
+                graph.merge(part)
+        finally:
+            pool.terminate()
+            pool.join()
+        return graph
+
+    def node(self, user_id, screen_name=None):
+        ''' Get the node number of a user, adding it if new. The user's
+        latest known screen name is kept
+        '''
+        node = self.index.get(user_id)
+        if node is None:
+            node = self.index[user_id] = len(self.ids)
+            self.ids.append(user_id)
+            self.names.append(screen_name)
+            self.activity.append(0)
+        elif screen_name is not None:
+            self.names[node] = screen_name
+        return node
+
+    def add_edge(self, kind, source, target):
+        if source == target:
+            return
+        self._sources[kind].append(source)
+        self._targets[kind].append(target)
+        self._buffered += 1
+        if self._buffered >= self.COMPACT_EDGES:
+            self.compact()
+
+    def add_status(self, status):
+        ''' Add the interactions of a status. Returns False, adding
+        nothing, for any other message
+        '''
+        try:
+            user = status["user"]
+            author = self.node(user["id"], user.get("screen_name"))
+        except (KeyError, TypeError):
+            return False
+        self.statuses += 1
+        self.activity[author] += 1
+
+        reply_id = status.get("in_reply_to_user_id")
+        if reply_id is not None:
+            self.add_edge(REPLY, author, self.node(
+                reply_id, status.get("in_reply_to_screen_name")))
+
+        retweeted = status.get("retweeted_status")
+        if retweeted:
+            try:
+                original = retweeted["user"]
+                self.add_edge(RETWEET, author, self.node(
+                    original["id"], original.get("screen_name")))
+            except (KeyError, TypeError):
+                pass
+            return True
+
+        mentions = (status.get("entities") or {}).get("user_mentions")
+        for mention in mentions or []:
+            mention_id = mention.get("id")
+            if mention_id is not None and mention_id != reply_id:
+                self.add_edge(MENTION, author, self.node(
+                    mention_id, mention.get("screen_name")))
+        return True
+
+    def add_statuses(self, statuses):
+        for status in statuses:
+            self.add_status(status)
+
+    def add_file(self, path, processor=None, start=None, end=None):
+        ''' Add the statuses of a results file (from byte start to end, if
+        given) or gzipped segment
+        '''
+        processor = processor if processor is not None else Processor()
+        if path.endswith('.gz'):
+            results_file = open_segment(path)
+            reader = results_file
+        else:
+            results_file = open(path, "r")
+            results_file.seek(start or 0)
+            reader = RangeReader(results_file, end) if end is not None \
+                else results_file
+        try:
+            self.add_statuses(processor.simple_results_iterator(reader, None))
+        finally:
+            results_file.close()
+
+    def compact(self):
+        ''' Add the buffered edges to the matrices
+        '''
+        size = len(self.ids)
+        for kind in INTERACTIONS:
+            sources = np.frombuffer(self._sources[kind], dtype=np.int_) \
+                if len(self._sources[kind]) else np.zeros(0, dtype=np.int_)
+            targets = np.frombuffer(self._targets[kind], dtype=np.int_) \
+                if len(self._targets[kind]) else np.zeros(0, dtype=np.int_)
+            edges = sp.csr_matrix(
+                (np.ones(len(sources), dtype=np.int64), (sources, targets)),
+                shape=(size, size), dtype=np.int64)
+            self._matrices[kind] = self.resized(self._matrices[kind]) + edges
+            self._sources[kind] = array.array('l')
+            self._targets[kind] = array.array('l')
+        self._buffered = 0
+
+    def resized(self, matrix, mapping=None):
+        ''' Copy a matrix into the current number of nodes, renumbering its
+        nodes by mapping (if given)
+        '''
+        size = len(self.ids)
+        coo = matrix.tocoo()
+        (rows, cols) = (coo.row, coo.col) if mapping is None \
+            else (mapping[coo.row], mapping[coo.col])
+        return sp.csr_matrix((coo.data, (rows, cols)), shape=(size, size),
+                             dtype=np.int64)
+
+    def matrix(self, kind):
+        ''' Get the adjacency matrix of a kind of interaction: the number
+        of times each user (row) interacted with each other (column)
+        '''
+        self.compact()
+        return self._matrices[kind]
+
+    def adjacency(self, kinds=None):
+        ''' Get the sum of the adjacency matrices of kinds (by default, of
+        all of them)
+        '''
+        kinds = kinds if kinds is not None else INTERACTIONS
+        self.compact()
+        total = sp.csr_matrix((len(self), len(self)), dtype=np.int64)
+        for kind in kinds:
+            total = total + self._matrices[kind]
+        return total
+
+    def merge(self, other):
+        ''' Add the nodes and edges of another graph
+        '''
+        self.compact()
+        mapping = np.array([self.node(user_id, name) for (user_id, name)
+                            in zip(other.ids, other.names)], dtype=np.int_)
+        if len(mapping):
+            activity = np.frombuffer(self.activity, dtype=np.int_).copy()
+            activity[mapping] += np.frombuffer(other.activity,
+                                               dtype=np.int_)
+            self.activity = array.array('l', activity.tolist())
+        self.statuses += other.statuses
+        for kind in INTERACTIONS:
+            self._matrices[kind] = self.resized(self._matrices[kind]) + \
+                self.resized(other.matrix(kind), mapping)
+        return self
+
+    def save(self, path):
+        ''' Save the graph to an .npz file
+        '''
+        self.compact()
+        arrays = {
+            "ids": np.array(self.ids, dtype=np.int64),
+            "activity": np.frombuffer(self.activity, dtype=np.int_)
+            if len(self.activity) else np.zeros(0, dtype=np.int_),
+            "statuses": np.array([self.statuses]),
+        }
+        (arrays["names.data"], arrays["names.offsets"]) = encode_strings(
+            [name or u'' for name in self.names])
+        for kind in INTERACTIONS:
+            matrix = self._matrices[kind]
+            arrays[kind + ".data"] = matrix.data
+            arrays[kind + ".indices"] = matrix.indices
+            arrays[kind + ".indptr"] = matrix.indptr
+        with open(path, "wb") as graph_file:
+            np.savez(graph_file, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        graph = cls()
+        data = np.load(path)
+        try:
+            graph.ids = data["ids"].tolist()
+            graph.names = [name or None for name in decode_strings(
+                data["names.data"], data["names.offsets"])]
+            graph.index = dict((user_id, node)
+                               for (node, user_id) in enumerate(graph.ids))
+            graph.activity = array.array('l', data["activity"].tolist())
+            graph.statuses = int(data["statuses"][0])
+            size = len(graph.ids)
+            for kind in INTERACTIONS:
+                graph._matrices[kind] = sp.csr_matrix(
+                    (data[kind + ".data"], data[kind + ".indices"],
+                     data[kind + ".indptr"]), shape=(size, size))
+        finally:
+            data.close()
+        return graph
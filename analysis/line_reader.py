@@ -0,0 +1,189 @@
+""" Memory-mapped reading of results files by line number.
+
+LineReader maps a JSONL results file into memory and keeps an index of
+where each line starts, so any line can be had directly by its number,
+and a scan can start (or resume) at any line. Lines are handed out as
+memoryview slices of the mapping, without copying them. (The JSON
+decoders cannot parse a memoryview, so the Processor still copies each
+line it decodes.)
+
+The index is a file of little endian int64s saved beside the results
+file (as <file>.lineidx): a header, then the start of every complete
+line, then the end of the last one. The header holds hashes of the first
+and last FINGERPRINT_BYTES of the file up to that end, so an index is
+only used for the file it was built from. As the results file grows, the
+offsets of the new lines are appended to it and the header rewritten, so
+the file is never scanned twice.
+"""
+import hashlib
+import mmap
+import os
+import numpy as np
+import logging
+
+LOG = logging.getLogger(__name__)
+
+INDEX_SUFFIX = '.lineidx'
+
+# First word of an index file ("LIDX1"), and its number of header words
+INDEX_MAGIC = 0x3158444c49
+HEADER_WORDS = 3
+
+# Bytes hashed at each end of the indexed part of the file
+FINGERPRINT_BYTES = 4096
+
+# Bytes scanned for newlines at once, to bound the scan's memory
+SCAN_BLOCK = 64 * 1024 * 1024
+
+
+def block_hash(block):
+    return np.frombuffer(hashlib.sha1(block).digest()[:8], dtype='<i8')[0]
+
+
+def index_header(head, tail):
+    ''' Make the header of an index, given the first and last
+    FINGERPRINT_BYTES of the file up to its end
+    '''
+    return np.array([INDEX_MAGIC, block_hash(head), block_hash(tail)],
+                    dtype='<i8')
+
+
+class LineReader(object):
+    ''' Random access to the complete lines of a file, by line number
+    '''
+
+    def __init__(self, path, index_path=None, save_index=True):
+        self.name = path
+        self.index_path = index_path if index_path is not None \
+            else path + INDEX_SUFFIX
+        self.save_index = save_index
+        self.offsets = None
+        self._file = open(path, "rb")
+        self._mmap = None
+        self._view = memoryview(b'')
+        self._size = 0
+        self.load_index()
+        self.refresh()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, line_no):
+        return self.line(line_no)
+
+    def close(self):
+        # The map is not closed, as lines handed out may still be in use:
+        # it is unmapped once the last of them is released
+        self._view = None
+        self._mmap = None
+        self._file.close()
+
+    def _read(self, start, end):
+        self._file.seek(start)
+        return self._file.read(end - start)
+
+    def load_index(self):
+        ''' Read the saved index, if it still fits the file
+        '''
+        self.offsets = np.zeros(1, dtype='<i8')
+        if not os.path.exists(self.index_path):
+            return
+        words = np.fromfile(self.index_path, dtype='<i8')
+        (header, offsets) = (words[:HEADER_WORDS], words[HEADER_WORDS:])
+        if len(offsets) == 0 or header[0] != INDEX_MAGIC or \
+                offsets[0] != 0:
+            LOG.warn("Ignoring bad line index %s", self.index_path)
+            return
+        end = int(offsets[-1])
+        size = os.fstat(self._file.fileno()).st_size
+        if end > size:
+            LOG.warn("Line index %s is past the end of %s, rebuilding",
+                     self.index_path, self.name)
+            return
+        expected = index_header(
+            self._read(0, min(end, FINGERPRINT_BYTES)),
+            self._read(max(0, end - FINGERPRINT_BYTES), end))
+        if not np.array_equal(header, expected):
+            LOG.warn("Line index %s does not match %s, rebuilding",
+                     self.index_path, self.name)
+            return
+        self.offsets = offsets
+
+    def refresh(self):
+        ''' Map any data added to the file since it was last mapped, and
+        index its complete lines. Returns the number of new lines
+        '''
+        size = os.fstat(self._file.fileno()).st_size
+        if size == self._size:
+            return 0
+        if size < self._size:
+            raise IOError("%s has been truncated" % self.name)
+        # The old map is left to be unmapped once the lines handed out
+        # from it are released
+        self._view = None
+        self._mmap = mmap.mmap(self._file.fileno(), size,
+                               access=mmap.ACCESS_READ)
+        data = np.frombuffer(self._mmap, dtype=np.uint8)
+        self._view = memoryview(data)
+        self._size = size
+
+        end = int(self.offsets[-1])
+        new_offsets = []
+        for start in range(end, size, SCAN_BLOCK):
+            block = data[start:min(start + SCAN_BLOCK, size)]
+            new_offsets.append(np.flatnonzero(block == 10) + (start + 1))
+        if not new_offsets:
+            return 0
+        new_offsets = np.concatenate(new_offsets).astype('<i8')
+        if len(new_offsets) == 0:
+            return 0
+        self.offsets = np.concatenate([self.offsets, new_offsets])
+        if self.save_index:
+            self._save_index(data, end, new_offsets)
+        return len(new_offsets)
+
+    def _save_index(self, data, end, new_offsets):
+        ''' Append the new offsets to the saved index, and rewrite its
+        header for the new end. An index built from the start replaces
+        any saved one (which may have been rejected as stale)
+        '''
+        new_end = int(self.offsets[-1])
+        header = index_header(
+            data[:min(new_end, FINGERPRINT_BYTES)].tobytes(),
+            data[max(0, new_end - FINGERPRINT_BYTES):new_end].tobytes())
+        if end > 0:
+            with open(self.index_path, "r+b") as index_file:
+                index_file.seek(0, os.SEEK_END)
+                new_offsets.tofile(index_file)
+                index_file.seek(0)
+                header.tofile(index_file)
+        else:
+            with open(self.index_path, "wb") as index_file:
+                header.tofile(index_file)
+                self.offsets.tofile(index_file)
+
+    def line(self, line_no):
+        ''' Get a line (without its newline) as a memoryview
+        '''
+        if line_no < 0:
+            line_no += len(self)
+        if not 0 <= line_no < len(self):
+            raise IndexError("line %d out of range" % line_no)
+        return self._view[int(self.offsets[line_no]):
+                          int(self.offsets[line_no + 1]) - 1]
+
+    def iter_lines(self, start=0, stop=None):
+        ''' A generator of the lines from line start up to (not including)
+        line stop, as memoryviews
+        '''
+        stop = len(self) if stop is None else min(stop, len(self))
+        view = self._view
+        offsets = self.offsets[start:stop + 1].tolist()
+        for i in range(len(offsets) - 1):
+            yield view[offsets[i]:offsets[i + 1] - 1]
@@ -0,0 +1,390 @@
+""" Pre-aggregated activity counts, by time bucket and dimension.
+
+A Rollup counts the statuses in the Processor's DataFrames per time
+bucket (minute, hour or day) and, for each dimension, per key:
+    - 'all': one key, for the totals
+    - 'user': the user's screen name
+    - 'cell': the (row, column) of the geo grid cell, of cell_size degrees
+    - 'hashtag': each (lower case) hashtag in the status
+For each dimension, it keeps sparse matrices with a row per bucket and a
+column per key, of the statuses and of the geotagged statuses. Time
+window queries (tweets, unique users, geotagged share, top keys...) then
+only sum rows of those matrices, without touching the statuses again.
+
+Rollups built separately (e.g. over the byte ranges of a file, by worker
+processes) are combined with merge(). A Rollup is also an aggregator for
+an analysis.follow.Follower, and Rollups keeps one per resolution.
+"""
+import re
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import logging
+
+LOG = logging.getLogger(__name__)
+
+# Seconds per bucket of each resolution
+RESOLUTIONS = {
+    'minute': 60,
+    'hour': 3600,
+    'day': 86400,
+}
+
+DIMENSIONS = ['all', 'user', 'cell', 'hashtag']
+
+RE_HASHTAG = re.compile(r'#(\w+)', re.UNICODE)
+
+
+def to_seconds(times):
+    ''' Convert datetimes (e.g. strings, Timestamps) to seconds since the
+    epoch
+    '''
+    return np.asarray(pd.to_datetime(times).values.astype('datetime64[s]')
+                      .astype(np.int64))
+
+
+def extract_hashtags(statuses):
+    ''' Get the hashtags in an array of status texts, as the (row, hashtag)
+    of each, lower cased
+    '''
+    rows = []
+    hashtags = []
+    for (row, text) in enumerate(statuses):
+        if not text or u'#' not in text:
+            continue
+        for hashtag in RE_HASHTAG.findall(text):
+            rows.append(row)
+            hashtags.append(hashtag.lower())
+    return (np.array(rows, dtype=np.int64), hashtags)
+
+
+def column_sums(matrix):
+    return matrix.T.dot(np.ones(matrix.shape[0], dtype=np.int64))
+
+
+def row_sums(matrix):
+    return matrix.dot(np.ones(matrix.shape[1], dtype=np.int64))
+
+
+def shifted(matrix, shape, row_shift=0, columns=None):
+    ''' Copy a sparse matrix into a new shape, moving its rows down by
+    row_shift and its columns to the indices in columns (if given)
+    '''
+    coo = matrix.tocoo()
+    cols = coo.col if columns is None else columns[coo.col]
+    return sp.csr_matrix((coo.data, (coo.row + row_shift, cols)),
+                         shape=shape, dtype=np.int64)
+
+
+class DimensionCounts(object):
+    ''' Counts of statuses (and geotagged statuses) per bucket and key of
+    one dimension, keys being interned to the matrices' columns
+    '''
+
+    def __init__(self):
+        self.keys = []
+        self.index = {}
+        self.tweets = sp.csr_matrix((0, 0), dtype=np.int64)
+        self.geotagged = sp.csr_matrix((0, 0), dtype=np.int64)
+
+    def intern(self, keys):
+        ''' Get the column of each of keys, adding new keys
+        '''
+        (codes, uniques) = pd.factorize(pd.Series(keys, dtype=object))
+        columns = np.empty(len(uniques), dtype=np.int64)
+        for (i, key) in enumerate(uniques):
+            column = self.index.get(key)
+            if column is None:
+                column = self.index[key] = len(self.keys)
+                self.keys.append(key)
+            columns[i] = column
+        return columns[codes]
+
+    def resize(self, buckets, row_shift=0):
+        shape = (buckets, len(self.keys))
+        self.tweets = shifted(self.tweets, shape, row_shift)
+        self.geotagged = shifted(self.geotagged, shape, row_shift)
+
+    def add(self, rows, columns, geotagged, buckets):
+        ''' Count a status in each (row, column), of buckets rows
+        '''
+        shape = (buckets, len(self.keys))
+        ones = np.ones(len(rows), dtype=np.int64)
+        self.tweets = shifted(self.tweets, shape) + sp.csr_matrix(
+            (ones, (rows, columns)), shape=shape, dtype=np.int64)
+        self.geotagged = shifted(self.geotagged, shape) + sp.csr_matrix(
+            (ones[geotagged], (rows[geotagged], columns[geotagged])),
+            shape=shape, dtype=np.int64)
+
+    def merge(self, other, buckets, row_shift, other_row_shift):
+        ''' Add the counts of other, whose rows move down by
+        other_row_shift (as ours do by row_shift)
+        '''
+        columns = self.intern(other.keys) if other.keys \
+            else np.zeros(0, dtype=np.int64)
+        shape = (buckets, len(self.keys))
+        self.tweets = shifted(self.tweets, shape, row_shift) + shifted(
+            other.tweets, shape, other_row_shift, columns)
+        self.geotagged = shifted(self.geotagged, shape, row_shift) + \
+            shifted(other.geotagged, shape, other_row_shift, columns)
+
+    def get_state(self):
+        tweets = self.tweets.tocoo()
+        geotagged = self.geotagged.tocsr()
+        return {
+            "keys": [list(key) if isinstance(key, tuple) else key
+                     for key in self.keys],
+            "rows": tweets.row.tolist(),
+            "columns": tweets.col.tolist(),
+            "tweets": tweets.data.tolist(),
+            "geotagged": np.asarray(
+                geotagged[tweets.row, tweets.col]).ravel().tolist()
+            if tweets.nnz else [],
+        }
+
+    def set_state(self, state, buckets):
+        self.keys = [tuple(key) if isinstance(key, list) else key
+                     for key in state["keys"]]
+        self.index = dict((key, i) for (i, key) in enumerate(self.keys))
+        shape = (buckets, len(self.keys))
+        indices = (np.array(state["rows"], dtype=np.int64),
+                   np.array(state["columns"], dtype=np.int64))
+        self.tweets = sp.csr_matrix(
+            (np.array(state["tweets"], dtype=np.int64), indices),
+            shape=shape, dtype=np.int64)
+        self.geotagged = sp.csr_matrix(
+            (np.array(state["geotagged"], dtype=np.int64), indices),
+            shape=shape, dtype=np.int64)
+        self.geotagged.eliminate_zeros()
+
+
+class Rollup(object):
+    ''' Activity counts per bucket of resolution ('minute', 'hour' or
+    'day'), in total and per user, geo cell (of cell_size degrees) and
+    hashtag. Bucket rows start at origin, the first bucket counted
+    '''
+
+    def __init__(self, resolution='hour', cell_size=0.01):
+        if resolution not in RESOLUTIONS:
+            raise ValueError("Unknown resolution: %s" % resolution)
+        self.resolution = resolution
+        self.seconds = RESOLUTIONS[resolution]
+        self.cell_size = cell_size
+        self.reset()
+
+    def reset(self):
+        self.origin = None
+        self.buckets = 0
+        self.dimensions = dict((name, DimensionCounts())
+                               for name in DIMENSIONS)
+
+    def _extend(self, first, last):
+        ''' Make room for the buckets from first to last. Returns the row
+        shift of the existing rows
+        '''
+        if self.origin is None:
+            (self.origin, self.buckets) = (first, 0)
+        row_shift = max(0, self.origin - first)
+        self.origin -= row_shift
+        self.buckets = max(self.buckets + row_shift,
+                           last - self.origin + 1)
+        return row_shift
+
+    def update(self, dataframe):
+        ''' Count the statuses in a DataFrame from the Processor. Those
+        without a (parsable) created_at are left out
+        '''
+        dataframe = dataframe[dataframe["created_at"].notnull()]
+        if len(dataframe) == 0:
+            return
+        buckets = to_seconds(dataframe["created_at"]) // self.seconds
+        row_shift = self._extend(int(buckets.min()), int(buckets.max()))
+        rows = buckets - self.origin
+        latitudes = dataframe["latitude"].values
+        longitudes = dataframe["longitude"].values
+        geotagged = ~(np.isnan(latitudes) | np.isnan(longitudes))
+
+        keys = {
+            'all': (rows, np.zeros(len(rows), dtype=np.int64), geotagged),
+            'user': (rows, dataframe["user"].astype(object).values,
+                     geotagged),
+        }
+        cell_rows = np.floor(latitudes[geotagged] / self.cell_size)
+        cell_columns = np.floor(longitudes[geotagged] / self.cell_size)
+        keys['cell'] = (rows[geotagged],
+                        [(int(row), int(column)) for (row, column)
+                         in zip(cell_rows, cell_columns)],
+                        np.ones(len(cell_rows), dtype=bool))
+        (tag_rows, hashtags) = extract_hashtags(dataframe["status"].values)
+        keys['hashtag'] = (rows[tag_rows], hashtags, geotagged[tag_rows])
+
+        for (name, (key_rows, key_values, key_geotagged)) in keys.items():
+            counts = self.dimensions[name]
+            counts.resize(self.buckets, row_shift)
+            if name == 'all':
+                if not counts.keys:
+                    counts.intern(['all'])
+                columns = key_values
+            else:
+                columns = counts.intern(key_values) if len(key_rows) \
+                    else np.zeros(0, dtype=np.int64)
+            counts.add(key_rows, columns, key_geotagged, self.buckets)
+
+    def merge(self, other):
+        ''' Add the counts of another Rollup, of the same resolution and
+        cell size (e.g. of another part of the data)
+        '''
+        if (other.resolution, other.cell_size) != \
+                (self.resolution, self.cell_size):
+            raise ValueError("Cannot merge a rollup by %s (of %s degree "
+                             "cells) into one by %s (of %s degree cells)" %
+                             (other.resolution, other.cell_size,
+                              self.resolution, self.cell_size))
+        if other.origin is None:
+            return self
+        row_shift = self._extend(other.origin,
+                                 other.origin + other.buckets - 1)
+        other_row_shift = other.origin - self.origin
+        for name in DIMENSIONS:
+            self.dimensions[name].merge(other.dimensions[name], self.buckets,
+                                        row_shift, other_row_shift)
+        return self
+
+    def get_state(self):
+        return {
+            "resolution": self.resolution,
+            "cell_size": self.cell_size,
+            "origin": self.origin,
+            "buckets": self.buckets,
+            "dimensions": dict((name, counts.get_state())
+                               for (name, counts) in self.dimensions.items()),
+        }
+
+    def set_state(self, state):
+        self.resolution = state["resolution"]
+        self.seconds = RESOLUTIONS[self.resolution]
+        self.cell_size = state["cell_size"]
+        self.origin = state["origin"]
+        self.buckets = state["buckets"]
+        for (name, counts) in self.dimensions.items():
+            counts.set_state(state["dimensions"][name], self.buckets)
+
+    def rows(self, start=None, end=None):
+        ''' Get the (first, last + 1) rows of the buckets in the window
+        from start up to end (datetimes, or None for no limit)
+        '''
+        if self.origin is None:
+            return (0, 0)
+        first = 0 if start is None else \
+            to_seconds([start])[0] // self.seconds - self.origin
+        last = self.buckets if end is None else \
+            -(-to_seconds([end])[0] // self.seconds) - self.origin
+        first = min(max(first, 0), self.buckets)
+        return (first, max(first, min(last, self.buckets)))
+
+    def times(self, first=0, last=None):
+        ''' Get the start time of each bucket row from first to last
+        '''
+        last = self.buckets if last is None else last
+        seconds = (np.arange(first, last) + (self.origin or 0)) * \
+            self.seconds
+        return pd.to_datetime(seconds, unit='s')
+
+    def key_counts(self, dimension, start=None, end=None):
+        ''' Get the tweets and geotagged tweets per key of a dimension in a
+        time window, as two arrays in the order of the dimension's keys
+        '''
+        counts = self.dimensions[dimension]
+        (first, last) = self.rows(start, end)
+        tweets = column_sums(counts.tweets[first:last])
+        geotagged = column_sums(counts.geotagged[first:last])
+        return (tweets, geotagged)
+
+    def window(self, dimension, start=None, end=None):
+        ''' Get a DataFrame of the tweets, geotagged tweets and geotagged
+        share per key of a dimension in a time window, most tweets first
+        '''
+        (tweets, geotagged) = self.key_counts(dimension, start, end)
+        keys = self.dimensions[dimension].keys
+        active = np.flatnonzero(tweets)
+        dataframe = pd.DataFrame({
+            "tweets": tweets[active],
+            "geotagged": geotagged[active],
+        }, index=pd.Index([keys[i] for i in active], dtype=object),
+            columns=["tweets", "geotagged"])
+        dataframe["geotagged_share"] = \
+            dataframe["geotagged"] / dataframe["tweets"].astype(float)
+        return dataframe.sort_values("tweets", ascending=False) \
+            if hasattr(dataframe, "sort_values") else \
+            dataframe.sort("tweets", ascending=False)
+
+    def top(self, dimension, n=10, start=None, end=None):
+        ''' Get the n keys of a dimension with the most tweets in a window
+        '''
+        return self.window(dimension, start, end)[:n]
+
+    def summary(self, start=None, end=None):
+        ''' Get the tweets, unique users and geotagged share in a time
+        window
+        '''
+        (tweets, geotagged) = self.key_counts('all', start, end)
+        (user_tweets, _) = self.key_counts('user', start, end)
+        tweets = int(tweets.sum())
+        return {
+            "tweets": tweets,
+            "unique_users": int(np.count_nonzero(user_tweets)),
+            "geotagged_share": geotagged.sum() / float(tweets)
+            if tweets else np.nan,
+        }
+
+    def series(self, start=None, end=None):
+        ''' Get the tweets, unique users and geotagged share of each bucket
+        in a time window, as a DataFrame indexed by the bucket's start time
+        '''
+        (first, last) = self.rows(start, end)
+        totals = self.dimensions['all']
+        tweets = row_sums(totals.tweets[first:last])
+        geotagged = row_sums(totals.geotagged[first:last])
+        users = self.dimensions['user'].tweets[first:last].tocsr()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            share = geotagged / tweets.astype(float)
+        return pd.DataFrame({
+            "tweets": tweets,
+            "unique_users": np.diff(users.indptr),
+            "geotagged_share": share,
+        }, index=self.times(first, last),
+            columns=["tweets", "unique_users", "geotagged_share"])
+
+
+class Rollups(object):
+    ''' A Rollup for each of several resolutions, updated together
+    '''
+
+    def __init__(self, resolutions=('minute', 'hour', 'day'),
+                 cell_size=0.01):
+        self.rollups = dict((resolution, Rollup(resolution, cell_size))
+                            for resolution in resolutions)
+
+    def __getitem__(self, resolution):
+        return self.rollups[resolution]
+
+    def reset(self):
+        for rollup in self.rollups.values():
+            rollup.reset()
+
+    def update(self, dataframe):
+        for rollup in self.rollups.values():
+            rollup.update(dataframe)
+
+    def merge(self, other):
+        for (resolution, rollup) in self.rollups.items():
+            rollup.merge(other[resolution])
+        return self
+
+    def get_state(self):
+        return dict((resolution, rollup.get_state())
+                    for (resolution, rollup) in self.rollups.items())
+
+    def set_state(self, state):
+        for (resolution, rollup) in self.rollups.items():
+            rollup.set_state(state[resolution])
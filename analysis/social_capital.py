@@ -0,0 +1,225 @@
+""" Social capital metrics of groups of users: communities (from
+analysis.communities) or the areas they tweet from (analysis.areas).
+
+For each group, from the interaction graph (analysis.graph):
+    - users: the users in the group, and active_users those who posted
+    at least one status; statuses their number of statuses
+    - ties: the pairs of members who interacted either way
+    - density: the interactions (directed edges) between members, as a
+    share of all the ordered pairs of members
+    - reciprocity: the share of those interactions returned
+    - clustering: the mean local clustering coefficient of the members
+    (with at least two ties in the group), on the ties within the group
+    - mean_degree: the mean number of users each member interacted with
+    - within_share and cross_share: the shares of the members' ties which
+    are with other members and with users outside the group
+    - growth: the relative change in the group's statuses since the last
+    time its metrics were computed: 0 for a group which has not changed,
+    and NaN for one with no statuses to compare to (new, or with none
+    before)
+Everything is sparse matrix algebra over all the groups at once: edges
+are kept or dropped by comparing the group of their ends, the triangles
+at each node are the row sums of S * (S S) (elementwise, S being the
+within-group ties), and per group sums are bincounts.
+
+SocialCapital keeps the last metrics, and what each user looked like
+then, so that a later run only recomputes the groups with a member who
+has a new tie, status or group.
+"""
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import logging
+
+LOG = logging.getLogger(__name__)
+
+COLUMNS = ["users", "active_users", "statuses", "ties", "density",
+           "reciprocity", "clustering", "mean_degree", "within_share",
+           "cross_share", "growth"]
+
+
+def user_areas(graph, dataframe, area_index):
+    ''' Get the area code of each user of a graph: the area of most of
+    their statuses in a DataFrame from the Processor, assigned by an
+    analysis.areas.AreaIndex. Users with no status in an area get None
+    '''
+    codes = np.asarray(area_index.assign_frame(dataframe), dtype=object)
+    frame = pd.DataFrame({"user": np.asarray(dataframe["user"],
+                                             dtype=object),
+                          "area": codes}).dropna()
+    counts = frame.groupby(["user", "area"]).size().reset_index()
+    counts.columns = ["user", "area", "count"]
+    counts = counts.sort_values("count", ascending=False) \
+        if hasattr(counts, "sort_values") else \
+        counts.sort("count", ascending=False)
+    counts = counts.drop_duplicates("user")
+    areas = pd.Series(counts["area"].values, index=counts["user"].values)
+    names = [u"@" + name if name is not None else None
+             for name in graph.names]
+    return np.array([None if pd.isnull(value) else value
+                     for value in areas.reindex(names).values], dtype=object)
+
+
+def binary(matrix):
+    ''' Get the pattern of a sparse matrix, less its diagonal, as a float
+    CSR matrix of ones
+    '''
+    coo = sp.coo_matrix(matrix)
+    keep = (coo.row != coo.col) & (coo.data != 0)
+    return sp.csr_matrix((np.ones(keep.sum()),
+                          (coo.row[keep], coo.col[keep])), shape=coo.shape)
+
+
+def within(matrix, codes):
+    ''' Keep the entries of a sparse matrix whose row and column are in
+    the same group (codes of -1 being in none)
+    '''
+    coo = matrix.tocoo()
+    keep = (codes[coo.row] == codes[coo.col]) & (codes[coo.row] >= 0)
+    return sp.csr_matrix((coo.data[keep], (coo.row[keep], coo.col[keep])),
+                         shape=matrix.shape)
+
+
+def row_sums(matrix):
+    return matrix.dot(np.ones(matrix.shape[1]))
+
+
+def group_metrics(adjacency, codes, count, activity):
+    ''' Compute the metrics of count groups from a directed adjacency
+    matrix and the group code (0 to count - 1, or -1 for none) and number
+    of statuses of each node. Returns a DataFrame indexed by code
+    (without growth)
+    '''
+    codes = np.asarray(codes)
+    activity = np.asarray(activity, dtype=np.float64)
+    members = codes >= 0
+    grouped = codes[members]
+
+    def per_group(values):
+        return np.bincount(grouped, np.asarray(values)[members],
+                           minlength=count)
+
+    directed = binary(adjacency)
+    ties = binary(directed + directed.T)
+    internal = within(directed, codes)
+    internal_ties = within(ties, codes)
+
+    users = per_group(np.ones(len(codes)))
+    edges = per_group(row_sums(internal))
+    mutual = per_group(row_sums(internal.multiply(internal.T)))
+    degree = row_sums(ties)
+    internal_degree = row_sums(internal_ties)
+    triangles = row_sums(internal_ties.multiply(
+        internal_ties.dot(internal_ties))) / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        local_clustering = np.where(
+            internal_degree >= 2,
+            2 * triangles / (internal_degree * (internal_degree - 1)), 0)
+        clustered = per_group(internal_degree >= 2)
+        total_degree = per_group(degree)
+        within_share = per_group(internal_degree) / total_degree
+        metrics = pd.DataFrame({
+            "users": users.astype(np.int64),
+            "active_users": per_group(activity > 0).astype(np.int64),
+            "statuses": per_group(activity).astype(np.int64),
+            "ties": (per_group(internal_degree) / 2).astype(np.int64),
+            "density": edges / (users * (users - 1)),
+            "reciprocity": mutual / edges,
+            "clustering": per_group(local_clustering) / clustered,
+            "mean_degree": total_degree / users,
+            "within_share": within_share,
+            "cross_share": 1 - within_share,
+        }, columns=COLUMNS[:-1])
+    return metrics
+
+
+class SocialCapital(object):
+    ''' Social capital metrics of groups of the users of an
+    analysis.graph.InteractionGraph, recomputed only for the groups which
+    changed since the last run
+    '''
+
+    def __init__(self, kinds=None):
+        self.kinds = kinds
+        self.reset()
+
+    def reset(self):
+        self.metrics = pd.DataFrame(columns=COLUMNS)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.signatures = np.zeros((0, 3), dtype=np.int64)
+        self.groups = np.zeros(0, dtype=object)
+
+    def signature(self, adjacency, activity):
+        ''' Get what a change to a user's ties or statuses changes: their
+        interactions both ways, and their statuses (counts only grow)
+        '''
+        adjacency = sp.csr_matrix(adjacency)
+        return np.column_stack([
+            adjacency.dot(np.ones(adjacency.shape[1], dtype=np.int64)),
+            adjacency.T.dot(np.ones(adjacency.shape[0], dtype=np.int64)),
+            activity]).astype(np.int64)
+
+    def changed_groups(self, ids, signatures, groups):
+        ''' Get the groups with a member who is new, or whose ties,
+        statuses or group changed, or who left (to another group)
+        '''
+        previous = pd.Index(self.ids).get_indexer(ids)
+        known = previous >= 0
+        changed = ~known
+        changed[known] = (
+            (signatures[known] != self.signatures[previous[known]])
+            .any(axis=1) |
+            (groups[known] != self.groups[previous[known]]))
+        left = self.groups[previous[known & changed]]
+        return (set(groups[changed]) | set(left)) & set(groups)
+
+    def update(self, graph, groups):
+        ''' Get the metrics of the groups of the users of a graph, groups
+        being the group (e.g. community label or area code) of each of its
+        nodes, None for those in no group. Returns a DataFrame indexed by
+        group
+        '''
+        adjacency = graph.adjacency(self.kinds)
+        activity = np.frombuffer(graph.activity, dtype=np.int_) \
+            if len(graph.activity) else np.zeros(0, dtype=np.int_)
+        groups = np.array([None if pd.isnull(group) else group
+                           for group in groups], dtype=object)
+        ids = np.array(graph.ids, dtype=np.int64)
+        signatures = self.signature(adjacency, activity)
+        changed = self.changed_groups(ids, signatures, groups)
+        changed.discard(None)
+        present = set(groups)
+        unchanged = self.metrics.drop(
+            [name for name in self.metrics.index
+             if name in changed or name not in present])
+        # Their statuses are part of what is compared, so have not changed
+        unchanged = unchanged.assign(growth=0.0)
+        self.ids = ids
+        self.signatures = signatures
+        self.groups = groups
+        if not changed:
+            self.metrics = unchanged
+            return self.metrics
+
+        names = pd.Index(sorted(changed))
+        codes = names.get_indexer(groups)
+        # Only the members of changed groups, and the users they
+        # interacted with, matter
+        nodes = np.flatnonzero(codes >= 0)
+        neighbours = np.unique(np.concatenate([
+            nodes, adjacency[nodes].indices,
+            adjacency.T.tocsr()[nodes].indices]))
+        sub = adjacency[neighbours][:, neighbours]
+        metrics = group_metrics(sub, codes[neighbours], len(names),
+                                activity[neighbours])
+        metrics.index = names
+
+        before = self.metrics["statuses"].reindex(names).values \
+            .astype(np.float64)
+        before[before == 0] = np.nan
+        metrics["growth"] = (metrics["statuses"].values - before) / before
+        self.metrics = pd.concat([unchanged, metrics])[COLUMNS] \
+            if len(unchanged) else metrics
+        LOG.info("Recomputed the metrics of %d of %d groups", len(names),
+                 len(self.metrics))
+        return self.metrics
@@ -0,0 +1,289 @@
+""" Columnar on-disk cache of the tables parsed from results files.
+
+The first time a results file is read through the cache, its table is
+parsed (with a Processor) and written out in a columnar format: Parquet
+if pandas has an engine for it, .npz otherwise. Later reads load the
+columns back instead of parsing the JSON again.
+
+Each cached file has a directory with its parts and a meta.json recording
+the source's size and mtime, and how far it has been parsed. When the
+source has only grown (e.g. the daemon is still appending to it), just
+the new complete lines are parsed, into a new part. Any other change
+means the table is parsed again from scratch.
+
+The directory is keyed by what the table depends on besides the source:
+the decoder's projected fields and JSON backend, and SCHEMA_VERSION, so
+a table parsed differently is never read back as the same one.
+"""
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import logging
+
+from analysis.twitter_processor import COLUMNS, RangeReader, ColumnBuffers
+
+LOG = logging.getLogger(__name__)
+
+PARQUET = 'parquet'
+NPZ = 'npz'
+
+# Bytes before the parsed offset which must be unchanged to append
+FINGERPRINT_BYTES = 4096
+
+# Bump when the table a Processor makes (its columns, their types or how
+# they are parsed) changes, so older caches are not used
+SCHEMA_VERSION = 1
+
+
+def parquet_engine():
+    ''' Get the name of an installed Parquet engine for pandas, or None
+    '''
+    if not hasattr(pd.DataFrame, "to_parquet"):
+        return None
+    for engine in ("pyarrow", "fastparquet"):
+        try:
+            __import__(engine)
+            return engine
+        except ImportError:
+            pass
+    return None
+
+
+def last_line_end(path, start, end):
+    ''' Get the offset just after the last newline between start and end,
+    or start if there is none, so a line still being written is left out
+    '''
+    block = 65536
+    with open(path, "rb") as results_file:
+        pos = end
+        while pos > start:
+            size = min(block, pos - start)
+            results_file.seek(pos - size)
+            data = results_file.read(size)
+            newline = data.rfind('\n')
+            if newline >= 0:
+                return pos - size + newline + 1
+            pos -= size
+    return start
+
+
+def encode_strings(values):
+    ''' Pack an object array of strings into a UTF-8 byte array and the
+    (N + 1) offsets of the strings in it, to store without pickle
+    '''
+    encoded = [value.encode('utf-8') for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    data = np.frombuffer(b''.join(encoded), dtype=np.uint8) \
+        if encoded else np.zeros(0, dtype=np.uint8)
+    return (data, offsets)
+
+
+def decode_strings(data, offsets):
+    ''' Unpack the strings packed by encode_strings
+    '''
+    blob = data.tostring()
+    bounds = offsets.tolist()
+    values = np.empty(len(bounds) - 1, dtype=object)
+    values[:] = [blob[bounds[i]:bounds[i + 1]].decode('utf-8')
+                 for i in range(len(bounds) - 1)]
+    return values
+
+
+def fingerprint(path, offset):
+    ''' Hash the bytes of a file just before offset
+    '''
+    start = max(0, offset - FINGERPRINT_BYTES)
+    with open(path, "rb") as results_file:
+        results_file.seek(start)
+        return hashlib.sha1(results_file.read(offset - start)).hexdigest()
+
+
+class TableCache(object):
+    ''' Cache of parsed results tables, in cache_dir. format is PARQUET or
+    NPZ; by default Parquet if an engine is installed
+    '''
+
+    META_NAME = 'meta.json'
+
+    def __init__(self, cache_dir, format=None):
+        self.cache_dir = cache_dir
+        self.engine = parquet_engine()
+        if format is None:
+            format = PARQUET if self.engine is not None else NPZ
+        if format == PARQUET and self.engine is None:
+            raise ImportError("pyarrow or fastparquet is needed for Parquet")
+        if format not in (PARQUET, NPZ):
+            raise ValueError("Unknown cache format: %s" % format)
+        self.format = format
+
+    def cache_key(self, processor):
+        ''' Get what, besides the source, the table of a processor
+        depends on
+        '''
+        decoder = processor.decoder
+        return {
+            "schema": SCHEMA_VERSION,
+            "columns": COLUMNS,
+            "fields": decoder.fields,
+            "backend": decoder.backend.__name__,
+        }
+
+    def entry_dir(self, path, key):
+        ''' Get the cache directory for a results file, parsed as key
+        (from cache_key()) describes
+        '''
+        path = os.path.abspath(path)
+        digest = hashlib.sha1(path.encode('utf-8') + b'\0' +
+                              json.dumps(key, sort_keys=True)
+                              .encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cache_dir,
+                            '%s-%s' % (os.path.basename(path), digest))
+
+    def read_meta(self, entry_dir):
+        meta_path = os.path.join(entry_dir, self.META_NAME)
+        if not os.path.exists(meta_path):
+            return None
+        try:
+            with open(meta_path, "r") as meta_file:
+                return json.load(meta_file)
+        except ValueError:
+            LOG.warn("Ignoring bad cache metadata %s", meta_path)
+            return None
+
+    def write_meta(self, entry_dir, meta):
+        meta_path = os.path.join(entry_dir, self.META_NAME)
+        with open(meta_path + '.tmp', "w") as meta_file:
+            json.dump(meta, meta_file, indent=4, sort_keys=True)
+        os.rename(meta_path + '.tmp', meta_path)
+
+    def write_part(self, entry_dir, index, columns):
+        ''' Write a part of the table. Returns its file name
+        '''
+        name = 'part-%05d.%s' % (index, self.format)
+        part_path = os.path.join(entry_dir, name)
+        if self.format == PARQUET:
+            pd.DataFrame(columns, columns=COLUMNS).to_parquet(
+                part_path, engine=self.engine)
+        else:
+            arrays = {}
+            for (column, values) in columns.items():
+                if values.dtype == object:
+                    (arrays[column + '.data'],
+                     arrays[column + '.offsets']) = encode_strings(values)
+                else:
+                    arrays[column] = values
+            with open(part_path, "wb") as part_file:
+                np.savez(part_file, **arrays)
+        return name
+
+    def read_part(self, entry_dir, name):
+        ''' Read a part of the table, as a dict of column arrays
+        '''
+        part_path = os.path.join(entry_dir, name)
+        if name.endswith(PARQUET):
+            dataframe = pd.read_parquet(part_path, engine=self.engine)
+            return dict((column, dataframe[column].values)
+                        for column in COLUMNS)
+        data = np.load(part_path)
+        try:
+            columns = {}
+            for column in COLUMNS:
+                if column in data.files:
+                    columns[column] = data[column]
+                else:
+                    columns[column] = decode_strings(
+                        data[column + '.data'], data[column + '.offsets'])
+            return columns
+        finally:
+            data.close()
+
+    def parse(self, processor, path, start, end, processes=None):
+        ''' Parse the lines of a results file from start to end into one
+        dict of column arrays
+        '''
+        if processes is not None:
+            chunks = list(processor.iter_parallel_column_chunks(
+                path, processes, start=start, end=end))
+        else:
+            with open(path, "r") as results_file:
+                results_file.seek(start)
+                chunks = list(processor.iter_column_chunks(
+                    RangeReader(results_file, end)))
+        if not chunks:
+            return ColumnBuffers(0).columns()
+        return dict((column, np.concatenate([chunk[column]
+                                             for chunk in chunks]))
+                    for column in COLUMNS)
+
+    def reset(self, entry_dir, path, key):
+        ''' Empty the cache of a results file. Returns its new metadata
+        '''
+        if os.path.exists(entry_dir):
+            shutil.rmtree(entry_dir)
+        os.makedirs(entry_dir)
+        return {
+            "source": os.path.abspath(path),
+            "key": key,
+            "format": self.format,
+            "offset": 0,
+            "parts": [],
+            "rows": 0,
+            "lines_read": 0,
+            "errors": 0,
+            "skipped": 0,
+        }
+
+    def update(self, meta, entry_dir, path, stat, processor, processes):
+        ''' Parse the complete lines after the cached offset into a new part
+        '''
+        end = last_line_end(path, meta["offset"], stat.st_size)
+        if end > meta["offset"]:
+            columns = self.parse(processor, path, meta["offset"], end,
+                                 processes)
+            for count in ("lines_read", "errors", "skipped"):
+                meta[count] += getattr(processor, count)
+            rows = len(columns["id"])
+            if rows:
+                meta["parts"].append(self.write_part(
+                    entry_dir, len(meta["parts"]), columns))
+                meta["rows"] += rows
+        meta["offset"] = end
+        meta["fingerprint"] = fingerprint(path, end)
+        meta["size"] = stat.st_size
+        meta["mtime"] = stat.st_mtime
+        self.write_meta(entry_dir, meta)
+
+    def load_chunks(self, path, processor, processes=None):
+        ''' Get the table of a results file as a list of dicts of column
+        arrays, parsing (with processor) only what is not cached yet.
+        Sets the processor's counts to those of the whole file
+        '''
+        stat = os.stat(path)
+        # Through JSON, as it is compared with the one read back
+        key = json.loads(json.dumps(self.cache_key(processor)))
+        entry_dir = self.entry_dir(path, key)
+        meta = self.read_meta(entry_dir)
+        if meta is not None and (meta["format"] != self.format or
+                                 meta.get("key") != key):
+            meta = None
+
+        if meta is not None and meta["size"] == stat.st_size and \
+                meta["mtime"] == stat.st_mtime:
+            LOG.info("Loading %s from cache", path)
+        else:
+            if meta is not None and stat.st_size > meta["size"] and \
+                    fingerprint(path, meta["offset"]) == meta["fingerprint"]:
+                LOG.info("Appending to cache of %s from byte %d",
+                         path, meta["offset"])
+            else:
+                LOG.info("Caching %s", path)
+                meta = self.reset(entry_dir, path, key)
+            self.update(meta, entry_dir, path, stat, processor, processes)
+
+        for count in ("lines_read", "errors", "skipped"):
+            setattr(processor, count, meta[count])
+        return [self.read_part(entry_dir, name) for name in meta["parts"]]
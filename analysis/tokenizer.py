@@ -0,0 +1,119 @@
+""" Tokenizing status texts into words, and counting them.
+
+The rules are those the notebooks used for word clouds and topics:
+    - words with a handle, hashtag or URL in them are dropped, as are
+    words starting with a non-ASCII character
+    - words joined by simple punctuation (. , : \\ /) are split, and any
+    other character but letters, digits, - and _ is removed
+    - stop words (stopwords.WORDS) and words shorter than min_len are
+    dropped
+The stop words are made a frozenset once, on import, and each rule is a
+single precompiled regex applied to a whole batch of texts at once, so
+per word there is only a set lookup and a length check left.
+
+Counts are collections.Counters, one per batch, which add up: counting
+can be spread over processes and the counters merged.
+"""
+import collections
+import multiprocessing
+import re
+import logging
+
+import stopwords
+
+LOG = logging.getLogger(__name__)
+
+STOPWORDS = frozenset(stopwords.WORDS)
+
+# Whole words containing a handle, hashtag or URL, or starting with a
+# non-ASCII character, with the whitespace before them (so texts are
+# given a leading space)
+RE_JUNK = re.compile(r'\s(?:\S*(?:[@#]|https?://)\S*|[^\x00-\x7f\s]\S*)',
+                     re.UNICODE)
+# Characters to remove (texts are lower cased first)
+RE_STRIP = re.compile(r'[^0-9a-z\-_\s.,:\\/]', re.UNICODE)
+# Word separators
+RE_SPLIT = re.compile(r'[\s.,:\\/]+', re.UNICODE)
+
+
+class Tokenizer(object):
+    ''' Splits texts into words, less stop words and those shorter than
+    min_len
+    '''
+
+    def __init__(self, min_len=3, stopwords=STOPWORDS):
+        self.min_len = max(1, min_len)
+        self.stopwords = frozenset(stopwords)
+
+    def filter(self, words):
+        min_len = self.min_len
+        stopwords = self.stopwords
+        return [word for word in words
+                if len(word) >= min_len and word not in stopwords]
+
+    def clean(self, text):
+        ''' Lower case a text, and remove the junk words and characters
+        '''
+        return RE_STRIP.sub(u'', RE_JUNK.sub(u' ', u' ' + text.lower()))
+
+    def tokenize(self, text):
+        ''' Get the words of a text, as a list
+        '''
+        return self.filter(RE_SPLIT.split(self.clean(text)))
+
+    def tokenize_many(self, texts):
+        ''' Get the words of each of a batch of texts, as a list of lists.
+        The batch is cleaned up in one go
+        '''
+        texts = [text.replace(u'\n', u' ') if text else u''
+                 for text in texts]
+        if not texts:
+            return []
+        split = RE_SPLIT.split
+        # The space after each newline keeps it from being taken as the
+        # whitespace before a junk word
+        return [self.filter(split(text))
+                for text in self.clean(u'\n '.join(texts)).split(u'\n')]
+
+    def count(self, texts):
+        ''' Count the words in a batch of texts, as a Counter
+        '''
+        words = RE_SPLIT.split(self.clean(u' '.join(
+            text for text in texts if text)))
+        counts = collections.defaultdict(int)
+        min_len = self.min_len
+        stopwords = self.stopwords
+        for word in words:
+            if len(word) >= min_len and word not in stopwords:
+                counts[word] += 1
+        return collections.Counter(counts)
+
+
+def count_batch(args):
+    ''' Count the words in a batch of texts with a Tokenizer (run in a
+    worker process)
+    '''
+    (tokenizer, texts) = args
+    return tokenizer.count(texts)
+
+
+def count_words(batches, tokenizer=None, processes=None):
+    ''' Count the words in an iterable of batches of texts (e.g. the status
+    column of each of the Processor's column chunks), in that many
+    processes if given. Returns one Counter
+    '''
+    tokenizer = tokenizer if tokenizer is not None else Tokenizer()
+    counter = collections.Counter()
+    if processes is None:
+        for texts in batches:
+            counter.update(tokenizer.count(texts))
+        return counter
+    pool = multiprocessing.Pool(processes)
+    try:
+        tasks = ((tokenizer, list(texts)) for texts in batches)
+        for batch_counter in pool.imap(count_batch, tasks):
+            counter.update(batch_counter)
+    finally:
+        pool.terminate()
+        pool.join()
+    return counter
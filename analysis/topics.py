@@ -0,0 +1,269 @@
+""" Topic modelling (LDA) over the whole collection of statuses.
+
+A TopicCorpus streams the statuses of results files (or the daemon's
+gzipped segments) through the Tokenizer, and writes them to disk as a
+bag of words corpus, without ever holding it in memory:
+    - dictionary.dict: the gensim Dictionary of every word seen
+    - corpus-NNNNN.mm: the documents, in MatrixMarket format, a part
+    for each update
+    - corpus.json: the parts, and how much of each source has been read
+update() only reads what is new: sources not seen before, and the lines
+appended to a (plain) results file since the last update. New words are
+added to the dictionary as they are met, so existing parts keep their
+word ids. The new part and the dictionary are written first, and the
+state (a CorpusState) last, each atomically, so an interrupted update
+leaves the corpus as it was: the part is written again by the next one,
+and words it added to the dictionary only take unused ids.
+
+train() fits a multicore LDA model over all the parts, after dropping
+the rarest and commonest words; update_model() updates a model with the
+parts added since.
+"""
+import copy
+import itertools
+import json
+import os
+import logging
+
+try:
+    from gensim import corpora, models
+except ImportError:
+    corpora = None
+    models = None
+
+from analysis.datafetch.segments import read_manifest, open_segment
+from analysis.table_cache import last_line_end, fingerprint
+from analysis.tokenizer import Tokenizer
+from analysis.twitter_processor import Processor, Decoder, RangeReader, \
+    ROW_FIELDS
+
+LOG = logging.getLogger(__name__)
+
+
+def iter_documents(path, processor, tokenizer, start=0, end=None):
+    ''' A generator of the documents (lists of words) of the statuses in
+    a results file, from byte start to end, or in a gzipped segment.
+    Statuses without any words are left out
+    '''
+    if path.endswith('.gz'):
+        results_file = open_segment(path)
+        reader = results_file
+    else:
+        results_file = open(path, "r")
+        results_file.seek(start)
+        reader = RangeReader(results_file, end) if end is not None \
+            else results_file
+    try:
+        for columns in processor.iter_column_chunks(reader):
+            for document in tokenizer.tokenize_many(columns["status"]):
+                if document:
+                    yield document
+    finally:
+        results_file.close()
+
+
+class RemappedCorpus(object):
+    ''' A bag of words corpus with its word ids mapped to those of another
+    dictionary, dropping the words not in mapping
+    '''
+
+    def __init__(self, corpus, mapping):
+        self.corpus = corpus
+        self.mapping = mapping
+
+    def __iter__(self):
+        mapping = self.mapping
+        for document in self.corpus:
+            yield [(mapping[word_id], count) for (word_id, count) in document
+                   if word_id in mapping]
+
+
+class CorpusState(object):
+    ''' The parts of a TopicCorpus, and how much of each source they
+    hold, saved to a JSON file at path
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.sources = {}
+        self.parts = []
+        if os.path.exists(path):
+            with open(path, "r") as state_file:
+                state = json.load(state_file)
+            self.sources = state["sources"]
+            self.parts = state["parts"]
+
+    def new_range(self, path):
+        ''' Get the (start, end) byte range of the new complete lines of a
+        source, or None if there are none
+        '''
+        source = self.sources.get(os.path.abspath(path))
+        size = os.path.getsize(path)
+        if path.endswith('.gz'):
+            # Segments are closed before they are listed, so never change
+            return (0, size) if source is None else None
+        start = 0
+        if source is not None:
+            if size >= source["offset"] and \
+                    fingerprint(path, source["offset"]) == \
+                    source["fingerprint"]:
+                start = source["offset"]
+            else:
+                LOG.warn("%s has been replaced since it was added to the "
+                         "corpus; adding all of it again", path)
+        end = last_line_end(path, start, size)
+        return (start, end) if end > start else None
+
+    def add_part(self, name, documents, ranges):
+        ''' Record a part of documents read from the (path, (start, end))
+        ranges of its sources
+        '''
+        self.parts.append({"name": name, "documents": documents})
+        for (path, (start, end)) in ranges:
+            self.sources[os.path.abspath(path)] = {
+                "offset": end,
+                "fingerprint": fingerprint(path, end)
+                if not path.endswith('.gz') else None,
+            }
+
+    def save(self):
+        ''' Save the state, atomically replacing the file
+        '''
+        state = {"sources": self.sources, "parts": self.parts}
+        with open(self.path + '.tmp', "w") as state_file:
+            json.dump(state, state_file, indent=4, sort_keys=True)
+            state_file.flush()
+            os.fsync(state_file.fileno())
+        os.rename(self.path + '.tmp', self.path)
+
+
+class TopicCorpus(object):
+    ''' Bag of words corpus of statuses, kept in corpus_dir
+    '''
+
+    STATE_NAME = 'corpus.json'
+    DICTIONARY_NAME = 'dictionary.dict'
+
+    def __init__(self, corpus_dir, tokenizer=None, processor=None):
+        if corpora is None:
+            raise ImportError("gensim is needed for topic modelling")
+        self.corpus_dir = corpus_dir
+        self.tokenizer = tokenizer if tokenizer is not None else Tokenizer()
+        self.processor = processor if processor is not None \
+            else Processor(Decoder(fields=ROW_FIELDS))
+        if not os.path.exists(corpus_dir):
+            os.makedirs(corpus_dir)
+
+        self.state = CorpusState(os.path.join(corpus_dir, self.STATE_NAME))
+        dictionary_path = os.path.join(corpus_dir, self.DICTIONARY_NAME)
+        if self.state.parts and os.path.exists(dictionary_path):
+            self.dictionary = corpora.Dictionary.load(dictionary_path)
+        else:
+            self.dictionary = corpora.Dictionary()
+
+    @property
+    def parts(self):
+        return self.state.parts
+
+    def __len__(self):
+        return sum(part["documents"] for part in self.parts)
+
+    def __iter__(self):
+        return iter(self.corpus())
+
+    def update(self, paths):
+        ''' Add the new statuses of results files or segments to the
+        corpus, as a new part. Returns the number of documents added
+        '''
+        ranges = []
+        for path in paths:
+            new_range = self.state.new_range(path)
+            if new_range is not None:
+                ranges.append((path, new_range))
+        if not ranges:
+            return 0
+
+        documents = itertools.chain.from_iterable(
+            iter_documents(path, self.processor, self.tokenizer, start, end)
+            for (path, (start, end)) in ranges)
+        count = [0]
+
+        def bags_of_words():
+            for document in documents:
+                count[0] += 1
+                yield self.dictionary.doc2bow(document, allow_update=True)
+
+        name = 'corpus-%05d.mm' % len(self.parts)
+        corpora.MmCorpus.serialize(os.path.join(self.corpus_dir, name),
+                                   bags_of_words())
+        dictionary_path = os.path.join(self.corpus_dir,
+                                       self.DICTIONARY_NAME)
+        self.dictionary.save(dictionary_path + '.tmp')
+        os.rename(dictionary_path + '.tmp', dictionary_path)
+        # Last, so that the part only counts once all of it is saved
+        self.state.add_part(name, count[0], ranges)
+        self.state.save()
+        LOG.info("Added %d documents from %d sources to %s", count[0],
+                 len(ranges), name)
+        return count[0]
+
+    def update_from_manifest(self, outdir):
+        ''' Add the statuses of the closed segments in the daemon's output
+        directory which are not in the corpus yet
+        '''
+        return self.update([os.path.join(outdir, entry["segment"])
+                            for entry in read_manifest(outdir)])
+
+    def corpus(self, first_part=0):
+        ''' Get the documents of the parts from first_part on, streamed
+        from disk
+        '''
+        return itertools.chain.from_iterable(
+            corpora.MmCorpus(os.path.join(self.corpus_dir, part["name"]))
+            for part in self.parts[first_part:])
+
+    def train(self, num_topics=50, workers=None, passes=1, chunksize=10000,
+              no_below=5, no_above=0.5, keep_n=100000):
+        ''' Fit an LDA model to the whole corpus, in workers processes,
+        leaving out the words in fewer than no_below documents or in more
+        than a no_above fraction of them, and keeping at most keep_n
+        '''
+        id2word = copy.deepcopy(self.dictionary)
+        id2word.filter_extremes(no_below, no_above, keep_n)
+        corpus = ChainedCorpus(self, 0, id2word)
+        LOG.info("Training %d topics over %d documents and %d words",
+                 num_topics, len(self), len(id2word))
+        return models.LdaMulticore(corpus, num_topics=num_topics,
+                                   id2word=id2word, workers=workers,
+                                   passes=passes, chunksize=chunksize)
+
+    def update_model(self, lda, first_part):
+        ''' Update an LDA model (from train()) with the documents of the
+        parts from first_part on. Words the model does not know are left
+        out
+        '''
+        lda.update(ChainedCorpus(self, first_part, lda.id2word))
+        return lda
+
+
+class ChainedCorpus(object):
+    ''' The parts of a TopicCorpus from first_part on, with the word ids of
+    id2word (a filtered copy of its dictionary), re-read from disk on
+    every pass
+    '''
+
+    def __init__(self, topic_corpus, first_part, id2word):
+        self.topic_corpus = topic_corpus
+        self.first_part = first_part
+        token2id = topic_corpus.dictionary.token2id
+        self.mapping = dict((token2id[token], word_id)
+                            for (token, word_id) in id2word.token2id.items()
+                            if token in token2id)
+
+    def __len__(self):
+        return sum(part["documents"]
+                   for part in self.topic_corpus.parts[self.first_part:])
+
+    def __iter__(self):
+        return iter(RemappedCorpus(
+            self.topic_corpus.corpus(self.first_part), self.mapping))
@@ -0,0 +1,444 @@
+""" Detection of trending hashtags and words, as statuses arrive.
+
+A TrendDetector counts the terms of statuses (hashtags, and the words
+the Tokenizer keeps) in time buckets, e.g. of 5 minutes, held in a ring:
+the last window buckets are the current window, and the baseline
+buckets before them are what the terms are compared with. Each bucket
+has
+    - a Count-Min sketch: a depth x width table of counts, each term
+    adding to one cell per row (picked by a hash of the term), its count
+    being the least of those cells. Estimates can only be too high, by
+    at most about e / width of the bucket's total, with probability
+    1 - e^-depth
+    - a Space-Saving summary of its capacity most frequent terms, which
+    names the candidates to score (a sketch can count terms, not list
+    them)
+so memory is fixed however many distinct terms are seen. The sketch
+tables of the window and of the baseline are also kept summed, so
+scoring a term is two lookups.
+
+A term trends when its count in the window is at least min_count and
+departs from what its baseline predicts (its mean per bucket, times the
+window) by a Poisson z-score of at least threshold.
+
+The detector can be fed decoded statuses (add_status(), e.g. from the
+daemon's write path) or the DataFrames of an analysis.follow.Follower,
+as an aggregator. Statuses are bucketed by when they were created, not
+when they arrive (a backfill's may be hours old), so those without a
+creation time are skipped rather than counted now.
+"""
+import collections
+import hashlib
+import heapq
+import json
+import os
+import threading
+import time
+import numpy as np
+import pandas as pd
+import logging
+
+from analysis.datafetch.metrics import parse_created_at
+from analysis.rollup import to_seconds, RE_HASHTAG
+from analysis.tokenizer import Tokenizer
+
+LOG = logging.getLogger(__name__)
+
+
+def term_hashes(terms):
+    ''' Get two 64 bit hashes of each term, as an (n, 2) array
+    '''
+    digests = b''.join(hashlib.md5(term.encode('utf-8')).digest()
+                       for term in terms)
+    return np.frombuffer(digests, dtype=np.uint64).reshape(-1, 2)
+
+
+class CountMinSketch(object):
+    ''' Approximate counts of terms, in a depth x width table
+    '''
+
+    def __init__(self, width=2 ** 14, depth=4):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.int64)
+
+    def cells(self, terms):
+        ''' Get the flat index in the table of the cell of each term in
+        each row, as a (depth, n) array. The row hashes are h1 + i * h2
+        '''
+        hashes = term_hashes(terms)
+        rows = np.arange(self.depth, dtype=np.uint64)[:, None]
+        columns = (hashes[:, 0][None, :] + rows * hashes[:, 1][None, :]) \
+            % np.uint64(self.width)
+        return (rows * np.uint64(self.width) + columns).astype(np.intp)
+
+    def add(self, terms, counts=None, tables=()):
+        ''' Count terms (each once, or counts times), in the table and in
+        any other tables of the same shape
+        '''
+        if not len(terms):
+            return
+        counts = np.ones(len(terms), dtype=np.int64) if counts is None \
+            else np.asarray(counts, dtype=np.int64)
+        cells = self.cells(terms).ravel()
+        counts = np.tile(counts, self.depth)
+        for table in [self.table] + list(tables):
+            np.add.at(table.ravel(), cells, counts)
+
+    def estimate(self, terms, table=None):
+        ''' Get the estimated count of each term (in table, if given: a
+        sum of the tables of sketches of the same shape)
+        '''
+        if not len(terms):
+            return np.zeros(0, dtype=np.int64)
+        table = table if table is not None else self.table
+        return table.ravel()[self.cells(terms)].min(axis=0)
+
+    def clear(self):
+        self.table.fill(0)
+
+
+class SpaceSaving(object):
+    ''' The (at most) capacity most frequent terms, with their counts.
+    When full, a new term replaces the least counted one, taking over its
+    count (so counts can only be too high, by at most that count, kept as
+    the term's error)
+    '''
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.clear()
+
+    def clear(self):
+        self.counts = {}
+        self.errors = {}
+        self._heap = []
+
+    def __len__(self):
+        return len(self.counts)
+
+    def _pop_least(self):
+        ''' Remove the least counted term. The heap may hold stale
+        entries, of terms counted again since, which are skipped
+        '''
+        while True:
+            (count, term) = heapq.heappop(self._heap)
+            if self.counts.get(term) == count:
+                del self.counts[term]
+                del self.errors[term]
+                return count
+
+    def add(self, term, count=1):
+        if term in self.counts:
+            self.counts[term] += count
+        else:
+            error = self._pop_least() if len(self.counts) >= self.capacity \
+                else 0
+            self.counts[term] = error + count
+            self.errors[term] = error
+        heapq.heappush(self._heap, (self.counts[term], term))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(count, term)
+                          for (term, count) in self.counts.items()]
+            heapq.heapify(self._heap)
+
+    def update(self, counts):
+        for (term, count) in counts.items():
+            self.add(term, count)
+
+    def top(self, n=None):
+        ''' Get the (term, count) of the n most counted terms
+        '''
+        items = sorted(self.counts.items(), key=lambda item: -item[1])
+        return items[:n] if n is not None else items
+
+
+class TrendDetector(object):
+    ''' Flags the terms whose count in the last window buckets (of
+    bucket_seconds) departs from that of the baseline buckets before them
+    '''
+
+    def __init__(self, bucket_seconds=300, window=1, baseline=12,
+                 width=2 ** 14, depth=4, capacity=1000, min_count=5,
+                 threshold=3.0, tokenizer=None, clock=time.time):
+        self.bucket_seconds = bucket_seconds
+        self.window = window
+        self.baseline = baseline
+        self.width = width
+        self.depth = depth
+        self.capacity = capacity
+        self.min_count = min_count
+        self.threshold = threshold
+        self.tokenizer = tokenizer if tokenizer is not None else Tokenizer()
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        size = self.window + self.baseline
+        self.sketches = [CountMinSketch(self.width, self.depth)
+                         for _ in range(size)]
+        self.summaries = [SpaceSaving(self.capacity) for _ in range(size)]
+        self.window_table = np.zeros((self.depth, self.width),
+                                     dtype=np.int64)
+        self.baseline_table = np.zeros((self.depth, self.width),
+                                       dtype=np.int64)
+        # Number of the current and first buckets (since the epoch), or
+        # None before the first term
+        self.bucket = None
+        self.first_bucket = None
+        self.statuses = 0
+        self.undated = 0
+
+    def slot(self, age):
+        ''' Get the ring slot of the bucket age buckets before the current
+        one
+        '''
+        return (self.bucket - age) % len(self.sketches)
+
+    def advance(self, timestamp):
+        ''' Move on to the bucket of timestamp (seconds since the epoch),
+        if later than the current one. Returns the slot to count in
+        '''
+        bucket = int(timestamp // self.bucket_seconds)
+        if self.bucket is None:
+            (self.bucket, self.first_bucket) = (bucket, bucket)
+        steps = min(bucket - self.bucket, len(self.sketches))
+        for _ in range(max(steps, 0)):
+            # The oldest window bucket joins the baseline, and the oldest
+            # baseline bucket is cleared, to become the new current one
+            moving = self.sketches[self.slot(self.window - 1)].table
+            self.window_table -= moving
+            self.baseline_table += moving
+            oldest = self.slot(len(self.sketches) - 1)
+            self.baseline_table -= self.sketches[oldest].table
+            self.sketches[oldest].clear()
+            self.summaries[oldest].clear()
+            self.bucket += 1
+        if bucket > self.bucket:
+            self.bucket = bucket
+        return self.slot(0)
+
+    def add_terms(self, counts, timestamp=None):
+        ''' Count terms (a dict of term to count) at timestamp (by
+        default, now)
+        '''
+        timestamp = timestamp if timestamp is not None else self.clock()
+        with self._lock:
+            slot = self.advance(timestamp)
+            if not counts:
+                return
+            terms = list(counts.keys())
+            values = np.array([counts[term] for term in terms],
+                              dtype=np.int64)
+            self.sketches[slot].add(terms, values, [self.window_table])
+            self.summaries[slot].update(counts)
+
+    def status_terms(self, texts):
+        ''' Count the hashtags (as '#tag', lower cased) and words of a
+        batch of texts
+        '''
+        counts = collections.Counter()
+        for text in texts:
+            if text and u'#' in text:
+                counts.update(u'#' + tag.lower()
+                              for tag in RE_HASHTAG.findall(text))
+        counts.update(self.tokenizer.count(texts))
+        return counts
+
+    def add_status(self, status, timestamp=None):
+        ''' Count the terms of a decoded status at timestamp, if given, or
+        else its timestamp_ms (as from the stream) or created_at. A status
+        with neither is skipped
+        '''
+        if not isinstance(status, dict) or "text" not in status:
+            return
+        if timestamp is None and "timestamp_ms" in status:
+            try:
+                timestamp = int(status["timestamp_ms"]) / 1000.0
+            except (ValueError, TypeError):
+                pass
+        if timestamp is None and "created_at" in status:
+            try:
+                timestamp = parse_created_at(status["created_at"])
+            except (ValueError, TypeError):
+                pass
+        if timestamp is None:
+            self.undated += 1
+            return
+        self.statuses += 1
+        self.add_terms(self.status_terms([status["text"]]), timestamp)
+
+    def update(self, dataframe):
+        ''' Count the terms of the statuses of a DataFrame from the
+        Processor, bucket by bucket of their creation time (skipping
+        those without one)
+        '''
+        texts = dataframe["status"].values
+        seconds = to_seconds(dataframe["created_at"])
+        valid = dataframe["created_at"].notnull().values
+        buckets = seconds[valid] // self.bucket_seconds
+        texts = texts[valid]
+        self.statuses += int(valid.sum())
+        self.undated += len(dataframe) - int(valid.sum())
+        for bucket in np.unique(buckets):
+            rows = buckets == bucket
+            self.add_terms(self.status_terms(texts[rows]),
+                           bucket * self.bucket_seconds)
+
+    def baseline_buckets(self):
+        ''' Get the number of baseline buckets since the first term
+        '''
+        return min(self.baseline, max(
+            0, self.bucket - self.first_bucket - self.window + 1))
+
+    def candidates(self):
+        ''' Get the terms in the summaries of the window buckets
+        '''
+        terms = set()
+        for age in range(self.window):
+            terms.update(self.summaries[self.slot(age)].counts)
+        return sorted(terms)
+
+    def trends(self, n=None, timestamp=None):
+        ''' Get the trending terms (at timestamp, if given: buckets which
+        have ended by then are moved on first), as a DataFrame of the
+        term, its count in the window, its expected count and its score,
+        highest score first
+        '''
+        columns = ["term", "count", "expected", "score"]
+        with self._lock:
+            if self.bucket is None:
+                return pd.DataFrame(columns=columns)
+            if timestamp is not None:
+                self.advance(timestamp)
+            filled = self.baseline_buckets()
+            if not filled:
+                # Nothing to compare with yet
+                return pd.DataFrame(columns=columns)
+            terms = self.candidates()
+            sketch = self.sketches[0]
+            counts = sketch.estimate(terms, self.window_table)
+            baseline = sketch.estimate(terms, self.baseline_table)
+        expected = baseline * float(self.window) / filled
+        scores = (counts - expected) / np.sqrt(expected + 1)
+        trending = (counts >= self.min_count) & (scores >= self.threshold)
+        result = pd.DataFrame({
+            "term": np.array(terms, dtype=object)[trending]
+            if len(terms) else np.zeros(0, dtype=object),
+            "count": counts[trending],
+            "expected": expected[trending],
+            "score": scores[trending],
+        }, columns=columns)
+        result = result.sort_values("score", ascending=False) \
+            if hasattr(result, "sort_values") else \
+            result.sort("score", ascending=False)
+        result = result.reset_index(drop=True)
+        return result[:n] if n is not None else result
+
+    def get_state(self):
+        with self._lock:
+            sketches = []
+            for sketch in self.sketches:
+                cells = np.flatnonzero(sketch.table)
+                sketches.append({
+                    "cells": cells.tolist(),
+                    "counts": sketch.table.ravel()[cells].tolist(),
+                })
+            return {
+                "bucket_seconds": self.bucket_seconds,
+                "bucket": self.bucket,
+                "first_bucket": self.first_bucket,
+                "statuses": self.statuses,
+                "sketches": sketches,
+                "summaries": [{"counts": summary.counts,
+                               "errors": summary.errors}
+                              for summary in self.summaries],
+            }
+
+    def set_state(self, state):
+        if state["bucket_seconds"] != self.bucket_seconds or \
+                len(state["sketches"]) != len(self.sketches):
+            LOG.warn("Trend state saved with other buckets; starting over")
+            self.reset()
+            return
+        with self._lock:
+            self.bucket = state["bucket"]
+            self.first_bucket = state["first_bucket"]
+            self.statuses = state["statuses"]
+            for (sketch, saved) in zip(self.sketches, state["sketches"]):
+                sketch.clear()
+                sketch.table.ravel()[saved["cells"]] = saved["counts"]
+            for (summary, saved) in zip(self.summaries, state["summaries"]):
+                summary.clear()
+                summary.counts = dict(saved["counts"])
+                summary.errors = dict(saved["errors"])
+                summary._heap = [(count, term) for (term, count)
+                                 in summary.counts.items()]
+                heapq.heapify(summary._heap)
+            self.window_table.fill(0)
+            self.baseline_table.fill(0)
+            if self.bucket is not None:
+                for age in range(len(self.sketches)):
+                    table = self.sketches[self.slot(age)].table
+                    if age < self.window:
+                        self.window_table += table
+                    else:
+                        self.baseline_table += table
+
+
+class TrendsReporter(object):
+    ''' Every interval seconds, appends the current trends of a
+    TrendDetector to a file, as a line of JSON, rolled over to path.1 at
+    max_bytes
+    '''
+
+    def __init__(self, detector, path, interval=60, n=20,
+                 max_bytes=16 * 1024 * 1024, clock=time.time):
+        self.detector = detector
+        self.path = path
+        self.interval = interval
+        self.n = n
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def report(self):
+        now = self.clock()
+        trends = self.detector.trends(self.n, now)
+        values = {
+            "time": now,
+            "trends": [{"term": row["term"],
+                        "count": int(row["count"]),
+                        "expected": float(row["expected"]),
+                        "score": float(row["score"])}
+                       for (_, row) in trends.iterrows()],
+        }
+        if os.path.exists(self.path) and \
+                os.path.getsize(self.path) >= self.max_bytes:
+            os.rename(self.path, self.path + '.1')
+        with open(self.path, "a") as trends_file:
+            trends_file.write(json.dumps(values, sort_keys=True) + '\n')
+        return values
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.report()
+            except Exception:
+                LOG.exception("Unable to report trends")
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name='trends')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        ''' Stop reporting, after a last report
+        '''
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.report()
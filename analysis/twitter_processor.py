@@ -1,78 +1,447 @@
 """ Utility Class/es for doing post-processing on twitter data we collect
 """
+import itertools
 import json
+import multiprocessing
+import os
+import re
 import pandas as pd
 import numpy as np
 import logging
 
+from analysis.geofence import status_coordinates
+
 LOG = logging.getLogger(__name__)
 
+# JSON backends, fastest first
+JSON_BACKENDS = ["ujson", "simplejson", "json"]
+
+# Fields of a status used for the rows of the results DataFrame, e.g.
+# for Processor(Decoder(fields=ROW_FIELDS))
+ROW_FIELDS = ["id", "text", "user.screen_name", "created_at", "geo",
+              "coordinates"]
+
+
+def load_json_backend(name=None):
+    '''Import a JSON module by name, or the fastest one installed
+    '''
+    for backend in [name] if name is not None else JSON_BACKENDS:
+        try:
+            return __import__(backend)
+        except ImportError:
+            if name is not None:
+                raise
+    return json
+
+
+class Decoder(object):
+    '''Decodes a results line into a status dict, with the JSON backend
+    (by default, the fastest installed).
+
+    If fields (a list of dotted paths, e.g. "user.screen_name") is given,
+    only those fields are kept, in a dict of the same shape as the
+    status. The line's top level keys are then walked in order, and
+    decoding stops as soon as every field has been seen, so the bulk of
+    a status written in the API's key order (entities, retweeted_status,
+    place...) is never decoded. So that damaged lines are still errors,
+    as they would be decoded in full, the rest of the line is only checked
+    to end with a closing brace and to balance its braces. A line without
+    all the fields (e.g. a limit notice), or whose braces do not balance
+    (e.g. truncated, or with a stray brace in a string), is decoded in
+    full instead.
+    '''
+
+    # The first key of an object, and each key after a value
+    RE_FIRST_KEY = re.compile(r'\s*\{\s*"([^"\\]*)"\s*:\s*')
+    RE_NEXT_KEY = re.compile(r'\s*,\s*"([^"\\]*)"\s*:\s*')
+    RE_END = re.compile(r'\s*\}')
+
+    def __init__(self, backend=None, fields=None):
+        self.backend = load_json_backend(backend)
+        self.loads = self.backend.loads
+        self.fields = list(fields) if fields is not None else None
+        if self.fields is not None:
+            self.paths = [field.split(".") for field in self.fields]
+            self.top_keys = frozenset(path[0] for path in self.paths)
+        self.raw_decode = json.JSONDecoder().raw_decode
+        self.fallbacks = 0
+
+    def decode(self, line):
+        '''Decode a line. Raises ValueError if it is not valid JSON
+        '''
+        if self.fields is None:
+            return self.loads(line)
+        values = self.decode_fields(line) if self.well_formed(line) \
+            else None
+        if values is None:
+            self.fallbacks += 1
+            values = self.loads(line)
+            if not isinstance(values, dict) or \
+                    not self.top_keys.issubset(values):
+                # Not a status: keep it whole
+                return values
+        return self.project(values)
+
+    def well_formed(self, line):
+        '''Cheaply check that a line could be a whole JSON object: that it
+        ends with a closing brace, and has as many of them as opening ones
+        '''
+        end = len(line)
+        while end and line[end - 1] in ' \t\r\n':
+            end -= 1
+        return end > 0 and line[end - 1] == '}' and \
+            line.count('{') == line.count('}')
+
+    def decode_fields(self, line):
+        '''Decode the top level values of a JSON object line until all of
+        the fields' keys have been seen. Returns them in a dict, or None if
+        the object ends first (or the line is not an object)
+        '''
+        raw_decode = self.raw_decode
+        next_key = self.RE_NEXT_KEY.match
+        remaining = set(self.top_keys)
+        values = {}
+        key_match = self.RE_FIRST_KEY.match(line)
+        while key_match is not None:
+            key = key_match.group(1)
+            (value, pos) = raw_decode(line, key_match.end())
+            if key in remaining:
+                values[key] = value
+                remaining.discard(key)
+                if not remaining:
+                    return values
+            key_match = next_key(line, pos)
+        if remaining and values and \
+                self.RE_END.match(line, pos) is None:
+            raise ValueError("Expecting , or } at %d" % pos)
+        return None
+
+    def project(self, values):
+        '''Keep just the requested fields of a decoded status
+        '''
+        result = {}
+        for path in self.paths:
+            value = values.get(path[0])
+            if len(path) == 1:
+                result[path[0]] = value
+                continue
+            for key in path[1:]:
+                value = value.get(key) if isinstance(value, dict) else None
+            set_field(result, ".".join(path), value)
+        return result
+
+
+def set_field(result, field, value):
+    '''Set a dotted field in a nested dict
+    '''
+    keys = field.split(".")
+    for key in keys[:-1]:
+        result = result.setdefault(key, {})
+    result[keys[-1]] = value
+
+
+# Columns of the results DataFrame, in order
+COLUMNS = ["created_at", "id", "latitude", "longitude", "status", "user"]
+
+DEFAULT_CHUNK_SIZE = 100000
+
+
+class ColumnBuffers(object):
+    '''Typed buffers for the columns of one chunk of up to size rows, so
+    that no dict (or DataFrame row) is made per status
+    '''
+
+    def __init__(self, size=DEFAULT_CHUNK_SIZE):
+        self.size = size
+        self.count = 0
+        self.ids = np.empty(size, dtype=np.int64)
+        self.latitudes = np.empty(size, dtype=np.float32)
+        self.longitudes = np.empty(size, dtype=np.float32)
+        self.statuses = []
+        self.users = []
+        self.created_ats = []
+
+    def __len__(self):
+        return self.count
+
+    def full(self):
+        return self.count >= self.size
+
+    def append(self, result):
+        '''Append the fields of a status. Returns False, appending
+        nothing, for any other message (e.g. a limit notice)
+        '''
+        try:
+            tid = result["id"]
+            text = result["text"]
+            user = "@" + result["user"]["screen_name"]
+            created_at = result["created_at"]
+        except (KeyError, TypeError):
+            return False
+        try:
+            (lon, lat) = status_coordinates(result) or (np.nan, np.nan)
+        except (AttributeError, TypeError, ValueError):
+            (lon, lat) = (np.nan, np.nan)
+
+        i = self.count
+        self.ids[i] = tid
+        self.latitudes[i] = lat
+        self.longitudes[i] = lon
+        self.statuses.append(text)
+        self.users.append(user)
+        self.created_ats.append(created_at)
+        self.count += 1
+        return True
+
+    def columns(self):
+        '''Get the buffered rows as a dict of column arrays
+        '''
+        count = self.count
+        return {
+            "created_at": np.array(self.created_ats, dtype=object),
+            "id": self.ids[:count].copy(),
+            "latitude": self.latitudes[:count].copy(),
+            "longitude": self.longitudes[:count].copy(),
+            "status": np.array(self.statuses, dtype=object),
+            "user": np.array(self.users, dtype=object),
+        }
+
+
+# Twitter's created_at, e.g. "Thu Jan 01 00:00:00 +0000 2015": its
+# fixed characters and the positions of its fields
+CREATED_AT_TEMPLATE = "Www Mmm DD HH:MM:SS +0000 YYYY"
+CREATED_AT_FIXED = [(3, " "), (7, " "), (10, " "), (13, ":"), (16, ":"),
+                    (19, " "), (20, "+"), (21, "0"), (22, "0"), (23, "0"),
+                    (24, "0"), (25, " ")]
+MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun",
+          "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+
+def parse_created_at(values):
+    '''Parse an array of created_at strings to datetime64[ns] (UTC) in one
+    vectorized pass over their characters, rather than a strptime per
+    row. Values not in Twitter's format become NaT
+    '''
+    width = len(CREATED_AT_TEMPLATE)
+    values = np.asarray(values, dtype=object)
+    if len(values) == 0:
+        return np.zeros(0, dtype="datetime64[ns]")
+    chars = np.array(values.tolist(), dtype="U%d" % (width + 1))
+    chars = chars.view(np.uint32).reshape(len(values), width + 1)
+
+    valid = chars[:, width] == 0
+    for (i, char) in CREATED_AT_FIXED:
+        valid &= chars[:, i] == ord(char)
+
+    def number(start, stop):
+        digits = chars[:, start:stop].astype(np.int64) - ord("0")
+        valid[:] &= ((digits >= 0) & (digits <= 9)).all(axis=1)
+        result = np.zeros(len(values), dtype=np.int64)
+        for i in range(stop - start):
+            result = result * 10 + digits[:, i]
+        return result
+
+    year = number(26, 30)
+    day = number(8, 10)
+    seconds = number(11, 13) * 3600 + number(14, 16) * 60 + number(17, 19)
+    month_codes = (chars[:, 4].astype(np.int64) << 16) | \
+        (chars[:, 5].astype(np.int64) << 8) | chars[:, 6]
+    codes = np.array([(ord(name[0]) << 16) | (ord(name[1]) << 8) |
+                      ord(name[2]) for name in MONTHS], dtype=np.int64)
+    order = np.argsort(codes)
+    found = np.searchsorted(codes[order], month_codes).clip(0, 11)
+    valid &= codes[order][found] == month_codes
+    valid &= (day >= 1) & (day <= 31)
+    month = order[found]
+
+    months = ((year - 1970) * 12 + month).astype("datetime64[M]")
+    result = months.astype("datetime64[D]") + (day - 1).astype(
+        "timedelta64[D]")
+    result = result.astype("datetime64[s]") + seconds.astype(
+        "timedelta64[s]")
+    result = result.astype("datetime64[ns]")
+    result[~valid] = np.datetime64("NaT")
+    return result
+
+
+def typed_frame(data):
+    '''Make the results DataFrame from a dict of column arrays, with its
+    compact types: int64 id, datetime64 created_at, categorical user and
+    float32 latitude and longitude
+    '''
+    data = dict(data)
+    data["id"] = np.asarray(data["id"], dtype=np.int64)
+    if data["created_at"].dtype == object:
+        data["created_at"] = parse_created_at(data["created_at"])
+    data["user"] = pd.Categorical(data["user"])
+    for name in ("latitude", "longitude"):
+        data[name] = np.asarray(data[name], dtype=np.float32)
+    return pd.DataFrame(data, columns=COLUMNS)
+
+
+def concat_columns(chunks):
+    '''Join a list of dicts of column arrays into one (typed) DataFrame,
+    one column at a time
+    '''
+    if not chunks:
+        chunks = [ColumnBuffers(0).columns()]
+    data = {}
+    for name in COLUMNS:
+        data[name] = np.concatenate([chunk[name] for chunk in chunks])
+    return typed_frame(data)
+
+
+def drop_seen(columns, seen_index):
+    '''Get the columns less the rows whose id seen_index has seen, adding
+    the new ids to it
+    '''
+    is_new = seen_index.add_many(columns["id"])
+    return dict((name, values[is_new]) for (name, values) in columns.items())
+
+
+def newline_ranges(path, count, start=0, end=None):
+    '''Split a file (or the part of it from start, a line start, to end)
+    into up to count (start, end) byte ranges of about the same size,
+    each starting at the start of a line
+    '''
+    end = end if end is not None else os.path.getsize(path)
+    starts = [start]
+    with open(path, "rb") as results_file:
+        for i in range(1, count):
+            results_file.seek(start + (end - start) * i // count)
+            results_file.readline()
+            offset = results_file.tell()
+            if starts[-1] < offset < end:
+                starts.append(offset)
+    return list(zip(starts, starts[1:] + [end]))
+
+
+class RangeReader(object):
+    '''Reads the lines of a file which start before the end offset
+    '''
+
+    def __init__(self, fp, end):
+        self.fp = fp
+        self.end = end
+
+    def readline(self):
+        if self.fp.tell() >= self.end:
+            return ""
+        return self.fp.readline()
+
+
+def parse_range(args):
+    '''Parse the statuses in a byte range of a results file into columns
+    (run in a worker process). Returns the columns and the counts of
+    lines read, errors and skipped messages
+    '''
+    (path, start, end, backend, fields) = args
+    processor = Processor(Decoder(backend, fields))
+    with open(path, "r") as results_file:
+        results_file.seek(start)
+        reader = RangeReader(results_file, end)
+        chunks = list(processor.iter_column_chunks(reader, None,
+                                                   DEFAULT_CHUNK_SIZE))
+    if chunks:
+        columns = dict((name, np.concatenate([chunk[name]
+                                              for chunk in chunks]))
+                       for name in COLUMNS)
+    else:
+        columns = ColumnBuffers(0).columns()
+    return (columns, processor.lines_read, processor.errors,
+            processor.skipped)
+
 
 class Processor(object):
     '''Post Processing for twitter results.
     '''
 
-    def __init__(self):
-        pass
+    def __init__(self, decoder=None):
+        # e.g. Decoder(fields=ROW_FIELDS), to decode only the fields
+        # make_df needs
+        self.decoder = decoder if decoder is not None else Decoder()
+        # Counts for the last file read
+        self.lines_read = 0
+        self.errors = 0
+        self.skipped = 0
 
     def simple_results_iterator(self, fp, max=1000):
         '''A generator for iterating through the twitter results file.
-        By default, iterates only through first 1000 valid lines
+        By default, iterates only through first 1000 lines, or the whole
+        file if max is None. fp may also be an
+        analysis.line_reader.LineReader, whose lines are read from the
+        memory mapped file (each still copied once, for the decoder).
         if file contains an error, fails silently, but logs an error
         '''
         lines = 0
-        errors = 0
-        while lines < max:
-
-            try:
-                next_line = fp.readline()
-                lines += 1
-            except:
-                errors += 1
-                LOG.exception("Error reading file")
-                continue
-
-            if next_line is None:
-                LOG.error("Unexpected file truncation at line %d", lines)
-                break
+        self.lines_read = 0
+        self.errors = 0
+        if hasattr(fp, "iter_lines"):
+            next_lines = (line.tobytes() for line in fp.iter_lines(0, max))
+        else:
+            next_lines = itertools.islice(self.read_lines(fp), max)
+        for next_line in next_lines:
+            lines += 1
+            self.lines_read = lines
 
             next_line = next_line.strip()
 
             if next_line == "":
-                errors += 1
+                self.errors += 1
                 LOG.warn("Skipping empty line at %d", lines)
                 continue
 
             try:
-                result = json.loads(next_line)
-                yield result
+                result = self.decoder.decode(next_line)
             except ValueError:
-                errors += 1
+                self.errors += 1
                 LOG.warn("Unable to parse Line %d: %s", lines, next_line)
                 continue
             except:
-                errors += 1
+                self.errors += 1
                 LOG.exception("Error reading JSON")
                 continue
+            yield result
 
-        LOG.error("Encountered %d errors while reading " +
-                  "twitter results", errors)
+        if self.errors:
+            LOG.error("Encountered %d errors while reading " +
+                      "twitter results", self.errors)
 
-    def make_result_rows(self, fp, results_iterator, max_rows):
+    def read_lines(self, fp):
+        '''A generator of the lines of fp, until its end or a read error
+        '''
+        while True:
+            try:
+                next_line = fp.readline()
+            except:
+                self.errors += 1
+                LOG.exception("Error reading file")
+                break
+
+            if next_line == "":
+                # End of file
+                break
+            yield next_line
+
+    def make_result_rows(self, fp, results_iterator, max_rows,
+                         seen_index=None):
         '''A generator to yield dicts as rows as input to the DataFrame constructor
 
         this is a helper function to quickly build a dataframe from a
         results file of twitter searches encoded in JSON.
+        If seen_index (an analysis.dedup.SeenIndex) is given, tweets
+        whose id it has already seen are skipped, and new ids are added.
+        Messages without an id (e.g. limit notices) are skipped.
         '''
         for result in results_iterator(fp, max_rows):
+            if result.get("id") is None:
+                continue
+            if seen_index is not None and not seen_index.add(result["id"]):
+                continue
             text = result["text"]
             # print(text)
             # print(r["geo"])
-            if "geo" in result and result["geo"] is None:
-                (xlon, ylat) = (np.nan, np.nan)
-            else:
-                xlon = result["geo"]["coordinates"][0]
-                ylat = result["geo"]["coordinates"][1]
+            (lon, lat) = status_coordinates(result) or (np.nan, np.nan)
             created_at = result["created_at"]
             tid = result["id"]
             user = "@" + result["user"]["screen_name"]
@@ -82,19 +451,104 @@ class Processor(object):
                 "status": text,
                 "user": user,
                 "created_at": created_at,
-                "latitude": xlon,
-                "longitude": ylat,
+                "latitude": lat,
+                "longitude": lon,
             }
 
             yield d_row
 
-    def make_df(self, results_file, max_rows=1000):
-        '''Make dataframe from results file
+    def iter_column_chunks(self, fp, max_rows=None,
+                           chunk_size=DEFAULT_CHUNK_SIZE, seen_index=None):
+        '''A generator of dicts of column arrays, for up to chunk_size
+        statuses each, from the first max_rows lines of fp (or all of it,
+        if max_rows is None). Messages which are not statuses are skipped
+        '''
+        self.skipped = 0
+        buffers = ColumnBuffers(chunk_size)
+        for result in self.simple_results_iterator(fp, max_rows):
+            if not buffers.append(result):
+                self.skipped += 1
+                continue
+            if buffers.full():
+                yield self.finish_chunk(buffers, seen_index)
+                buffers = ColumnBuffers(chunk_size)
+        if len(buffers):
+            yield self.finish_chunk(buffers, seen_index)
+
+    def finish_chunk(self, buffers, seen_index=None):
+        '''Get the columns of a chunk, less the tweets in seen_index
+        '''
+        columns = buffers.columns()
+        if seen_index is not None:
+            columns = drop_seen(columns, seen_index)
+        return columns
+
+    def iter_parallel_column_chunks(self, path, processes=None,
+                                    seen_index=None, start=0, end=None):
+        '''A generator of dicts of column arrays, one per byte range of
+        the file at path (or of its bytes from start to end), parsed in a
+        pool of processes (by default, one per CPU) and yielded in file
+        order. The counts of lines read, errors and skipped messages are
+        totalled over the ranges, so they are the same as reading the file
+        in one go
         '''
+        processes = processes or multiprocessing.cpu_count()
+        # A few ranges per process, so that one slow range does not hold
+        # up the rest
+        ranges = newline_ranges(path, processes * 4, start, end)
+        tasks = [(path, start, end, self.decoder.backend.__name__,
+                  self.decoder.fields)
+                 for (start, end) in ranges]
+        (self.lines_read, self.errors, self.skipped) = (0, 0, 0)
+        pool = multiprocessing.Pool(processes)
         try:
-            dataframe = pd.DataFrame(self.make_result_rows(results_file,
-                                                           self.simple_results_iterator,
-                                                           max_rows))
+            for (columns, lines_read, errors, skipped) in \
+                    pool.imap(parse_range, tasks):
+                self.lines_read += lines_read
+                self.errors += errors
+                self.skipped += skipped
+                if seen_index is not None:
+                    columns = drop_seen(columns, seen_index)
+                yield columns
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def iter_df_chunks(self, results_file, max_rows=None,
+                       chunk_size=DEFAULT_CHUNK_SIZE, seen_index=None):
+        '''A generator of DataFrames of up to chunk_size rows each, to
+        work through a file too big for one DataFrame
+        '''
+        for columns in self.iter_column_chunks(results_file, max_rows,
+                                               chunk_size, seen_index):
+            yield typed_frame(columns)
+
+    def make_df(self, results_file, max_rows=1000, seen_index=None,
+                chunk_size=DEFAULT_CHUNK_SIZE, processes=None, cache=None):
+        '''Make dataframe from results file, from its first max_rows
+        lines, or the whole file if max_rows is None. Pass the same
+        seen_index when combining several files (e.g. stream and search
+        output) to keep only one copy of each tweet.
+        With processes (and max_rows None), the file (a path, or a file
+        opened from one) is parsed in that many processes.
+        With a cache (an analysis.table_cache.TableCache, and max_rows
+        None), the table is loaded from the cache, parsing only the lines
+        added to the file since it was cached.
+        '''
+        try:
+            path = getattr(results_file, "name", results_file)
+            if cache is not None and max_rows is None:
+                chunks = cache.load_chunks(path, self, processes)
+                if seen_index is not None:
+                    chunks = [drop_seen(chunk, seen_index)
+                              for chunk in chunks]
+            elif processes is not None and max_rows is None:
+                chunks = self.iter_parallel_column_chunks(path, processes,
+                                                          seen_index)
+            else:
+                chunks = self.iter_column_chunks(results_file, max_rows,
+                                                 chunk_size, seen_index)
+            dataframe = concat_columns(list(chunks))
         except:
             LOG.exception("Error creating dataframe")
             return None
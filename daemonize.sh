@@ -1,3 +1,3 @@
 #!/bin/sh
 cd /usr/share/northants/
-nohup nice /usr/share/northants/twitterd.py start --outdir /usr/share/northants/twout/ --cmd stream_filter --max-time 259200 --settings /usr/share/northants/.twitter_api_keys.json &
+nohup nice /usr/share/northants/twitterd.py start --outdir /usr/share/northants/twout/ --cmd stream_filter --max-time 259200 --native --pidfile /usr/share/northants/twout/twitterd.pid --metrics-port 9410 --stats-file /usr/share/northants/twout/twitterd_stats.jsonl --settings /usr/share/northants/.twitter_api_keys.json &
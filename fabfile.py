@@ -117,7 +117,9 @@ def push_sources():
 def fetch_stop():
     """ Stop data fetching
     """
-    pass
+    with cd(env.code_dir):
+        run("sudo ./twitterd.py stop --pidfile %s" %
+            '/'.join([env.code_dir, 'twout', 'twitterd.pid']))
 
 def install_dependencies():
     """ Install the python dependencies we need
@@ -0,0 +1,134 @@
+import unittest
+import logging
+import logging.config
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+from analysis.areas import AreaIndex, NO_AREA
+from analysis.geofence import PolygonGrid, shapefile
+
+D_LOG = {
+    'version': 1,
+    'disable_existing_loggers': True,
+    'formatters': {
+        'standard': {
+            'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+        },
+    },
+    'handlers': {
+        'default': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        '': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+        'analysis.areas': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+    },
+}
+
+logging.config.dictConfig(D_LOG)
+
+
+def make_areas(count=20):
+    ''' A count x count grid of areas over lon -1..0, lat 52..53, each
+    split into two triangles, one of them with a hole
+    '''
+    size = 1.0 / count
+    areas = []
+    for row in range(count):
+        for col in range(count):
+            (x, y) = (-1.0 + col * size, 52.0 + row * size)
+            lower = [[(x, y), (x + size, y), (x + size, y + size)]]
+            upper = [[(x, y), (x + size, y + size), (x, y + size)],
+                     [(x + size * 0.1, y + size * 0.5),
+                      (x + size * 0.4, y + size * 0.8),
+                      (x + size * 0.1, y + size * 0.8)]]
+            areas.append(("L%02d%02d" % (row, col), lower))
+            areas.append(("U%02d%02d" % (row, col), upper))
+    return areas
+
+
+class TestAreaIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.areas = make_areas()
+        self.index = AreaIndex(self.areas, grid_size=16)
+        random = np.random.RandomState(1)
+        self.lons = random.uniform(-1.1, 0.1, 5000)
+        self.lats = random.uniform(51.9, 53.1, 5000)
+
+    def test_matches_brute_force(self):
+        expected = np.empty(len(self.lons), dtype=np.intp)
+        expected.fill(NO_AREA)
+        for (i, (_, rings)) in enumerate(self.areas):
+            inside = PolygonGrid(rings).contains_many(self.lons, self.lats)
+            expected[inside & (expected == NO_AREA)] = i
+        result = self.index.assign(self.lons, self.lats)
+        self.assertTrue((result == expected).all())
+        # Points in the holes are in no area
+        self.assertEqual(self.index.assign([-0.995], [52.035])[0], NO_AREA)
+        self.assertEqual(self.index.assign([-0.995], [52.01])[0], 1)
+
+    def test_codes(self):
+        codes = self.index.assign_codes([-0.99, -0.999, 5.0, np.nan],
+                                        [52.001, 52.03, 52.0, np.nan])
+        self.assertEqual(list(codes[:2]), ["L0000", "U0000"])
+        self.assertTrue(pd.isnull(codes[2:]).all())
+
+    def test_shared_codes(self):
+        areas = [("A", [[(0, 0), (1, 0), (1, 1), (0, 1)]]),
+                 ("B", [[(1, 0), (2, 0), (2, 1), (1, 1)]]),
+                 ("A", [[(2, 0), (3, 0), (3, 1), (2, 1)]])]
+        index = AreaIndex(areas, grid_size=4)
+        codes = index.assign_codes([0.5, 1.5, 2.5], [0.5, 0.5, 0.5])
+        self.assertEqual(list(codes), ["A", "B", "A"])
+        self.assertEqual(list(codes.categories), ["A", "B"])
+
+    def test_frame(self):
+        dataframe = pd.DataFrame({"latitude": np.float32([52.001, np.nan]),
+                                  "longitude": np.float32([-0.99, np.nan])})
+        codes = self.index.assign_frame(dataframe)
+        self.assertEqual(codes[0], "L0000")
+        self.assertTrue(pd.isnull(codes[1]))
+
+
+@unittest.skipIf(shapefile is None, "pyshp is not installed")
+class TestAreaShapefile(unittest.TestCase):
+
+    def setUp(self):
+        # Two LSOAs side by side, in British National Grid coordinates
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'lsoa')
+        writer = shapefile.Writer(self.path)
+        writer.field('LSOA11CD', 'C')
+        for (code, x) in (('E01000001', 470000.0), ('E01000002', 475000.0)):
+            writer.poly([[[x, 255000.0], [x + 5000.0, 255000.0],
+                          [x + 5000.0, 265000.0], [x, 265000.0]]])
+            writer.record(code)
+        writer.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_projected(self):
+        self.assertRaises(ValueError, AreaIndex.from_shapefile, self.path,
+                          'LSOA11CD')
+        with open(self.path + '.prj', "w") as prj_file:
+            prj_file.write('PROJCS["British_National_Grid",'
+                           'GEOGCS["GCS_OSGB_1936"]]')
+        index = AreaIndex.from_shapefile(self.path, 'LSOA11CD')
+        self.assertEqual(list(index.assign_codes([-0.94, -0.86],
+                                                 [52.24, 52.24])),
+                         ['E01000001', 'E01000002'])
@@ -0,0 +1,179 @@
+import unittest
+import logging
+import logging.config
+import json
+import os
+import shutil
+import tempfile
+
+from analysis.datafetch.backfill import SearchBackfill, Checkpoints
+from analysis.datafetch.twitter_stream import StreamError
+from analysis.dedup import SeenIndex, Deduplicator
+
+D_LOG = {
+    'version': 1,
+    'disable_existing_loggers': True,
+    'formatters': {
+        'standard': {
+            'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+        },
+    },
+    'handlers': {
+        'default': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        '': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+        'analysis.datafetch.backfill': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+    },
+}
+
+logging.config.dictConfig(D_LOG)
+
+
+class FakeSearch(object):
+    ''' Answers searches like search/tweets, newest first
+    '''
+
+    def __init__(self, ids):
+        self.ids = list(ids)
+        self.calls = 0
+
+    def __call__(self, count, since_id=None, max_id=None, **kwargs):
+        self.calls += 1
+        ids = sorted(self.ids, reverse=True)
+        ids = [i for i in ids
+               if (since_id is None or i > since_id) and
+               (max_id is None or i <= max_id)]
+        return ({'statuses': [{'id': i} for i in ids[:count]]}, {})
+
+
+class TestSearchBackfill(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'checkpoints.json')
+        self.written = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_backfill(self, search, max_pages=None):
+        return SearchBackfill(search,
+                              Checkpoints(self.path),
+                              lambda line: self.written.append(
+                                  json.loads(line)['id']),
+                              count=3,
+                              max_pages=max_pages)
+
+    def test_incremental(self):
+        search = FakeSearch(range(1, 8))
+        queries = [{'id': 'northants', 'q': ''}]
+        self.assertEqual(self.make_backfill(search).run(queries), 7)
+        self.assertEqual(self.written, [7, 6, 5, 4, 3, 2, 1])
+        # The short last page ends the query, without asking for another
+        self.assertEqual(search.calls, 3)
+
+        search.ids.extend([8, 9])
+        self.written = []
+        self.assertEqual(self.make_backfill(search).run(queries), 2)
+        self.assertEqual(self.written, [9, 8])
+        self.assertEqual(Checkpoints(self.path).get('northants'),
+                         {'since_id': 9})
+
+    def test_full_last_page(self):
+        search = FakeSearch(range(1, 7))
+        queries = [{'id': 'northants', 'q': ''}]
+        self.assertEqual(self.make_backfill(search).run(queries), 6)
+        # Only an empty page shows that a full one was the last
+        self.assertEqual(search.calls, 3)
+        self.assertEqual(Checkpoints(self.path).get('northants'),
+                         {'since_id': 6})
+
+    def test_max_id_stuck(self):
+        search = FakeSearch(range(1, 8))
+
+        def stuck_search(max_id=None, **kwargs):
+            # Always the first page, whatever max_id asks for
+            return search(**kwargs)
+
+        backfill = self.make_backfill(stuck_search)
+        self.assertEqual(backfill.run([{'id': 'northants', 'q': ''}]), 6)
+        self.assertEqual(search.calls, 2)
+        self.assertEqual(self.written, [7, 6, 5, 7, 6, 5])
+        self.assertEqual(Checkpoints(self.path).get('northants'),
+                         {'since_id': 7})
+
+    def test_resume_unfinished(self):
+        search = FakeSearch(range(1, 8))
+        queries = [{'id': 'northants', 'q': ''}]
+        self.make_backfill(search, max_pages=1).run(queries)
+        self.assertEqual(self.written, [7, 6, 5])
+        self.assertEqual(Checkpoints(self.path).get('northants'),
+                         {'since_id': None, 'max_id': 4, 'newest': 7})
+
+        search.ids.append(8)
+        self.make_backfill(search).run(queries)
+        self.assertEqual(self.written, [7, 6, 5, 4, 3, 2, 1])
+        self.make_backfill(search).run(queries)
+        self.assertEqual(sorted(self.written), range(1, 9))
+
+    def test_refused(self):
+        search = FakeSearch(range(1, 8))
+        calls = [0]
+
+        def refusing_search(**kwargs):
+            calls[0] += 1
+            if calls[0] > 2:
+                raise StreamError("HTTP 429: Too Many Requests", status=429)
+            return search(**kwargs)
+
+        queries = [{'id': 'northants', 'q': ''}, {'id': 'other', 'q': 'x'}]
+        backfill = self.make_backfill(refusing_search)
+        self.assertEqual(backfill.run(queries), 6)
+        self.assertEqual(backfill.error.status, 429)
+        # The pages fetched are kept, and the other query is not tried
+        self.assertEqual(calls[0], 3)
+        self.assertEqual(Checkpoints(self.path).get('northants'),
+                         {'since_id': None, 'max_id': 1, 'newest': 7})
+        self.assertEqual(Checkpoints(self.path).get('other'), {})
+
+        self.make_backfill(search).run(queries)
+        self.assertEqual(self.written[:7], [7, 6, 5, 4, 3, 2, 1])
+        self.assertEqual(Checkpoints(self.path).get('northants'),
+                         {'since_id': 7})
+
+    def test_lines_dedup(self):
+        def search(count, since_id=None, max_id=None, **kwargs):
+            # The user's id is smaller than the status', and may come first
+            return ({'statuses': [
+                {'id': 1000 + i, 'text': 'hi', 'user': {'id': 7}}
+                for i in (3, 2, 1)
+                if max_id is None or 1000 + i <= max_id]}, {})
+
+        lines = []
+        backfill = SearchBackfill(search, Checkpoints(self.path),
+                                  lines.append, count=3, max_pages=1)
+        backfill.run([{'q': ''}])
+        deduplicator = Deduplicator(SeenIndex())
+        self.assertEqual([deduplicator.is_new(line) for line in lines],
+                         [True] * 3)
+        # The same statuses again, from search or the stream, are dropped
+        self.assertEqual([deduplicator.is_new(line) for line in lines],
+                         [False] * 3)
+        self.assertEqual(deduplicator.duplicates, 3)
+        seen_index = deduplicator.seen_index
+        self.assertEqual(len(seen_index), 3)
+        self.assertTrue(all(tid in seen_index for tid in (1001, 1002, 1003)))
+        self.assertFalse(7 in seen_index)
+        self.assertEqual(json.loads(lines[0])['user'], {'id': 7})
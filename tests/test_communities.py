@@ -0,0 +1,143 @@
+import unittest
+import logging
+import logging.config
+import numpy as np
+import scipy.sparse as sp
+
+from analysis.communities import Communities, symmetrize, modularity, \
+    move_nodes, louvain, aggregate
+from analysis.graph import InteractionGraph
+
+D_LOG = {
+    'version': 1,
+    'disable_existing_loggers': True,
+    'formatters': {
+        'standard': {
+            'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+        },
+    },
+    'handlers': {
+        'default': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        '': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+        'analysis.communities': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+    },
+}
+
+logging.config.dictConfig(D_LOG)
+
+
+def cliques(count, size, bridges=True):
+    ''' Adjacency matrix of count cliques of size nodes, each joined to
+    the next by one edge
+    '''
+    rows = []
+    cols = []
+    for clique in range(count):
+        nodes = range(clique * size, (clique + 1) * size)
+        for i in nodes:
+            for j in nodes:
+                if i < j:
+                    rows.append(i)
+                    cols.append(j)
+        if bridges and clique:
+            rows.append(clique * size)
+            cols.append(clique * size - 1)
+    total = count * size
+    return sp.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                         shape=(total, total))
+
+
+def same_partition(first, second):
+    pairs = set(zip(first, second))
+    return len(pairs) == len(set(first)) == len(set(second))
+
+
+class TestCommunities(unittest.TestCase):
+
+    def test_symmetrize(self):
+        adjacency = sp.csr_matrix(np.array([[1, 2], [1, 0]]))
+        weights = symmetrize(adjacency).toarray()
+        np.testing.assert_array_equal(weights, [[0, 3], [3, 0]])
+
+    def test_modularity(self):
+        weights = symmetrize(cliques(2, 3, bridges=False))
+        self.assertAlmostEqual(modularity(weights, [0, 0, 0, 1, 1, 1]),
+                               0.5)
+        self.assertAlmostEqual(modularity(weights, [0] * 6), 0.0)
+
+    def test_cliques(self):
+        weights = symmetrize(cliques(6, 5))
+        labels = louvain(weights)
+        self.assertTrue(same_partition(labels, np.arange(30) // 5))
+
+    def test_label_propagation(self):
+        weights = symmetrize(cliques(3, 5, bridges=False))
+        labels = move_nodes(weights, np.arange(15), resolution=0)
+        self.assertTrue(same_partition(labels, np.arange(15) // 5))
+
+    def test_aggregate(self):
+        weights = symmetrize(cliques(2, 3))
+        labels = np.array([0, 0, 0, 1, 1, 1])
+        community_weights = aggregate(weights, labels).toarray()
+        np.testing.assert_array_equal(community_weights, [[6, 1], [1, 6]])
+        self.assertAlmostEqual(
+            modularity(aggregate(weights, labels), [0, 1]),
+            modularity(weights, labels))
+
+    def test_warm_start(self):
+        weights = symmetrize(cliques(6, 5))
+        labels = louvain(weights)
+        # Already the best partition: nothing moves
+        self.assertTrue(same_partition(louvain(weights, labels), labels))
+
+    def test_update(self):
+        graph = InteractionGraph()
+        for user in range(1, 9):
+            # Two groups, 1-4 and 5-8, mentioning each other
+            group = range(1, 5) if user < 5 else range(5, 9)
+            graph.add_status({
+                "user": {"id": user},
+                "entities": {"user_mentions": [{"id": other}
+                                               for other in group]},
+            })
+        communities = Communities()
+        labels = communities.update(graph)
+        self.assertEqual(len(communities), 2)
+        self.assertEqual(sorted(communities.sizes()), [4, 4])
+        self.assertTrue(same_partition(
+            labels, [0 if user < 5 else 1 for user in graph.ids]))
+        self.assertEqual(communities.label_of([1, 2, 99])[-1], -1)
+        self.assertGreater(communities.modularity, 0.4)
+
+        # A new user, joining the second group
+        graph.add_status({"user": {"id": 9}, "entities": {
+            "user_mentions": [{"id": 5}, {"id": 6}, {"id": 7}]}})
+        previous = communities.label_of([5])[0]
+        communities.update(graph)
+        self.assertEqual(communities.label_of([9])[0],
+                         communities.label_of([5])[0])
+        self.assertEqual(sorted(communities.members(
+            communities.label_of([1])[0]).tolist()), [1, 2, 3, 4])
+        self.assertEqual(communities.label_of([5])[0], previous)
+
+        restored = Communities()
+        restored.set_state(communities.get_state())
+        np.testing.assert_array_equal(restored.label_of([1, 5, 9]),
+                                      communities.label_of([1, 5, 9]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+import unittest
+import logging
+import logging.config
+import os
+import random
+import shutil
+import tempfile
+import numpy as np
+
+from analysis.dedup import SeenIndex, BloomFilter, Deduplicator
+
+D_LOG = {
+    'version': 1,
+    'disable_existing_loggers': True,
+    'formatters': {
+        'standard': {
+            'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+        },
+    },
+    'handlers': {
+        'default': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        '': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+        'analysis.dedup': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+    },
+}
+
+logging.config.dictConfig(D_LOG)
+
+
+class TestBloomFilter(unittest.TestCase):
+
+    def test_error_rate(self):
+        bloom = BloomFilter(10000, error_rate=0.01)
+        bloom.add_many(np.arange(10000, dtype=np.uint64))
+        self.assertTrue(np.all(bloom.contains_many(np.arange(10000))))
+        for tid in range(100):
+            self.assertTrue(tid in bloom)
+        false_positives = bloom.contains_many(np.arange(10000, 30000)).mean()
+        self.assertTrue(false_positives < 0.02, false_positives)
+
+    def test_scalar_matches_array(self):
+        bloom = BloomFilter(1000)
+        for tid in (1, 565686632033300481, 2 ** 63 + 5):
+            bloom.add(tid)
+        self.assertTrue(np.all(bloom.contains_many(
+            [1, 565686632033300481, 2 ** 63 + 5])))
+
+
+class TestSeenIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'seen.npy')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_add(self):
+        index = SeenIndex(merge_threshold=10)
+        tids = random.sample(xrange(1, 10 ** 18), 100)
+        self.assertEqual([index.add(tid) for tid in tids], [True] * 100)
+        self.assertEqual([index.add(tid) for tid in tids], [False] * 100)
+        self.assertEqual(len(index), 100)
+        self.assertEqual(list(index.ids), sorted(tids))
+
+    def test_add_many(self):
+        index = SeenIndex(merge_threshold=4)
+        index.add(3)
+        is_new = index.add_many([1, 2, 2, 3, 4, 5, 1])
+        self.assertEqual(list(is_new),
+                         [True, True, False, False, True, True, False])
+        self.assertEqual(list(index.add_many([5, 6])), [False, True])
+
+    def test_persistent(self):
+        index = SeenIndex(self.path, merge_threshold=50)
+        tids = random.sample(xrange(1, 10 ** 18), 120)
+        for tid in tids:
+            index.add(tid)
+        index.save()
+
+        index = SeenIndex(self.path)
+        self.assertEqual(len(index), 120)
+        self.assertTrue(all(tid in index for tid in tids))
+        self.assertFalse(0 in index)
+        self.assertEqual(list(index.ids), sorted(tids))
+
+    def test_runs(self):
+        index = SeenIndex(self.path, merge_threshold=10)
+        tids = random.sample(xrange(1, 10 ** 18), 1000)
+        for tid in tids:
+            index.add(tid)
+        # Each run is at least twice the size of the next
+        sizes = [len(run) for run in index.runs]
+        self.assertEqual(sum(sizes), 1000)
+        self.assertTrue(all(older >= 2 * newer for (older, newer)
+                            in zip(sizes, sizes[1:])), sizes)
+        self.assertTrue(len(sizes) <= 10, sizes)
+        self.assertTrue(all(list(run) == sorted(run) for run in index.runs))
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         sorted(os.path.basename(run_path)
+                                for run_path in index.run_paths))
+
+        index.add(tids[0])
+        index = SeenIndex(self.path)
+        self.assertEqual([len(run) for run in index.runs], sizes)
+        self.assertTrue(all(tid in index for tid in tids))
+        self.assertEqual(list(index.add_many(tids[:5] + [0])),
+                         [False] * 5 + [True])
+        self.assertEqual(list(index.ids), sorted(tids))
+
+
+class TestDeduplicator(unittest.TestCase):
+
+    def test_write_new(self):
+        deduplicator = Deduplicator(SeenIndex())
+        written = []
+
+        def write(line):
+            written.append(line)
+
+        self.assertNotEqual(deduplicator.write_new('{"id":1}', write), False)
+        self.assertEqual(deduplicator.write_new('{"id":1}', write), False)
+        self.assertEqual(deduplicator.duplicates, 1)
+        # Lines without an id are always written
+        deduplicator.write_new('{"limit":{}}', write)
+        deduplicator.write_new('{"limit":{}}', write)
+        self.assertEqual(written, ['{"id":1}', '{"limit":{}}', '{"limit":{}}'])
+
+    def test_refused_not_seen(self):
+        deduplicator = Deduplicator(SeenIndex())
+        # A line the writer drops leaves its status unseen, so a later
+        # copy of it is still written
+        self.assertEqual(deduplicator.write_new('{"id":2}',
+                                                lambda line: False), False)
+        self.assertFalse(2 in deduplicator.seen_index)
+        self.assertEqual(deduplicator.write_new('{"id":2}',
+                                                lambda line: True, 2), True)
+        self.assertTrue(2 in deduplicator.seen_index)
+        self.assertEqual(deduplicator.duplicates, 0)
@@ -0,0 +1,250 @@
+import unittest
+import logging
+import logging.config
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from analysis.datafetch.segments import SegmentWriter, MANIFEST_NAME
+from analysis.dedup import SeenIndex
+from analysis.follow import Follower, StatusCounts
+
+D_LOG = {
+    'version': 1,
+    'disable_existing_loggers': True,
+    'formatters': {
+        'standard': {
+            'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+        },
+    },
+    'handlers': {
+        'default': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        '': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+        'analysis.follow': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+    },
+}
+
+logging.config.dictConfig(D_LOG)
+
+
+def make_line(tid):
+    return json.dumps({
+        "id": tid,
+        "text": "status %d" % tid,
+        "user": {"screen_name": "user%d" % (tid % 3)},
+        "created_at": "Thu Jan 01 %02d:00:00 +0000 2015" % (tid // 10),
+        "geo": {"coordinates": [52.0, -1.0]} if tid % 2 else None,
+    })
+
+
+class TestFollower(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'twitter_data.json')
+        self.append_lines([make_line(tid) for tid in range(1, 6)])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def append_lines(self, lines, partial=''):
+        with open(self.path, "a") as results_file:
+            results_file.write(''.join(line + '\n' for line in lines))
+            results_file.write(partial)
+
+    def make_follower(self):
+        follower = Follower(self.path)
+        counts = follower.register('counts', StatusCounts())
+        return (follower, counts)
+
+    def test_incremental(self):
+        (follower, counts) = self.make_follower()
+        self.assertEqual(follower.poll(), 5)
+        self.assertEqual(follower.poll(), 0)
+
+        # The partial line is only read once it is complete
+        line = make_line(12)
+        self.append_lines([make_line(11), 'not json'], partial=line[:20])
+        self.assertEqual(follower.poll(), 1)
+        self.append_lines([], partial=line[20:] + '\n')
+        self.assertEqual(follower.poll(), 1)
+
+        self.assertEqual(counts.statuses, 7)
+        self.assertEqual(counts.geotagged, 4)
+        self.assertEqual(counts.users,
+                         {"@user0": 2, "@user1": 2, "@user2": 3})
+        self.assertEqual(counts.hours,
+                         {"2015-01-01T00": 5, "2015-01-01T01": 2})
+        self.assertEqual((follower.lines_read, follower.errors), (8, 1))
+        self.assertEqual(follower.offset, os.path.getsize(self.path))
+
+    def test_restart(self):
+        (follower, counts) = self.make_follower()
+        follower.poll()
+        self.append_lines([make_line(6)])
+
+        # Carries on from the saved offset and counts
+        (follower, counts) = self.make_follower()
+        self.assertEqual(follower.offset, len(''.join(
+            make_line(tid) + '\n' for tid in range(1, 6))))
+        self.assertEqual(counts.statuses, 5)
+        self.assertEqual(follower.poll(), 1)
+        self.assertEqual(counts.statuses, 6)
+        self.assertEqual(follower.rows, 6)
+
+    def test_replaced(self):
+        (follower, counts) = self.make_follower()
+        follower.poll()
+        os.remove(self.path)
+        self.append_lines([make_line(tid) for tid in range(21, 24)])
+        self.assertEqual(follower.poll(), 3)
+        self.assertEqual(counts.statuses, 3)
+
+        # Also when the replacement is no shorter than the old offset
+        os.remove(self.path)
+        self.append_lines([make_line(tid) for tid in range(31, 41)])
+        (follower, counts) = self.make_follower()
+        self.assertEqual(follower.offset, 0)
+        self.assertEqual(follower.poll(), 10)
+        self.assertEqual(counts.statuses, 10)
+
+    def test_follow(self):
+        follower = Follower(self.path, poll_interval=0.01)
+        counts = follower.register('counts', StatusCounts())
+        thread = threading.Thread(target=follower.follow)
+        thread.start()
+        try:
+            self.append_lines([make_line(6)])
+            for _ in range(500):
+                if counts.statuses == 6:
+                    break
+                time.sleep(0.01)
+        finally:
+            follower.stop()
+            thread.join()
+        self.assertEqual(counts.statuses, 6)
+
+    def test_seen_index_saved(self):
+        seen_path = os.path.join(self.tmpdir, 'seen.npy')
+        self.assertRaises(ValueError, Follower, self.path,
+                          seen_index=SeenIndex(seen_path))
+        follower = Follower(self.path,
+                            seen_index=SeenIndex(seen_path,
+                                                 merge_threshold=None))
+        self.assertEqual(follower.poll(), 5)
+        self.assertEqual(len(SeenIndex(seen_path)), 5)
+
+        # The ids of a poll are saved with the state before the index, so
+        # a restart between the two still has them
+        self.append_lines([make_line(tid) for tid in (6, 7, 1)])
+        follower.seen_index.save = lambda: None
+        self.assertEqual(follower.poll(), 2)
+        seen_index = SeenIndex(seen_path, merge_threshold=None)
+        self.assertEqual(len(seen_index), 5)
+        follower = Follower(self.path, seen_index=seen_index)
+        self.assertEqual(len(seen_index), 7)
+        self.assertEqual(follower.rows, 7)
+        self.append_lines([make_line(tid) for tid in (7, 8)])
+        self.assertEqual(follower.poll(), 1)
+
+
+    def test_replaced_with_seen_index(self):
+        seen_path = os.path.join(self.tmpdir, 'seen.npy')
+        follower = Follower(self.path,
+                            seen_index=SeenIndex(seen_path,
+                                                 merge_threshold=None))
+        counts = follower.register('counts', StatusCounts())
+        self.assertEqual(follower.poll(), 5)
+
+        # Truncated and rewritten with the same statuses (in another
+        # order) and more: none of them are duplicates of what was read
+        # before
+        with open(self.path, "w") as results_file:
+            results_file.write(''.join(make_line(tid) + '\n'
+                                       for tid in range(7, 0, -1)))
+        self.assertEqual(follower.poll(), 7)
+        self.assertEqual(counts.statuses, 7)
+        self.assertEqual(len(SeenIndex(seen_path)), 7)
+
+        # Also when the change is found on loading the state
+        with open(self.path, "w") as results_file:
+            results_file.write(''.join(make_line(tid) + '\n'
+                                       for tid in range(1, 4)))
+        follower = Follower(self.path,
+                            seen_index=SeenIndex(seen_path,
+                                                 merge_threshold=None))
+        counts = follower.register('counts', StatusCounts())
+        self.assertEqual(follower.poll(), 3)
+        self.assertEqual(counts.statuses, 3)
+        self.assertEqual(len(SeenIndex(seen_path)), 3)
+
+
+class TestSegmentFollower(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.writer = SegmentWriter(self.tmpdir)
+
+    def tearDown(self):
+        self.writer.close()
+        shutil.rmtree(self.tmpdir)
+
+    def write_segment(self, tids):
+        for tid in tids:
+            self.writer.write(make_line(tid))
+        self.writer.roll()
+
+    def make_follower(self):
+        follower = Follower(self.tmpdir)
+        counts = follower.register('counts', StatusCounts())
+        return (follower, counts)
+
+    def test_segments(self):
+        self.write_segment(range(1, 6))
+        (follower, counts) = self.make_follower()
+        self.assertEqual(follower.state_path, os.path.join(
+            self.tmpdir, MANIFEST_NAME + '.follow'))
+        self.assertEqual(follower.poll(), 5)
+        self.assertEqual(follower.poll(), 0)
+
+        # The open segment is left until it is closed
+        self.write_segment(range(6, 9))
+        self.writer.write(make_line(9))
+        self.assertEqual(follower.poll(), 3)
+        self.writer.roll()
+        self.write_segment(range(10, 12))
+        self.assertEqual(follower.poll(), 3)
+        self.assertEqual(counts.statuses, 11)
+        self.assertEqual(follower.segments, 4)
+
+        # Carries on from the saved state
+        self.write_segment([12])
+        (follower, counts) = self.make_follower()
+        self.assertEqual(counts.statuses, 11)
+        self.assertEqual(follower.poll(), 1)
+        self.assertEqual((counts.statuses, follower.rows), (12, 12))
+
+    def test_manifest_replaced(self):
+        self.write_segment(range(1, 6))
+        (follower, counts) = self.make_follower()
+        follower.poll()
+        os.remove(os.path.join(self.tmpdir, MANIFEST_NAME))
+        self.write_segment(range(21, 24))
+        self.assertEqual(follower.poll(), 3)
+        self.assertEqual(counts.statuses, 3)
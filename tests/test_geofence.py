@@ -0,0 +1,170 @@
+import unittest
+import logging
+import logging.config
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from analysis.geofence import PolygonGrid, Geofence, crossings, \
+    status_coordinates, osgb_to_lon_lat, lon_lat_rings, shapefile
+
+D_LOG = {
+    'version': 1,
+    'disable_existing_loggers': True,
+    'formatters': {
+        'standard': {
+            'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+        },
+    },
+    'handlers': {
+        'default': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        '': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+        'analysis.geofence': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+    },
+}
+
+logging.config.dictConfig(D_LOG)
+
+
+# A 4 x 4 square with a 2 x 2 hole in the middle, and an island in the hole
+SQUARE = [[0.0, 0.0], [4.0, 0.0], [4.0, 4.0], [0.0, 4.0]]
+HOLE = [[1.0, 1.0], [3.0, 1.0], [3.0, 3.0], [1.0, 3.0]]
+ISLAND = [[1.5, 1.5], [2.5, 1.5], [2.0, 2.5]]
+
+BNG_PRJ = ('PROJCS["British_National_Grid",GEOGCS["GCS_OSGB_1936",'
+           'DATUM["D_OSGB_1936",SPHEROID["Airy_1830",6377563.396,'
+           '299.3249646]],PRIMEM["Greenwich",0.0],UNIT["Degree",'
+           '0.0174532925199433]],PROJECTION["Transverse_Mercator"],'
+           'PARAMETER["False_Easting",400000.0],'
+           'PARAMETER["False_Northing",-100000.0],'
+           'PARAMETER["Central_Meridian",-2.0],'
+           'PARAMETER["Scale_Factor",0.9996012717],'
+           'PARAMETER["Latitude_Of_Origin",49.0],UNIT["Meter",1.0]]')
+
+# Around Northampton, in British National Grid eastings/northings
+BNG_SQUARE = [[470000.0, 255000.0], [480000.0, 255000.0],
+              [480000.0, 265000.0], [470000.0, 265000.0]]
+
+
+def brute_force_contains(rings, lons, lats):
+    ''' Even-odd test against every edge, without the grid
+    '''
+    starts = np.concatenate([np.asarray(ring) for ring in rings])
+    ends = np.concatenate([np.roll(ring, -1, axis=0) for ring in rings])
+    return crossings(np.asarray(lons)[:, None], np.asarray(lats)[:, None],
+                     starts[None, :, 0], starts[None, :, 1],
+                     ends[None, :, 0], ends[None, :, 1]) % 2 == 1
+
+
+class TestPolygonGrid(unittest.TestCase):
+
+    def setUp(self):
+        self.rings = [SQUARE, HOLE, ISLAND]
+        self.polygon = PolygonGrid(self.rings, grid_size=8)
+
+    def test_points(self):
+        self.assertTrue(self.polygon.contains(0.5, 0.5))
+        self.assertTrue(self.polygon.contains(3.5, 2.0))
+        self.assertFalse(self.polygon.contains(1.2, 2.0))
+        self.assertTrue(self.polygon.contains(2.0, 1.8))
+        self.assertFalse(self.polygon.contains(5.0, 2.0))
+        self.assertFalse(self.polygon.contains(-0.1, 2.0))
+
+    def test_matches_brute_force(self):
+        rand = np.random.RandomState(42)
+        lons = rand.uniform(-1.0, 5.0, 5000)
+        lats = rand.uniform(-1.0, 5.0, 5000)
+        expected = brute_force_contains(self.rings, lons, lats)
+        self.assertTrue(np.array_equal(
+            self.polygon.contains_many(lons, lats), expected))
+        for i in range(200):
+            self.assertEqual(self.polygon.contains(lons[i], lats[i]),
+                             expected[i])
+
+    def test_grid_cells(self):
+        # Most of the grid should be settled without ray casting
+        self.assertTrue(np.any(self.polygon.cells == 1))
+        self.assertTrue(np.any(self.polygon.cells == 0))
+
+
+class TestGeofence(unittest.TestCase):
+
+    def setUp(self):
+        self.geofence = Geofence(PolygonGrid([SQUARE, HOLE]))
+
+    def test_status_coordinates(self):
+        status = {"coordinates": {"type": "Point",
+                                  "coordinates": [-0.9, 52.2]},
+                  "geo": {"type": "Point", "coordinates": [52.2, -0.9]}}
+        self.assertEqual(status_coordinates(status), (-0.9, 52.2))
+        del status["coordinates"]
+        self.assertEqual(status_coordinates(status), (-0.9, 52.2))
+        self.assertEqual(status_coordinates({"geo": None}), None)
+
+    def test_check(self):
+        inside = {"geo": {"coordinates": [0.5, 3.5]}}
+        in_hole = {"coordinates": {"coordinates": [2.0, 2.0]}}
+        self.assertTrue(self.geofence.check(inside))
+        self.assertFalse(self.geofence.check(in_hole))
+        self.assertEqual(self.geofence.check({"text": "no geo"}), None)
+
+
+class TestProjection(unittest.TestCase):
+
+    def test_osgb_to_lon_lat(self):
+        # The worked example of the Ordnance Survey's guide to coordinate
+        # systems, and its WGS84 position
+        (lons, lats) = osgb_to_lon_lat([651409.903], [313177.270])
+        self.assertAlmostEqual(lons[0], 1.716053, places=4)
+        self.assertAlmostEqual(lats[0], 52.657978, places=4)
+
+    def test_lon_lat_rings(self):
+        rings = lon_lat_rings([BNG_SQUARE], BNG_PRJ)
+        polygon = PolygonGrid(rings)
+        self.assertTrue(polygon.contains(-0.9, 52.24))
+        self.assertFalse(polygon.contains(-1.2, 52.24))
+        self.assertEqual(lon_lat_rings([SQUARE])[0].tolist(), SQUARE)
+
+    def test_projected_refused(self):
+        self.assertRaises(ValueError, lon_lat_rings, [BNG_SQUARE])
+        self.assertRaises(ValueError, lon_lat_rings, [BNG_SQUARE],
+                          'PROJCS["WGS_1984_Web_Mercator",GEOGCS[]]')
+
+
+@unittest.skipIf(shapefile is None, "pyshp is not installed")
+class TestGeofenceShapefile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'county')
+        writer = shapefile.Writer(self.path)
+        writer.field('NAME', 'C')
+        writer.poly([BNG_SQUARE])
+        writer.record('Northamptonshire')
+        writer.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_projected(self):
+        self.assertRaises(ValueError, Geofence.from_shapefile, self.path,
+                          'Northamptonshire')
+        with open(self.path + '.prj', "w") as prj_file:
+            prj_file.write(BNG_PRJ)
+        geofence = Geofence.from_shapefile(self.path, 'Northamptonshire')
+        self.assertTrue(geofence.check({"geo": {"coordinates": [52.24,
+                                                                -0.9]}}))
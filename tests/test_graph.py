@@ -0,0 +1,163 @@
+import unittest
+import logging
+import logging.config
+import json
+import os
+import shutil
+import tempfile
+
+from analysis.graph import InteractionGraph, INTERACTIONS, MENTION, \
+    REPLY, RETWEET
+
+D_LOG = {
+    'version': 1,
+    'disable_existing_loggers': True,
+    'formatters': {
+        'standard': {
+            'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+        },
+    },
+    'handlers': {
+        'default': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        '': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+        'analysis.graph': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+    },
+}
+
+logging.config.dictConfig(D_LOG)
+
+
+def status(tid, user, reply=None, mentions=(), retweet=None):
+    data = {
+        "id": tid,
+        "text": "status %d" % tid,
+        "user": {"id": user, "screen_name": "user%d" % user},
+        "in_reply_to_user_id": reply,
+        "in_reply_to_screen_name": "user%d" % reply if reply else None,
+        "entities": {"user_mentions": [
+            {"id": mention, "screen_name": "user%d" % mention}
+            for mention in mentions]},
+    }
+    if retweet is not None:
+        data["retweeted_status"] = {
+            "id": tid * 100,
+            "user": {"id": retweet, "screen_name": "user%d" % retweet}}
+    return data
+
+
+STATUSES = [
+    status(1, 1, mentions=[2, 3]),
+    status(2, 2, reply=1, mentions=[1, 3]),
+    status(3, 3, retweet=1, mentions=[1]),
+    status(4, 1, mentions=[2, 1]),
+    status(5, 3, reply=3),
+    {"delete": {"status": {"id": 1}}},
+]
+
+
+class TestInteractionGraph(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def edges(self, graph, kind):
+        matrix = graph.matrix(kind).tocoo()
+        return dict(((graph.ids[row], graph.ids[col]), weight)
+                    for (row, col, weight)
+                    in zip(matrix.row, matrix.col, matrix.data))
+
+    def write(self, name, statuses):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, "w") as results_file:
+            for data in statuses:
+                results_file.write(json.dumps(data) + "\n")
+        return path
+
+    def test_edges(self):
+        graph = InteractionGraph()
+        graph.add_statuses(STATUSES)
+        self.assertEqual(graph.statuses, 5)
+        self.assertEqual(sorted(graph.ids), [1, 2, 3])
+        self.assertEqual(graph.names[graph.index[2]], "user2")
+        # No edge to the replied to user as a mention, nor to oneself
+        self.assertEqual(self.edges(graph, MENTION),
+                         {(1, 2): 2, (1, 3): 1, (2, 3): 1})
+        self.assertEqual(self.edges(graph, REPLY), {(2, 1): 1})
+        # A retweet's mentions are the original's
+        self.assertEqual(self.edges(graph, RETWEET), {(3, 1): 1})
+        self.assertEqual(graph.adjacency().data.sum(), 6)
+        self.assertEqual(graph.activity[graph.index[1]], 2)
+
+    def test_compact(self):
+        graph = InteractionGraph()
+        graph.COMPACT_EDGES = 2
+        graph.add_statuses(STATUSES)
+        reference = InteractionGraph()
+        reference.add_statuses(STATUSES)
+        for kind in INTERACTIONS:
+            self.assertEqual(self.edges(graph, kind),
+                             self.edges(reference, kind))
+
+    def test_merge(self):
+        whole = InteractionGraph()
+        whole.add_statuses(STATUSES)
+        first = InteractionGraph()
+        first.add_statuses(STATUSES[3:])
+        second = InteractionGraph()
+        second.add_statuses(STATUSES[:3])
+        first.merge(second)
+        self.assertEqual(first.statuses, whole.statuses)
+        for kind in INTERACTIONS:
+            self.assertEqual(self.edges(first, kind),
+                             self.edges(whole, kind))
+        self.assertEqual(
+            dict(zip(first.ids, first.activity)),
+            dict(zip(whole.ids, whole.activity)))
+
+    def test_from_files(self):
+        paths = [self.write("a.json", STATUSES[:2]),
+                 self.write("b.json", STATUSES[2:])]
+        reference = InteractionGraph()
+        reference.add_statuses(STATUSES)
+        for processes in (None, 2):
+            graph = InteractionGraph.from_files(paths, processes)
+            self.assertEqual(graph.statuses, 5)
+            for kind in INTERACTIONS:
+                self.assertEqual(self.edges(graph, kind),
+                                 self.edges(reference, kind))
+
+    def test_save_load(self):
+        graph = InteractionGraph()
+        graph.add_statuses(STATUSES)
+        path = os.path.join(self.tmpdir, "graph.npz")
+        graph.save(path)
+        loaded = InteractionGraph.load(path)
+        self.assertEqual(loaded.ids, graph.ids)
+        self.assertEqual(loaded.names, graph.names)
+        self.assertEqual(list(loaded.activity), list(graph.activity))
+        for kind in INTERACTIONS:
+            self.assertEqual(self.edges(loaded, kind),
+                             self.edges(graph, kind))
+        # Appending carries on from the loaded graph
+        loaded.add_status(status(6, 4, mentions=[1]))
+        self.assertEqual(self.edges(loaded, MENTION)[(4, 1)], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+import unittest
+import logging
+import logging.config
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from analysis.twitter_processor import Processor
+from analysis.line_reader import LineReader, INDEX_SUFFIX, HEADER_WORDS
+
+D_LOG = {
+    'version': 1,
+    'disable_existing_loggers': True,
+    'formatters': {
+        'standard': {
+            'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+        },
+    },
+    'handlers': {
+        'default': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        '': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+        'analysis.line_reader': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+    },
+}
+
+logging.config.dictConfig(D_LOG)
+
+
+def make_line(tid):
+    return json.dumps({
+        "id": tid,
+        "text": "status %d" % tid,
+        "user": {"screen_name": "user%d" % (tid % 3)},
+        "created_at": "Thu Jan 01 00:00:00 +0000 2015",
+        "geo": None,
+    })
+
+
+class TestLineReader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'twitter_data.json')
+        self.lines = ['first', '', 'third line', 'x' * 1000]
+        self.append_lines(self.lines)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def append_lines(self, lines, partial=''):
+        with open(self.path, "a") as results_file:
+            results_file.write(''.join(line + '\n' for line in lines))
+            results_file.write(partial)
+
+    def test_random_access(self):
+        with LineReader(self.path) as reader:
+            self.assertEqual(len(reader), 4)
+            for (i, line) in enumerate(self.lines):
+                self.assertIsInstance(reader[i], memoryview)
+                self.assertEqual(reader[i].tobytes(), line)
+            self.assertEqual(reader[-1].tobytes(), self.lines[-1])
+            self.assertRaises(IndexError, reader.line, 4)
+            self.assertEqual([line.tobytes()
+                              for line in reader.iter_lines(1, 3)],
+                             self.lines[1:3])
+
+    def test_index_saved_and_extended(self):
+        with LineReader(self.path) as reader:
+            self.assertEqual(len(reader), 4)
+        index_path = self.path + INDEX_SUFFIX
+        self.assertEqual(os.path.getsize(index_path), (HEADER_WORDS + 5) * 8)
+
+        # A partial line is left out until it is complete
+        self.append_lines(['fifth'], partial='six')
+        with LineReader(self.path) as reader:
+            self.assertEqual(len(reader), 5)
+            self.assertEqual(reader[4].tobytes(), 'fifth')
+            self.append_lines([''], partial='')
+            self.assertEqual(reader.refresh(), 1)
+            self.assertEqual(reader[5].tobytes(), 'six')
+            self.assertEqual(reader.refresh(), 0)
+        self.assertEqual(os.path.getsize(index_path), (HEADER_WORDS + 7) * 8)
+        self.assertEqual(
+            list(np.fromfile(index_path, dtype='<i8')[HEADER_WORDS:]),
+            [0, 6, 7, 18, 1019, 1025, 1029])
+
+        # The extended index is used as it is next time
+        warnings = []
+        handler = logging.Handler(logging.WARNING)
+        handler.emit = warnings.append
+        logger = logging.getLogger('analysis.line_reader')
+        logger.addHandler(handler)
+        try:
+            with LineReader(self.path) as reader:
+                self.assertEqual(len(reader), 6)
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(warnings, [])
+
+    def test_bad_index_rebuilt(self):
+        with LineReader(self.path):
+            pass
+        # The file is replaced by one with different line breaks
+        with open(self.path, "w") as results_file:
+            results_file.write('a much longer first line\nb\n')
+        with LineReader(self.path) as reader:
+            self.assertEqual([line.tobytes() for line in reader.iter_lines()],
+                             ['a much longer first line', 'b'])
+        # The stale index is replaced, not appended to
+        self.assertEqual(
+            list(np.fromfile(self.path + INDEX_SUFFIX,
+                             dtype='<i8')[HEADER_WORDS:]),
+            [0, 25, 27])
+
+    def test_replaced_file(self):
+        with LineReader(self.path):
+            pass
+        # Replaced by a file that breaks its lines elsewhere: the rebuilt
+        # index must be the new file's alone, so that it is used next time
+        with open(self.path, "w") as results_file:
+            results_file.write('x' * 1017 + '\n' + 'y\n')
+        with LineReader(self.path) as reader:
+            self.assertEqual(len(reader), 2)
+        with LineReader(self.path) as reader:
+            self.assertEqual([len(line) for line in reader.iter_lines()],
+                             [1017, 1])
+
+    def test_replaced_same_breaks(self):
+        with LineReader(self.path):
+            pass
+        # The old index's end is still the end of a line, but the file is
+        # not the one it was built from
+        with open(self.path, "w") as results_file:
+            results_file.write('x' * 1016 + '\n' + 'y\n' + 'z\n')
+        with LineReader(self.path) as reader:
+            self.assertEqual([len(line) for line in reader.iter_lines()],
+                             [1016, 1, 1])
+
+    def test_lines_outlive_refresh(self):
+        reader = LineReader(self.path)
+        line = reader[3]
+        self.append_lines(['more'])
+        self.assertEqual(reader.refresh(), 1)
+        self.assertEqual(line.tobytes(), self.lines[3])
+        reader.close()
+        self.assertEqual(line.tobytes(), self.lines[3])
+
+    def test_empty_file(self):
+        path = os.path.join(self.tmpdir, 'empty.json')
+        open(path, "w").close()
+        with LineReader(path) as reader:
+            self.assertEqual(len(reader), 0)
+            self.assertEqual(list(reader.iter_lines()), [])
+        self.assertFalse(os.path.exists(path + INDEX_SUFFIX))
+
+    def test_make_df(self):
+        with open(self.path, "w") as results_file:
+            results_file.write(''.join(make_line(tid) + '\n'
+                                       for tid in range(1, 6)))
+            results_file.write('not json\n')
+        processor = Processor()
+        with LineReader(self.path) as reader:
+            dataframe = processor.make_df(reader, None)
+            self.assertEqual(list(dataframe["id"]), [1, 2, 3, 4, 5])
+            self.assertEqual(processor.lines_read, 6)
+            self.assertEqual(processor.errors, 1)
+            dataframe = processor.make_df(reader, 2)
+            self.assertEqual(list(dataframe["id"]), [1, 2])
@@ -0,0 +1,174 @@
+import unittest
+import logging
+import logging.config
+import json
+import os
+import shutil
+import tempfile
+import urllib2
+
+from analysis.datafetch.metrics import Metrics, IngestMetrics, \
+    StatsReporter, MetricsServer, COUNTER, parse_created_at
+
+D_LOG = {
+    'version': 1,
+    'disable_existing_loggers': True,
+    'formatters': {
+        'standard': {
+            'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+        },
+    },
+    'handlers': {
+        'default': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        '': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+        'analysis.datafetch.metrics': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+    },
+}
+
+logging.config.dictConfig(D_LOG)
+
+
+class FakeClock(object):
+
+    def __init__(self, now=1420070400.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_exposition(self):
+        metrics = Metrics()
+        metrics.counter('tweets_total', 'Statuses read')
+        metrics.gauge('lag_seconds')
+        metrics.register('reconnects_total', lambda: 3, COUNTER)
+        metrics.inc('tweets_total', 2)
+        text = metrics.exposition()
+        self.assertTrue('# HELP twitterd_tweets_total Statuses read\n'
+                        '# TYPE twitterd_tweets_total counter\n'
+                        'twitterd_tweets_total 2\n' in text)
+        self.assertTrue('# TYPE twitterd_lag_seconds gauge\n'
+                        'twitterd_lag_seconds NaN\n' in text)
+        self.assertTrue('twitterd_reconnects_total 3\n' in text)
+
+    def test_kind_mismatch(self):
+        metrics = Metrics()
+        metrics.counter('tweets_total')
+        self.assertRaises(ValueError, metrics.gauge, 'tweets_total')
+        self.assertRaises(ValueError, metrics.counter, 'bad-name')
+
+
+class TestIngestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.metrics = Metrics()
+        self.ingest = IngestMetrics(self.metrics, clock=self.clock)
+
+    def test_observe(self):
+        now_ms = int(self.clock.now * 1000)
+        lines = [
+            json.dumps({'id': 1, 'timestamp_ms': str(now_ms - 2000),
+                        'geo': {'coordinates': [52.2, -0.9]}}),
+            json.dumps({'id': 2, 'timestamp_ms': str(now_ms - 4000),
+                        'geo': None}),
+            json.dumps({'limit': {'track': 5}}),
+            '{"id": 3, "text": "trunc',
+        ]
+        for line in lines:
+            self.ingest.observe(line)
+        values = self.metrics.snapshot()
+        self.assertEqual(values['lines_total'], 4)
+        self.assertEqual(values['bytes_total'],
+                         sum(len(line) + 1 for line in lines))
+        self.assertEqual(values['tweets_total'], 2)
+        self.assertEqual(values['notices_total'], 1)
+        self.assertEqual(values['parse_errors_total'], 1)
+        self.assertEqual(values['geotagged_total'], 1)
+        self.assertAlmostEqual(values['lag_seconds_sum'], 6.0)
+        self.assertEqual(values['lag_seconds_count'], 2)
+        self.assertAlmostEqual(values['last_lag_seconds'], 4.0)
+
+    def test_created_at(self):
+        created_at = 'Thu Jan 01 00:00:00 +0000 2015'
+        self.assertEqual(parse_created_at(created_at), 1420070400)
+        status = {'id': 1, 'created_at': 'Wed Dec 31 23:59:00 +0000 2014'}
+        self.assertEqual(self.ingest.get_lag(status), 60.0)
+
+
+class TestStatsReporter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'stats.jsonl')
+        self.clock = FakeClock()
+        self.metrics = Metrics()
+        self.ingest = IngestMetrics(self.metrics, clock=self.clock)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_report(self):
+        reporter = StatsReporter(self.metrics, self.path, interval=10,
+                                 clock=self.clock)
+        for i in range(20):
+            geo = {'coordinates': [52, -1]} if i % 4 else None
+            self.ingest.observe(json.dumps({'id': i, 'geo': geo}))
+        self.clock.now += 10
+        values = reporter.report()
+        self.assertEqual(values['tweets_per_second'], 2.0)
+        self.assertEqual(values['geotagged_ratio'], 0.75)
+        self.assertEqual(values['lag_seconds'], None)
+        self.assertEqual(self.metrics.get('tweets_per_second'), 2.0)
+
+        self.clock.now += 10
+        values = reporter.report()
+        self.assertEqual(values['tweets_per_second'], 0.0)
+        with open(self.path, "r") as stats_file:
+            snapshots = [json.loads(line) for line in stats_file]
+        self.assertEqual(len(snapshots), 2)
+        self.assertEqual(snapshots[0]['tweets_total'], 20)
+
+    def test_roll(self):
+        reporter = StatsReporter(self.metrics, self.path, max_bytes=100,
+                                 clock=self.clock)
+        for _ in range(3):
+            self.clock.now += 1
+            reporter.report()
+        self.assertTrue(os.path.exists(self.path + '.1'))
+        with open(self.path, "r") as stats_file:
+            self.assertEqual(len(stats_file.readlines()), 1)
+
+
+class TestMetricsServer(unittest.TestCase):
+
+    def test_serve(self):
+        metrics = Metrics()
+        metrics.inc('tweets_total', 5)
+        server = MetricsServer(metrics, 0)
+        server.start()
+        try:
+            url = 'http://127.0.0.1:%d/metrics' % server.port
+            response = urllib2.urlopen(url)
+            self.assertTrue(response.info()['Content-Type']
+                            .startswith('text/plain'))
+            self.assertTrue('twitterd_tweets_total 5\n' in response.read())
+            self.assertRaises(urllib2.HTTPError, urllib2.urlopen,
+                              'http://127.0.0.1:%d/other' % server.port)
+        finally:
+            server.stop()
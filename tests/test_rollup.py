@@ -0,0 +1,133 @@
+import unittest
+import logging
+import logging.config
+import json
+import pandas as pd
+
+from analysis.twitter_processor import ColumnBuffers, typed_frame
+from analysis.rollup import Rollup, Rollups, DIMENSIONS
+
+D_LOG = {
+    'version': 1,
+    'disable_existing_loggers': True,
+    'formatters': {
+        'standard': {
+            'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+        },
+    },
+    'handlers': {
+        'default': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        '': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+        'analysis.rollup': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+    },
+}
+
+logging.config.dictConfig(D_LOG)
+
+
+def make_frame(count, offset=0):
+    buffers = ColumnBuffers(count)
+    for tid in range(offset, offset + count):
+        buffers.append({
+            "id": tid,
+            "text": u"status #Tag%d #northampton" % (tid % 2),
+            "user": {"screen_name": "user%d" % (tid % 3)},
+            "created_at": "Thu Jan 01 %02d:%02d:00 +0000 2015" % (
+                tid // 6, tid % 60),
+            "geo": {"coordinates": [52.005, -0.995 + 0.01 * (tid % 2)]}
+            if tid % 4 else None,
+        })
+    return typed_frame(buffers.columns())
+
+
+class TestRollup(unittest.TestCase):
+
+    def setUp(self):
+        self.dataframe = make_frame(24)
+        self.rollup = Rollup('hour')
+        self.rollup.update(self.dataframe)
+
+    def test_summary(self):
+        self.assertEqual(self.rollup.summary(), {
+            "tweets": 24, "unique_users": 3, "geotagged_share": 0.75})
+        summary = self.rollup.summary("2015-01-01 01:00", "2015-01-01 02:00")
+        self.assertEqual(summary["tweets"], 6)
+
+    def test_series(self):
+        series = self.rollup.series()
+        self.assertEqual(list(series["tweets"]), [6, 6, 6, 6])
+        self.assertEqual(list(series["unique_users"]), [3, 3, 3, 3])
+        self.assertEqual(series.index[1], pd.Timestamp("2015-01-01 01:00"))
+        # Matches grouping the statuses themselves
+        expected = self.dataframe.groupby(
+            self.dataframe["created_at"].values.astype("datetime64[h]"))
+        self.assertEqual(list(series["tweets"]),
+                         list(expected["id"].count()))
+
+    def test_window(self):
+        users = self.rollup.window('user', "2015-01-01 01:30",
+                                   "2015-01-01 02:10")
+        # The window covers the buckets it overlaps
+        self.assertEqual(users["tweets"].sum(), 12)
+        self.assertEqual(sorted(users.index), ["@user0", "@user1", "@user2"])
+        hashtags = self.rollup.window('hashtag')
+        self.assertEqual(hashtags["tweets"]["northampton"], 24)
+        self.assertEqual(hashtags["tweets"]["tag1"], 12)
+        self.assertEqual(hashtags["geotagged_share"]["tag0"], 0.5)
+        cells = self.rollup.top('cell', 1)
+        self.assertEqual(cells["tweets"].iloc[0], 12)
+        self.assertEqual(len(self.rollup.window('cell')), 2)
+
+    def test_merge(self):
+        merged = Rollup('hour')
+        for part in [make_frame(8, 16), make_frame(16)]:
+            rollup = Rollup('hour')
+            rollup.update(part)
+            merged.merge(rollup)
+        self.assertEqual(merged.origin, self.rollup.origin)
+        for dimension in DIMENSIONS:
+            for (start, end) in [(None, None),
+                                 ("2015-01-01 01:00", "2015-01-01 03:00")]:
+                self.assertTrue(
+                    merged.window(dimension, start, end).sort_index().equals(
+                        self.rollup.window(dimension, start,
+                                           end).sort_index()))
+        self.assertRaises(ValueError, merged.merge, Rollup('day'))
+
+    def test_state(self):
+        state = json.loads(json.dumps(self.rollup.get_state()))
+        rollup = Rollup()
+        rollup.set_state(state)
+        for dimension in DIMENSIONS:
+            self.assertTrue(rollup.window(dimension).equals(
+                self.rollup.window(dimension)))
+        self.assertTrue(rollup.series().equals(self.rollup.series()))
+
+    def test_rollups(self):
+        rollups = Rollups()
+        rollups.update(self.dataframe)
+        self.assertEqual(rollups['minute'].buckets, 4 * 60 - 36)
+        self.assertEqual(rollups['day'].buckets, 1)
+        self.assertEqual(rollups['day'].summary()["tweets"], 24)
+        self.assertEqual(len(rollups['minute'].series()), 204)
+
+    def test_empty(self):
+        rollup = Rollup('day')
+        self.assertEqual(rollup.summary()["tweets"], 0)
+        self.assertEqual(len(rollup.window('user')), 0)
+        self.assertEqual(len(rollup.series()), 0)
+        rollup.update(make_frame(0))
+        self.assertEqual(rollup.buckets, 0)
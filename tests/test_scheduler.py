@@ -0,0 +1,235 @@
+import unittest
+import logging
+import logging.config
+import json
+import math
+import os
+import shutil
+import tempfile
+
+from analysis.datafetch.scheduler import tile_geocodes, RateLimiter, \
+    TileScheduler, KM_PER_DEGREE
+from analysis.datafetch.backfill import SearchBackfill, Checkpoints
+from analysis.datafetch.twitter_stream import StreamError
+from analysis.dedup import SeenIndex, Deduplicator
+
+D_LOG = {
+    'version': 1,
+    'disable_existing_loggers': True,
+    'formatters': {
+        'standard': {
+            'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+        },
+    },
+    'handlers': {
+        'default': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        '': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+        'analysis.datafetch.scheduler': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+    },
+}
+
+logging.config.dictConfig(D_LOG)
+
+NORTHANTS_BOX = '-1.386293,51.985165,-0.282167,52.650010'
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestTiles(unittest.TestCase):
+
+    def distance_km(self, lat1, lon1, lat2, lon2):
+        dlat = (lat2 - lat1) * KM_PER_DEGREE
+        dlon = (lon2 - lon1) * KM_PER_DEGREE * \
+            math.cos(math.radians((lat1 + lat2) / 2))
+        return math.sqrt(dlat ** 2 + dlon ** 2)
+
+    def test_covers_box(self):
+        radius = 10.0
+        centres = [[float(v) for v in g[:-2].split(',')[:2]]
+                   for g in tile_geocodes(NORTHANTS_BOX, radius)]
+        self.assertTrue(len(centres) > 10)
+        (lon1, lat1, lon2, lat2) = [float(v) for v in NORTHANTS_BOX.split(',')]
+        for i in range(21):
+            for j in range(21):
+                lat = lat1 + (lat2 - lat1) * i / 20.0
+                lon = lon1 + (lon2 - lon1) * j / 20.0
+                nearest = min(self.distance_km(lat, lon, c[0], c[1])
+                              for c in centres)
+                self.assertTrue(nearest <= radius * 1.01, (lat, lon))
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_headers(self):
+        clock = FakeClock()
+        limiter = RateLimiter(limit=180, window=900, clock=clock,
+                              sleep=clock.sleep)
+        self.assertEqual(limiter.acquire(), 0.0)
+        limiter.update({'x-rate-limit-remaining': '0',
+                        'x-rate-limit-reset': str(clock.now + 300)})
+        self.assertEqual(limiter.acquire(), 300.0)
+        self.assertEqual(limiter.tokens, 179.0)
+
+    def test_refill(self):
+        clock = FakeClock()
+        limiter = RateLimiter(limit=2, window=10, clock=clock,
+                              sleep=clock.sleep)
+        limiter.acquire()
+        limiter.acquire()
+        self.assertEqual(limiter.acquire(), 5.0)
+
+    def test_no_refill_before_reset(self):
+        clock = FakeClock()
+        limiter = RateLimiter(limit=180, window=900, clock=clock,
+                              sleep=clock.sleep)
+        limiter.update({'x-rate-limit-remaining': '0',
+                        'x-rate-limit-reset': str(clock.now + 300)})
+        clock.sleep(200)
+        self.assertEqual(limiter.wait_time(), 100.0)
+        self.assertEqual(limiter.tokens, 0.0)
+
+    def test_refused(self):
+        clock = FakeClock()
+        limiter = RateLimiter(limit=180, window=900, clock=clock,
+                              sleep=clock.sleep)
+        limiter.refused()
+        self.assertEqual(limiter.acquire(), 900.0)
+        self.assertEqual(limiter.tokens, 179.0)
+
+
+class TestTileScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_prefers_busy_tiles(self):
+        clock = FakeClock()
+        next_id = [0]
+        searched = []
+
+        def search(geocode, **kwargs):
+            searched.append(geocode)
+            # the busy tile always has new tweets, the quiet one never
+            if geocode != 'busy':
+                return ({'statuses': []}, {})
+            next_id[0] += 1
+            return ({'statuses': [{'id': next_id[0]}]}, {})
+
+        backfill = SearchBackfill(search,
+                                  Checkpoints(os.path.join(self.tmpdir,
+                                                           'ckpt.json')),
+                                  lambda line: None)
+        scheduler = TileScheduler(['quiet', 'busy'],
+                                  backfill,
+                                  RateLimiter(clock=clock, sleep=clock.sleep),
+                                  clock=clock)
+        self.assertEqual(scheduler.run(6), 5)
+        self.assertEqual(sorted(searched[:2]), ['busy', 'quiet'])
+        self.assertEqual(searched[2:], ['busy'] * 4)
+
+    def test_overlapping_tiles(self):
+        clock = FakeClock()
+        next_id = [0]
+        searched = []
+
+        def search(geocode, **kwargs):
+            searched.append(geocode)
+            # the overlapping tile only finds the busy tile's last tweet
+            if geocode == 'busy':
+                next_id[0] += 1
+            return ({'statuses': [{'id': next_id[0]}]}, {})
+
+        deduplicator = Deduplicator(SeenIndex())
+        backfill = SearchBackfill(search,
+                                  Checkpoints(os.path.join(self.tmpdir,
+                                                           'ckpt.json')),
+                                  lambda line: deduplicator.write_new(
+                                      line, lambda line: None))
+        scheduler = TileScheduler(['busy', 'overlap'],
+                                  backfill,
+                                  RateLimiter(clock=clock, sleep=clock.sleep),
+                                  clock=clock)
+        self.assertEqual(scheduler.run(6), 5)
+        self.assertEqual(searched, ['busy', 'overlap'] + ['busy'] * 4)
+        self.assertEqual(scheduler.scores['overlap'][0], 0)
+        self.assertEqual(deduplicator.duplicates, 1)
+
+    def test_rate_limited(self):
+        clock = FakeClock()
+        next_id = [0]
+        calls = [0]
+
+        def search(geocode, **kwargs):
+            calls[0] += 1
+            if calls[0] == 2:
+                raise StreamError("HTTP 429: Too Many Requests", status=429)
+            next_id[0] += 1
+            return ({'statuses': [{'id': next_id[0]}]},
+                    {'x-rate-limit-remaining': '100'})
+
+        scores_path = os.path.join(self.tmpdir, 'scores.json')
+        backfill = SearchBackfill(search,
+                                  Checkpoints(os.path.join(self.tmpdir,
+                                                           'ckpt.json')),
+                                  lambda line: None)
+        scheduler = TileScheduler(['a', 'b'],
+                                  backfill,
+                                  RateLimiter(clock=clock, sleep=clock.sleep),
+                                  scores_path=scores_path,
+                                  clock=clock)
+        self.assertTrue(backfill.search is search)
+        self.assertEqual(backfill.max_pages, None)
+        self.assertEqual(scheduler.run(3), 2)
+        self.assertEqual(scheduler.searches, 2)
+        # The refused request waits out a window before the next one
+        self.assertEqual(clock.now, 1900.0)
+        with open(scores_path, "r") as scores_file:
+            self.assertEqual(sorted(json.load(scores_file)), ['a', 'b'])
+
+    def test_saves_each_tile(self):
+        clock = FakeClock()
+        scores_path = os.path.join(self.tmpdir, 'scores.json')
+
+        def search(geocode, **kwargs):
+            if os.path.exists(scores_path):
+                raise KeyboardInterrupt()
+            return ({'statuses': [{'id': 1}]}, {})
+
+        backfill = SearchBackfill(search,
+                                  Checkpoints(os.path.join(self.tmpdir,
+                                                           'ckpt.json')),
+                                  lambda line: None)
+        scheduler = TileScheduler(['a', 'b'],
+                                  backfill,
+                                  RateLimiter(clock=clock, sleep=clock.sleep),
+                                  scores_path=scores_path,
+                                  clock=clock)
+        self.assertRaises(KeyboardInterrupt, scheduler.run, 2)
+        with open(scores_path, "r") as scores_file:
+            self.assertEqual(len(json.load(scores_file)), 1)
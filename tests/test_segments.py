@@ -0,0 +1,137 @@
+import unittest
+import logging
+import logging.config
+import shutil
+import tempfile
+import time
+
+from analysis.datafetch import segments
+from analysis.datafetch.segments import SegmentWriter
+
+D_LOG = {
+    'version': 1,
+    'disable_existing_loggers': True,
+    'formatters': {
+        'standard': {
+            'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+        },
+    },
+    'handlers': {
+        'default': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        '': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+        'analysis.datafetch.segments': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+    },
+}
+
+logging.config.dictConfig(D_LOG)
+
+
+class TestSegmentWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+
+    def make_line(self, tid):
+        return '{"created_at":"x","id":%d,"user":{"id":7}}' % tid
+
+    def read_segments(self):
+        lines = []
+        for entry in segments.read_manifest(self.outdir):
+            with segments.open_segment(self.outdir + '/' +
+                                       entry['segment']) as seg_file:
+                lines.extend(l.rstrip('\n') for l in seg_file)
+        return lines
+
+    def test_roll_by_size(self):
+        lines = [self.make_line(tid) for tid in range(100, 110)]
+        with SegmentWriter(self.outdir, max_bytes=80) as writer:
+            for line in lines:
+                writer.write(line)
+
+        manifest = segments.read_manifest(self.outdir)
+        self.assertEqual(len(manifest), 5)
+        self.assertEqual([e['lines'] for e in manifest], [2] * 5)
+        self.assertEqual(manifest[0]['first_id'], 100)
+        self.assertEqual(manifest[0]['last_id'], 101)
+        self.assertEqual(manifest[-1]['last_id'], 109)
+        self.assertEqual(manifest[0]['bytes'], len(lines[0]) * 2 + 2)
+        self.assertTrue(manifest[0]['segment'].endswith('.jsonl.gz'))
+        self.assertEqual(self.read_segments(), lines)
+
+    def test_write_many(self):
+        lines = [self.make_line(tid) for tid in range(100, 110)]
+        with SegmentWriter(self.outdir, max_bytes=80) as writer:
+            writer.write_many(lines[:3])
+            writer.write_many(lines[3:])
+            writer.write_many([])
+
+        manifest = segments.read_manifest(self.outdir)
+        self.assertEqual([e['lines'] for e in manifest], [3, 7])
+        self.assertEqual([(e['first_id'], e['last_id']) for e in manifest],
+                         [(100, 102), (103, 109)])
+        self.assertEqual(self.read_segments(), lines)
+
+    def test_roll_by_time(self):
+        with SegmentWriter(self.outdir, max_seconds=0.01) as writer:
+            writer.write(self.make_line(1))
+            time.sleep(0.02)
+            writer.write(self.make_line(2))
+        self.assertEqual(len(segments.read_manifest(self.outdir)), 2)
+
+    def test_recover_open_segment(self):
+        lines = [self.make_line(tid) for tid in range(100, 105)]
+        # Crash with a segment open, part of a line written
+        crashed = SegmentWriter(self.outdir)
+        crashed.write_many(lines)
+        crashed._out_file.write('{"created_at":"x","id":1')
+        crashed._out_file.flush()
+        crashed._raw_file.flush()
+        # Another prefix's writer leaves it alone
+        with SegmentWriter(self.outdir, prefix='twitter_search'):
+            pass
+        self.assertEqual(segments.read_manifest(self.outdir), [])
+
+        with SegmentWriter(self.outdir) as writer:
+            manifest = segments.read_manifest(self.outdir)
+            self.assertEqual(len(manifest), 1)
+            self.assertEqual(manifest[0]['segment'], crashed.segment_name)
+            self.assertEqual(manifest[0]['lines'], 5)
+            self.assertEqual(manifest[0]['last_id'], 104)
+            self.assertTrue(manifest[0]['recovered'])
+            self.assertEqual(self.read_segments(), lines)
+            writer.write(self.make_line(105))
+        crashed._raw_file.close()
+
+        # Only listed once
+        with SegmentWriter(self.outdir):
+            pass
+        self.assertEqual(len(segments.read_manifest(self.outdir)), 2)
+        self.assertEqual(self.read_segments(),
+                         lines + [self.make_line(105)])
+
+    def test_restart_appends(self):
+        for tid in (1, 2):
+            with SegmentWriter(self.outdir) as writer:
+                writer.write(self.make_line(tid))
+
+        manifest = segments.read_manifest(self.outdir)
+        self.assertEqual(len(manifest), 2)
+        self.assertNotEqual(manifest[0]['segment'], manifest[1]['segment'])
+        self.assertEqual(self.read_segments(),
+                         [self.make_line(1), self.make_line(2)])
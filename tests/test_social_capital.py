@@ -0,0 +1,177 @@
+import unittest
+import logging
+import logging.config
+import numpy as np
+import pandas as pd
+
+from analysis.areas import AreaIndex
+from analysis.graph import InteractionGraph
+from analysis.social_capital import SocialCapital, user_areas, \
+    group_metrics
+
+D_LOG = {
+    'version': 1,
+    'disable_existing_loggers': True,
+    'formatters': {
+        'standard': {
+            'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+        },
+    },
+    'handlers': {
+        'default': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        '': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+        'analysis.social_capital': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+    },
+}
+
+logging.config.dictConfig(D_LOG)
+
+
+def mentions(graph, user, *others):
+    graph.add_status({
+        "user": {"id": user, "screen_name": "user%d" % user},
+        "entities": {"user_mentions": [{"id": other} for other in others]},
+    })
+
+
+def make_graph():
+    ''' Group a: a triangle (1, 2, 3) with 1 <-> 2 returned, and 4
+    hanging off 3. Group b: 5 -> 6, and 6 -> 1 across the groups
+    '''
+    graph = InteractionGraph()
+    mentions(graph, 1, 2, 3)
+    mentions(graph, 2, 1, 3)
+    mentions(graph, 3, 4)
+    mentions(graph, 5, 6)
+    mentions(graph, 6, 1)
+    return graph
+
+
+GROUPS = {1: "a", 2: "a", 3: "a", 4: "a", 5: "b", 6: "b"}
+
+
+class TestSocialCapital(unittest.TestCase):
+
+    def groups(self, graph, extra=None):
+        groups = dict(GROUPS, **(extra or {}))
+        return [groups.get(user_id) for user_id in graph.ids]
+
+    def test_metrics(self):
+        graph = make_graph()
+        metrics = SocialCapital().update(graph, self.groups(graph))
+        a = metrics.loc["a"]
+        self.assertEqual(a["users"], 4)
+        self.assertEqual(a["active_users"], 3)
+        self.assertEqual(a["statuses"], 3)
+        self.assertEqual(a["ties"], 4)
+        self.assertAlmostEqual(a["density"], 5 / 12.0)
+        self.assertAlmostEqual(a["reciprocity"], 2 / 5.0)
+        # 1 and 2 are in one triangle with two ties, 3 in one with three
+        self.assertAlmostEqual(a["clustering"], (1 + 1 + 1 / 3.0) / 3)
+        self.assertAlmostEqual(a["mean_degree"], 9 / 4.0)
+        self.assertAlmostEqual(a["within_share"], 8 / 9.0)
+        self.assertAlmostEqual(a["cross_share"], 1 / 9.0)
+        self.assertTrue(np.isnan(a["growth"]))
+
+        b = metrics.loc["b"]
+        self.assertEqual(b["users"], 2)
+        self.assertAlmostEqual(b["density"], 0.5)
+        self.assertAlmostEqual(b["reciprocity"], 0)
+        self.assertTrue(np.isnan(b["clustering"]))
+        self.assertAlmostEqual(b["within_share"], 2 / 3.0)
+
+    def test_incremental(self):
+        graph = make_graph()
+        capital = SocialCapital()
+        capital.update(graph, self.groups(graph))
+        before = capital.metrics.copy()
+
+        mentions(graph, 5, 6)
+        mentions(graph, 6, 5)
+        metrics = capital.update(graph, self.groups(graph))
+        self.assertAlmostEqual(metrics.loc["b"]["reciprocity"], 1)
+        self.assertAlmostEqual(metrics.loc["b"]["growth"], 1)
+        # Group a was not recomputed, and has not grown
+        self.assertEqual(metrics.loc["a"]["growth"], 0)
+        pd.util.testing.assert_series_equal(
+            metrics.loc["a"].drop("growth"), before.loc["a"].drop("growth"))
+
+        # The same as from scratch
+        fresh = SocialCapital().update(graph, self.groups(graph))
+        pd.util.testing.assert_frame_equal(
+            metrics.drop("growth", axis=1).sort_index(),
+            fresh.drop("growth", axis=1).sort_index())
+
+        # A new user in a new group, and a user moving groups
+        mentions(graph, 7, 8)
+        metrics = capital.update(graph, self.groups(
+            graph, {4: "b", 7: "c", 8: "c"}))
+        self.assertEqual(sorted(metrics.index), ["a", "b", "c"])
+        self.assertEqual(metrics.loc["a"]["users"], 3)
+        self.assertEqual(metrics.loc["b"]["users"], 3)
+        self.assertEqual(metrics.loc["c"]["ties"], 1)
+
+        # A group with no members left is dropped
+        metrics = capital.update(graph, self.groups(
+            graph, {7: None, 8: None}))
+        self.assertEqual(sorted(metrics.index), ["a", "b"])
+
+    def test_growth(self):
+        graph = make_graph()
+        capital = SocialCapital()
+        # 4 has no statuses of their own
+        metrics = capital.update(graph, self.groups(graph, {4: "d"}))
+        self.assertEqual(metrics.loc["d"]["statuses"], 0)
+
+        mentions(graph, 4, 3)
+        mentions(graph, 1, 2)
+        metrics = capital.update(graph, self.groups(graph, {4: "d"}))
+        self.assertAlmostEqual(metrics.loc["a"]["growth"], 1 / 3.0)
+        self.assertEqual(metrics.loc["b"]["growth"], 0)
+        # Nothing to compare to: NaN rather than inf
+        self.assertEqual(metrics.loc["d"]["statuses"], 1)
+        self.assertTrue(np.isnan(metrics.loc["d"]["growth"]))
+
+        metrics = capital.update(graph, self.groups(graph, {4: "d"}))
+        self.assertTrue((metrics["growth"] == 0).all())
+
+    def test_group_metrics(self):
+        graph = make_graph()
+        codes = np.array([0 if GROUPS[user] == "a" else -1
+                          for user in graph.ids])
+        metrics = group_metrics(graph.adjacency(), codes, 1,
+                                np.frombuffer(graph.activity, dtype=np.int_))
+        self.assertEqual(metrics["users"][0], 4)
+
+    def test_user_areas(self):
+        graph = make_graph()
+        square = [[(0, 0), (0, 1), (1, 1), (1, 0), (0, 0)]]
+        index = AreaIndex([("E1", square),
+                           ("E2", [[(x + 1, y) for (x, y) in square[0]]])])
+        dataframe = pd.DataFrame({
+            "user": ["@user1", "@user1", "@user1", "@user2", "@user5"],
+            "longitude": [0.5, 1.5, 1.5, 0.5, 5.0],
+            "latitude": [0.5, 0.5, 0.5, 0.5, 0.5],
+        })
+        areas = dict(zip(graph.ids, user_areas(graph, dataframe, index)))
+        self.assertEqual(areas[1], "E2")
+        self.assertEqual(areas[2], "E1")
+        self.assertEqual(areas[5], None)
+        self.assertEqual(areas[3], None)
+
+
+if __name__ == '__main__':
+    unittest.main()
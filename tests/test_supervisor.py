@@ -0,0 +1,173 @@
+import unittest
+import logging
+import logging.config
+import os
+import shutil
+import socket
+import tempfile
+import zlib
+
+from analysis.datafetch.supervisor import Backoff, StreamSupervisor, PidFile
+from analysis.datafetch.twitter_stream import StreamError
+
+D_LOG = {
+    'version': 1,
+    'disable_existing_loggers': True,
+    'formatters': {
+        'standard': {
+            'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+        },
+    },
+    'handlers': {
+        'default': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        '': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+        'analysis.datafetch.supervisor': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+    },
+}
+
+logging.config.dictConfig(D_LOG)
+
+
+class TestBackoff(unittest.TestCase):
+
+    def test_delays(self):
+        backoff = Backoff(jitter=0.0)
+        self.assertEqual([backoff.next_delay(Backoff.NETWORK)
+                          for _ in range(3)], [0.25, 0.5, 0.75])
+        self.assertEqual([backoff.next_delay(Backoff.HTTP)
+                          for _ in range(8)],
+                         [5.0, 10.0, 20.0, 40.0, 80.0, 160.0, 320.0, 320.0])
+        self.assertEqual([backoff.next_delay(Backoff.RATE_LIMITED)
+                          for _ in range(2)], [60.0, 120.0])
+        backoff.reset()
+        self.assertEqual(backoff.next_delay(Backoff.RATE_LIMITED), 60.0)
+
+    def test_jitter(self):
+        backoff = Backoff(jitter=0.5, rand=lambda: 1.0)
+        self.assertEqual(backoff.next_delay(Backoff.HTTP), 7.5)
+
+
+class TestStreamSupervisor(unittest.TestCase):
+
+    def test_reconnects(self):
+        def stalled():
+            yield 'a'
+            raise socket.timeout()
+
+        def refused():
+            raise StreamError("HTTP 420", status=420)
+            yield
+
+        def working():
+            yield 'b'
+            yield 'c'
+
+        streams = [stalled(), refused(), working()]
+        lines = []
+        waits = []
+
+        def handle_line(line):
+            lines.append(line)
+            if line == 'c':
+                supervisor.stop()
+
+        supervisor = StreamSupervisor(lambda: streams.pop(0),
+                                      handle_line,
+                                      backoff=Backoff(jitter=0.0),
+                                      wait=waits.append)
+        supervisor.run()
+
+        self.assertEqual(lines, ['a', 'b', 'c'])
+        self.assertEqual(waits, [0.25, 60.0])
+        self.assertEqual(supervisor.connections, 3)
+        self.assertEqual(supervisor.stalls, 1)
+        self.assertEqual(supervisor.errors, 1)
+
+    def test_closed_connections_back_off(self):
+        def closed():
+            return
+            yield
+
+        def corrupt():
+            raise zlib.error("Error -3 while decompressing")
+            yield
+
+        def bad_chunk():
+            raise ValueError("invalid literal for int() with base 16")
+            yield
+
+        def working():
+            yield 'a'
+
+        streams = [closed(), closed(), corrupt(), bad_chunk(), working(),
+                   closed()]
+        waits = []
+
+        def wait(delay):
+            waits.append(delay)
+            if not streams:
+                supervisor.stop()
+
+        supervisor = StreamSupervisor(lambda: streams.pop(0),
+                                      lambda line: None,
+                                      backoff=Backoff(jitter=0.0),
+                                      wait=wait)
+        supervisor.run()
+
+        # The delay grows while connections end without a line, and starts
+        # again after one arrives
+        self.assertEqual(waits, [0.25, 0.5, 0.75, 1.0, 0.25, 0.5])
+        self.assertEqual(supervisor.connections, 6)
+        self.assertEqual(supervisor.errors, 2)
+
+    def test_stop_aborts(self):
+        aborted = []
+
+        def forever():
+            while True:
+                yield 'a'
+
+        supervisor = StreamSupervisor(forever,
+                                      lambda line: supervisor.stop(),
+                                      abort=lambda: aborted.append(True))
+        supervisor.run()
+        self.assertEqual(aborted, [True])
+        self.assertEqual(supervisor.connections, 1)
+
+
+class TestPidFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'twitterd.pid')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_acquire_release(self):
+        pidfile = PidFile(self.path)
+        pidfile.acquire()
+        self.assertEqual(pidfile.read_pid(), os.getpid())
+        pidfile.release()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_already_running(self):
+        with open(self.path, "w") as pid_file:
+            pid_file.write("%d\n" % os.getppid())
+        self.assertRaises(RuntimeError, PidFile(self.path).acquire)
+
+    def test_stop_not_running(self):
+        self.assertTrue(PidFile(self.path).stop())
@@ -0,0 +1,150 @@
+import unittest
+import logging
+import logging.config
+import json
+import os
+import shutil
+import tempfile
+
+from analysis import table_cache
+from analysis.twitter_processor import Processor, Decoder, ROW_FIELDS
+from analysis.table_cache import TableCache, NPZ, last_line_end
+
+D_LOG = {
+    'version': 1,
+    'disable_existing_loggers': True,
+    'formatters': {
+        'standard': {
+            'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+        },
+    },
+    'handlers': {
+        'default': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        '': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+        'analysis.table_cache': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+    },
+}
+
+logging.config.dictConfig(D_LOG)
+
+
+def make_line(tid):
+    return json.dumps({
+        "id": tid,
+        "text": "status %d" % tid,
+        "user": {"screen_name": "user%d" % (tid % 3)},
+        "created_at": "Thu Jan 01 00:00:00 +0000 2015",
+        "geo": {"coordinates": [52.0, -1.0]} if tid % 2 else None,
+    })
+
+
+class TestTableCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = TableCache(os.path.join(self.tmpdir, 'cache'), NPZ)
+        self.path = os.path.join(self.tmpdir, 'twitter_data.json')
+        self.append_lines([make_line(tid) for tid in range(1, 11)] +
+                          ['not json'])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def append_lines(self, lines, partial=''):
+        with open(self.path, "a") as results_file:
+            results_file.write(''.join(line + '\n' for line in lines))
+            results_file.write(partial)
+
+    def make_df(self, processor=None):
+        processor = processor or Processor()
+        return processor.make_df(self.path, None, cache=self.cache)
+
+    def parse_counts(self, processor=None):
+        parsed = []
+        processor = processor or Processor()
+        original = processor.iter_column_chunks
+
+        def iter_column_chunks(*args, **kwargs):
+            for chunk in original(*args, **kwargs):
+                parsed.append(len(chunk["id"]))
+                yield chunk
+
+        processor.iter_column_chunks = iter_column_chunks
+        return (processor, parsed)
+
+    def test_cached(self):
+        with open(self.path, "r") as results_file:
+            expected = Processor().make_df(results_file, None)
+        dataframe = self.make_df()
+        self.assertTrue(dataframe.equals(expected))
+
+        (processor, parsed) = self.parse_counts()
+        dataframe = self.make_df(processor)
+        self.assertTrue(dataframe.equals(expected))
+        self.assertEqual(parsed, [])
+        self.assertEqual((processor.lines_read, processor.errors), (11, 1))
+
+    def test_append(self):
+        self.make_df()
+        self.append_lines([make_line(tid) for tid in range(11, 16)],
+                          partial=make_line(16)[:20])
+        (processor, parsed) = self.parse_counts()
+        dataframe = self.make_df(processor)
+        # Only the new complete lines are parsed
+        self.assertEqual(parsed, [5])
+        self.assertEqual(list(dataframe["id"]), list(range(1, 16)))
+        self.assertEqual(processor.lines_read, 16)
+
+        with open(self.path, "a") as results_file:
+            results_file.write(make_line(16)[20:] + '\n')
+        dataframe = self.make_df()
+        self.assertEqual(list(dataframe["id"]), list(range(1, 17)))
+
+    def test_keyed_by_decoder(self):
+        self.make_df()
+        # Projected fields are cached apart from whole statuses
+        (processor, parsed) = self.parse_counts(
+            Processor(Decoder(fields=ROW_FIELDS)))
+        dataframe = self.make_df(processor)
+        self.assertEqual(parsed, [10])
+        self.assertEqual(list(dataframe["id"]), list(range(1, 11)))
+        (processor, parsed) = self.parse_counts()
+        self.make_df(processor)
+        self.assertEqual(parsed, [])
+
+        # and a new schema parses again
+        schema_version = table_cache.SCHEMA_VERSION
+        table_cache.SCHEMA_VERSION += 1
+        try:
+            (processor, parsed) = self.parse_counts()
+            self.make_df(processor)
+            self.assertEqual(parsed, [10])
+        finally:
+            table_cache.SCHEMA_VERSION = schema_version
+
+    def test_rewritten(self):
+        self.make_df()
+        os.remove(self.path)
+        self.append_lines([make_line(tid) for tid in range(100, 120)])
+        dataframe = self.make_df()
+        self.assertEqual(list(dataframe["id"]), list(range(100, 120)))
+
+    def test_last_line_end(self):
+        size = os.path.getsize(self.path)
+        self.assertEqual(last_line_end(self.path, 0, size), size)
+        self.append_lines([], partial='{"id": 1')
+        self.assertEqual(last_line_end(self.path, 0, size + 8), size)
+        self.assertEqual(last_line_end(self.path, size, size + 8), size)
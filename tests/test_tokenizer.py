@@ -0,0 +1,83 @@
+import unittest
+import logging
+import logging.config
+
+from analysis.tokenizer import Tokenizer, STOPWORDS, count_words
+
+D_LOG = {
+    'version': 1,
+    'disable_existing_loggers': True,
+    'formatters': {
+        'standard': {
+            'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+        },
+    },
+    'handlers': {
+        'default': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        '': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+        'analysis.tokenizer': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+    },
+}
+
+logging.config.dictConfig(D_LOG)
+
+
+class TestTokenizer(unittest.TestCase):
+
+    def setUp(self):
+        self.tokenizer = Tokenizer()
+        self.texts = [
+            u"Roads closed in Northampton.Kettering/Corby today @nccnews",
+            u"#northants council: http://t.co/abc bins,recycling A-road",
+            u"caf\xe9 \xfcber na\xefve snake_case\nl'\xe9cole 12345",
+            u"",
+            u"Wellingborough\xa0\u2600sunny great!!! foo@bar.com",
+        ]
+
+    def test_tokenize(self):
+        self.assertEqual(self.tokenizer.tokenize(self.texts[0]),
+                         [u"roads", u"closed", u"northampton",
+                          u"kettering", u"corby"])
+        self.assertEqual(self.tokenizer.tokenize(self.texts[1]),
+                         [u"council", u"bins", u"recycling", u"a-road"])
+        self.assertEqual(self.tokenizer.tokenize(self.texts[2]),
+                         [u"caf", u"nave", u"snake_case", u"lcole",
+                          u"12345"])
+        self.assertEqual(self.tokenizer.tokenize(self.texts[3]), [])
+        self.assertEqual(self.tokenizer.tokenize(self.texts[4]),
+                         [u"wellingborough", u"great"])
+        self.assertTrue(u"today" in STOPWORDS)
+        self.assertEqual(Tokenizer(min_len=7).tokenize(self.texts[0]),
+                         [u"northampton", u"kettering"])
+
+    def test_tokenize_many(self):
+        self.assertEqual(self.tokenizer.tokenize_many(self.texts),
+                         [self.tokenizer.tokenize(text)
+                          for text in self.texts])
+        self.assertEqual(self.tokenizer.tokenize_many([]), [])
+
+    def test_count(self):
+        counts = self.tokenizer.count(self.texts * 2)
+        self.assertEqual(counts[u"northampton"], 2)
+        self.assertEqual(counts[u"snake_case"], 2)
+        self.assertFalse(u"today" in counts)
+
+    def test_count_words(self):
+        batches = [self.texts[:2], self.texts[2:], self.texts]
+        expected = self.tokenizer.count(self.texts * 2)
+        self.assertEqual(count_words(batches, self.tokenizer), expected)
+        self.assertEqual(count_words(iter(batches), self.tokenizer,
+                                     processes=2), expected)
@@ -0,0 +1,204 @@
+import unittest
+import logging
+import logging.config
+import gzip
+import json
+import os
+import shutil
+import tempfile
+
+from analysis.topics import TopicCorpus, CorpusState, iter_documents, \
+    corpora
+from analysis.tokenizer import Tokenizer
+from analysis.twitter_processor import Processor, Decoder, ROW_FIELDS
+
+D_LOG = {
+    'version': 1,
+    'disable_existing_loggers': True,
+    'formatters': {
+        'standard': {
+            'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+        },
+    },
+    'handlers': {
+        'default': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        '': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+        'analysis.topics': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+    },
+}
+
+logging.config.dictConfig(D_LOG)
+
+
+def make_line(tid, text):
+    return json.dumps({
+        "id": tid,
+        "text": text,
+        "user": {"screen_name": "user%d" % (tid % 3)},
+        "created_at": "Thu Jan 01 00:00:00 +0000 2015",
+        "geo": None,
+    })
+
+
+TEXTS = [
+    u"Roadworks on the Kettering road again @nccnews",
+    u"Library opening hours cut in Corby #northants",
+    u"Roadworks and library closures, council budget",
+    u"http://t.co/abc @someone #tag",
+]
+
+
+class TestDocuments(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'twitter_data.json')
+        self.lines = [make_line(tid, text)
+                      for (tid, text) in enumerate(TEXTS)]
+        with open(self.path, "w") as results_file:
+            results_file.write(''.join(line + '\n' for line in self.lines))
+        self.processor = Processor(Decoder(fields=ROW_FIELDS))
+        self.tokenizer = Tokenizer()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_documents(self):
+        documents = list(iter_documents(self.path, self.processor,
+                                        self.tokenizer))
+        # The last status has no words left
+        self.assertEqual(len(documents), 3)
+        self.assertEqual(documents[0], [u"roadworks", u"kettering", u"road"])
+
+        # A byte range
+        start = len(self.lines[0]) + 1
+        end = start + len(self.lines[1]) + 1
+        documents = list(iter_documents(self.path, self.processor,
+                                        self.tokenizer, start, end))
+        self.assertEqual(documents, [[u"library", u"opening", u"hours",
+                                      u"cut", u"corby"]])
+
+    def test_segment(self):
+        segment_path = os.path.join(self.tmpdir, 'twitter_data-1.jsonl.gz')
+        with gzip.open(segment_path, "wb") as segment_file:
+            segment_file.write(''.join(line + '\n' for line in self.lines))
+        self.assertEqual(
+            list(iter_documents(segment_path, self.processor,
+                                self.tokenizer)),
+            list(iter_documents(self.path, self.processor, self.tokenizer)))
+
+
+class TestCorpusState(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.state_path = os.path.join(self.tmpdir, 'corpus.json')
+        self.path = os.path.join(self.tmpdir, 'twitter_data.json')
+        self.lines = [make_line(tid, text) + '\n'
+                      for (tid, text) in enumerate(TEXTS)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_ranges(self):
+        with open(self.path, "w") as results_file:
+            results_file.write(''.join(self.lines[:2]) + '{"id": 9')
+        first = len(self.lines[0]) + len(self.lines[1])
+        state = CorpusState(self.state_path)
+        self.assertEqual(state.new_range(self.path), (0, first))
+        state.add_part('corpus-00000.mm', 2, [(self.path, (0, first))])
+        state.save()
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ['corpus.json', 'twitter_data.json'])
+
+        # Only the lines completed since
+        with open(self.path, "w") as results_file:
+            results_file.write(''.join(self.lines))
+        state = CorpusState(self.state_path)
+        self.assertEqual(state.parts,
+                         [{"name": "corpus-00000.mm", "documents": 2}])
+        self.assertEqual(state.new_range(self.path),
+                         (first, os.path.getsize(self.path)))
+
+        # All of a file replaced since
+        with open(self.path, "w") as results_file:
+            results_file.write(''.join(reversed(self.lines)))
+        self.assertEqual(state.new_range(self.path),
+                         (0, os.path.getsize(self.path)))
+
+    def test_segments(self):
+        segment_path = os.path.join(self.tmpdir, 'twitter_data-1.jsonl.gz')
+        with gzip.open(segment_path, "wb") as segment_file:
+            segment_file.write(''.join(self.lines))
+        state = CorpusState(self.state_path)
+        size = os.path.getsize(segment_path)
+        self.assertEqual(state.new_range(segment_path), (0, size))
+        state.add_part('corpus-00000.mm', 3, [(segment_path, (0, size))])
+        state.save()
+        self.assertEqual(CorpusState(self.state_path).new_range(
+            segment_path), None)
+
+
+@unittest.skipIf(corpora is None, "gensim is not installed")
+class TestTopicCorpus(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.corpus_dir = os.path.join(self.tmpdir, 'topics')
+        self.path = os.path.join(self.tmpdir, 'twitter_data.json')
+        self.append_lines(TEXTS)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def append_lines(self, texts, partial=''):
+        with open(self.path, "a") as results_file:
+            results_file.write(''.join(make_line(tid, text) + '\n'
+                                       for (tid, text) in enumerate(texts)))
+            results_file.write(partial)
+
+    def test_incremental(self):
+        topic_corpus = TopicCorpus(self.corpus_dir)
+        self.assertEqual(topic_corpus.update([self.path]), 3)
+        self.assertEqual(topic_corpus.update([self.path]), 0)
+        words = len(topic_corpus.dictionary)
+
+        self.append_lines([u"Budget meeting at the council"],
+                          partial='{"id": 9')
+        topic_corpus = TopicCorpus(self.corpus_dir)
+        self.assertEqual(len(topic_corpus), 3)
+        self.assertEqual(topic_corpus.update([self.path]), 1)
+        self.assertEqual(len(topic_corpus.parts), 2)
+        self.assertEqual(len(topic_corpus), 4)
+        self.assertEqual(len(list(topic_corpus)), 4)
+        self.assertEqual(len(topic_corpus.dictionary), words + 1)
+
+        # Word ids of the first part are unchanged
+        dictionary = topic_corpus.dictionary
+        first = list(topic_corpus.corpus())[0]
+        self.assertEqual(sorted(dictionary[word_id] for (word_id, _) in first),
+                         [u"kettering", u"road", u"roadworks"])
+
+    def test_train(self):
+        topic_corpus = TopicCorpus(self.corpus_dir)
+        topic_corpus.update([self.path])
+        lda = topic_corpus.train(num_topics=2, workers=1, no_below=1,
+                                 no_above=1.0)
+        self.assertEqual(lda.num_topics, 2)
+        parts = len(topic_corpus.parts)
+        self.append_lines([u"Roadworks on the Corby road"])
+        topic_corpus.update([self.path])
+        topic_corpus.update_model(lda, parts)
@@ -0,0 +1,218 @@
+import unittest
+import logging
+import logging.config
+import collections
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+from analysis.trends import CountMinSketch, SpaceSaving, TrendDetector, \
+    TrendsReporter
+
+D_LOG = {
+    'version': 1,
+    'disable_existing_loggers': True,
+    'formatters': {
+        'standard': {
+            'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+        },
+    },
+    'handlers': {
+        'default': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        '': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+        'analysis.trends': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+    },
+}
+
+logging.config.dictConfig(D_LOG)
+
+
+def zipf_terms(count, vocabulary, seed=0):
+    random = np.random.RandomState(seed)
+    ranks = random.zipf(1.5, count)
+    return [u"term%d" % rank for rank in ranks if rank <= vocabulary]
+
+
+class TestCountMinSketch(unittest.TestCase):
+
+    def test_estimate(self):
+        terms = zipf_terms(20000, 5000)
+        counts = collections.Counter(terms)
+        sketch = CountMinSketch(width=1024, depth=4)
+        sketch.add(terms)
+        keys = list(counts)
+        estimates = sketch.estimate(keys)
+        exact = np.array([counts[key] for key in keys])
+        # Never too low, and too high by at most e / width of the total
+        self.assertTrue((estimates >= exact).all())
+        self.assertLessEqual(np.mean(estimates - exact),
+                             np.e / 1024 * len(terms))
+        self.assertEqual(sketch.estimate([u"term1"])[0], counts[u"term1"])
+
+    def test_counts(self):
+        sketch = CountMinSketch(width=256, depth=3)
+        sketch.add([u"a", u"b"], [5, 2])
+        sketch.add([u"a"])
+        np.testing.assert_array_equal(sketch.estimate([u"a", u"b"]), [6, 2])
+        other = np.zeros_like(sketch.table)
+        sketch.add([u"c"], [3], [other])
+        self.assertEqual(sketch.estimate([u"c"], other)[0], 3)
+        self.assertEqual(sketch.table.sum(), 3 * 11)
+
+
+class TestSpaceSaving(unittest.TestCase):
+
+    def test_exact(self):
+        summary = SpaceSaving(capacity=10)
+        summary.update({u"a": 3, u"b": 1})
+        summary.add(u"a")
+        self.assertEqual(summary.top(), [(u"a", 4), (u"b", 1)])
+
+    def test_heavy_hitters(self):
+        terms = zipf_terms(20000, 100000)
+        counts = collections.Counter(terms)
+        summary = SpaceSaving(capacity=50)
+        for term in terms:
+            summary.add(term)
+        self.assertEqual(len(summary), 50)
+        top = [term for (term, _) in counts.most_common(5)]
+        for term in top:
+            self.assertIn(term, summary.counts)
+            self.assertGreaterEqual(summary.counts[term], counts[term])
+            self.assertLessEqual(
+                summary.counts[term] - summary.errors[term], counts[term])
+
+
+class TestTrendDetector(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def feed(self, detector, buckets, spike=None):
+        ''' Add the same statuses to each of buckets (of 60 seconds), and
+        spike, a hashtag, 20 times to the last one
+        '''
+        for bucket in range(buckets):
+            for i in range(10):
+                detector.add_status({"text": u"Traffic on the road #a43",
+                                     "timestamp_ms": str(
+                                         (bucket * 60 + i) * 1000)})
+        for i in range(20 if spike else 0):
+            detector.add_status({"text": u"Flooding %s" % spike},
+                                (buckets - 1) * 60 + 30)
+
+    def test_spike(self):
+        detector = TrendDetector(bucket_seconds=60, baseline=5,
+                                 width=512)
+        self.feed(detector, 8, spike=u"#Flood")
+        trends = detector.trends()
+        self.assertEqual(list(trends["term"]), [u"#flood", u"flooding"])
+        self.assertEqual(trends["count"][0], 20)
+        self.assertEqual(trends["expected"][0], 0)
+        self.assertEqual(detector.statuses, 100)
+        # Steady terms do not trend, and memory does not grow
+        self.assertNotIn(u"traffic", list(trends["term"]))
+        self.assertEqual(detector.window_table.shape, (4, 512))
+
+        # Once the spike is in the baseline, it is expected
+        self.feed(detector, 1)
+        detector.add_status({"text": u"#flood"}, 9 * 60)
+        self.assertEqual(len(detector.trends(timestamp=9 * 60)), 0)
+        # And after the whole ring, forgotten
+        self.assertEqual(len(detector.trends(timestamp=30 * 60)), 0)
+        self.assertEqual(detector.window_table.sum(), 0)
+        self.assertEqual(detector.baseline_table.sum(), 0)
+
+    def test_no_baseline(self):
+        detector = TrendDetector(bucket_seconds=60)
+        self.feed(detector, 1, spike=u"#flood")
+        self.assertEqual(len(detector.trends()), 0)
+
+    def test_status_times(self):
+        detector = TrendDetector(bucket_seconds=60, clock=lambda: 3600.0)
+        # Without timestamp_ms, bucketed at created_at, not now
+        detector.add_status({"text": u"#flood",
+                             "created_at": "Thu Jan 01 00:02:30 +0000 1970"})
+        self.assertEqual(detector.bucket, 2)
+        detector.add_status({"text": u"#flood", "created_at": "yesterday"})
+        detector.add_status({"text": u"#flood"})
+        self.assertEqual((detector.statuses, detector.undated), (1, 2))
+        self.assertEqual(detector.bucket, 2)
+
+        dataframe = pd.DataFrame({
+            "status": [u"#flood", u"#flood"],
+            "created_at": pd.to_datetime([180, None], unit="s"),
+        })
+        detector.update(dataframe)
+        self.assertEqual((detector.statuses, detector.undated), (2, 3))
+        self.assertEqual(detector.bucket, 3)
+
+    def test_window_sums(self):
+        detector = TrendDetector(bucket_seconds=60, window=2, baseline=3,
+                                 width=256)
+        self.feed(detector, 7)
+        ages = [detector.slot(age) for age in range(5)]
+        np.testing.assert_array_equal(
+            detector.window_table,
+            sum(detector.sketches[slot].table for slot in ages[:2]))
+        np.testing.assert_array_equal(
+            detector.baseline_table,
+            sum(detector.sketches[slot].table for slot in ages[2:]))
+
+    def test_state(self):
+        detector = TrendDetector(bucket_seconds=60, baseline=5, width=512)
+        self.feed(detector, 8, spike=u"#flood")
+        restored = TrendDetector(bucket_seconds=60, baseline=5, width=512)
+        restored.set_state(json.loads(json.dumps(detector.get_state())))
+        pd.util.testing.assert_frame_equal(restored.trends(),
+                                           detector.trends())
+        np.testing.assert_array_equal(restored.baseline_table,
+                                      detector.baseline_table)
+
+    def test_update(self):
+        minutes = np.repeat(np.arange(8), 10)
+        texts = [u"Traffic on the road #a43"] * len(minutes) + \
+            [u"#flood warning"] * 20
+        times = np.concatenate([minutes, np.repeat(7, 20)])
+        dataframe = pd.DataFrame({
+            "status": texts,
+            "created_at": pd.to_datetime(times * 60, unit="s"),
+        })
+        detector = TrendDetector(bucket_seconds=60, baseline=5)
+        detector.update(dataframe)
+        self.assertEqual(detector.bucket, 7)
+        self.assertEqual(list(detector.trends()["term"])[:1], [u"#flood"])
+
+    def test_reporter(self):
+        detector = TrendDetector(bucket_seconds=60, baseline=5)
+        self.feed(detector, 8, spike=u"#flood")
+        path = os.path.join(self.tmpdir, "trends.json")
+        reporter = TrendsReporter(detector, path, clock=lambda: 7 * 60)
+        reporter.report()
+        with open(path) as trends_file:
+            values = json.loads(trends_file.readline())
+        self.assertEqual(values["trends"][0]["term"], u"#flood")
+        self.assertEqual(values["trends"][0]["count"], 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
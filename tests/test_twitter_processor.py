@@ -2,8 +2,18 @@
 import unittest
 import logging
 import logging.config
+import json
+import os
+import tempfile
+from StringIO import StringIO
+import numpy as np
+import pandas as pd
+
+from analysis.twitter_processor import Processor, Decoder, COLUMNS, \
+    ROW_FIELDS, newline_ranges, typed_frame, parse_created_at
+from analysis.datafetch.twitter_stream import tag_line
+from analysis.dedup import SeenIndex
 
-from analysis.twitter_processor import Processor
 D_LOG = {
     'version': 1,
     'disable_existing_loggers': True,
@@ -47,3 +57,239 @@ class TestTwitterProcessor(unittest.TestCase):
             print(dataframe)
             user_frame = dataframe.groupby("user")
             print(user_frame.groups)
+
+
+def make_status(tid, geo=None):
+    status = {
+        "id": tid,
+        "text": "status %d" % tid,
+        "user": {"screen_name": "user%d" % (tid % 3)},
+        "created_at": "Thu Jan 01 00:00:%02d +0000 2015" % tid,
+        "geo": None,
+    }
+    if geo is not None:
+        status["geo"] = {"type": "Point", "coordinates": geo}
+    return json.dumps(status)
+
+
+class TestColumnarProcessor(unittest.TestCase):
+
+    def setUp(self):
+        self.processor = Processor()
+        self.lines = [make_status(tid, [52.2, -0.9] if tid % 2 else None)
+                      for tid in range(1, 6)]
+
+    def make_file(self, lines):
+        return StringIO(''.join(line + '\n' for line in lines))
+
+    def test_whole_file(self):
+        lines = self.lines[:2] + ['{"limit":{"track":3}}', '', 'not json'] + \
+            self.lines[2:]
+        dataframe = self.processor.make_df(self.make_file(lines), None)
+        self.assertEqual(list(dataframe.columns), COLUMNS)
+        self.assertEqual(list(dataframe["id"]), [1, 2, 3, 4, 5])
+        self.assertEqual(dataframe["id"].dtype, np.int64)
+        self.assertEqual(list(dataframe["user"][:2]), ["@user1", "@user2"])
+        self.assertAlmostEqual(dataframe["latitude"][0], 52.2, places=5)
+        self.assertAlmostEqual(dataframe["longitude"][0], -0.9, places=5)
+        self.assertTrue(np.isnan(dataframe["latitude"][1]))
+        # Stops at the end of the file, counting the bad lines once
+        self.assertEqual(self.processor.lines_read, 8)
+        self.assertEqual(self.processor.errors, 2)
+        self.assertEqual(self.processor.skipped, 1)
+
+    def test_max_rows(self):
+        dataframe = self.processor.make_df(self.make_file(self.lines), 3)
+        self.assertEqual(len(dataframe), 3)
+        dataframe = self.processor.make_df(self.make_file([]))
+        self.assertEqual(len(dataframe), 0)
+        self.assertEqual(list(dataframe.columns), COLUMNS)
+
+    def test_matches_rows(self):
+        rows = pd.DataFrame(self.processor.make_result_rows(
+            self.make_file(self.lines),
+            self.processor.simple_results_iterator,
+            1000))
+        dataframe = self.processor.make_df(self.make_file(self.lines),
+                                           chunk_size=2)
+        self.assertTrue(dataframe.equals(typed_frame(
+            dict((name, rows[name].values) for name in COLUMNS))))
+
+    def test_rows_skip_notices(self):
+        lines = self.lines[:2] + ['{"limit":{"track":5}}'] + self.lines[2:]
+        rows = list(self.processor.make_result_rows(
+            self.make_file(lines), self.processor.simple_results_iterator,
+            1000, SeenIndex()))
+        self.assertEqual([row["id"] for row in rows], [1, 2, 3, 4, 5])
+
+    def test_schema(self):
+        dataframe = self.processor.make_df(self.make_file(self.lines))
+        self.assertEqual(dataframe["id"].dtype, np.int64)
+        self.assertEqual(dataframe["latitude"].dtype, np.float32)
+        self.assertEqual(dataframe["longitude"].dtype, np.float32)
+        self.assertEqual(str(dataframe["user"].dtype), "category")
+        self.assertEqual(dataframe["created_at"].dtype, "datetime64[ns]")
+        self.assertEqual(dataframe["created_at"][1],
+                         pd.Timestamp("2015-01-01 00:00:02"))
+        self.assertEqual(dataframe.groupby("user")["id"].count()["@user1"],
+                         2)
+
+    def test_coordinates(self):
+        # GeoJSON "coordinates" are [lon, lat], and preferred to "geo"
+        status = json.loads(make_status(1, [52.2, -0.9]))
+        status["coordinates"] = {"type": "Point",
+                                 "coordinates": [-1.5, 53.0]}
+        dataframe = self.processor.make_df(self.make_file(
+            [json.dumps(status), make_status(2, [52.2, -0.9])]))
+        self.assertEqual(list(dataframe["latitude"]),
+                         list(np.float32([53.0, 52.2])))
+        self.assertEqual(list(dataframe["longitude"]),
+                         list(np.float32([-1.5, -0.9])))
+
+    def test_parse_created_at(self):
+        parsed = parse_created_at([
+            "Wed Dec 31 23:59:59 +0000 2014",
+            "Sat Feb 29 12:34:56 +0000 2020",
+            "Thu Foo 01 00:00:00 +0000 2015",
+            "Thu Jan 01 00:00:00 +0100 2015",
+            "2015-01-01 00:00:00", None])
+        expected = pd.to_datetime(
+            ["2014-12-31 23:59:59", "2020-02-29 12:34:56"]).values
+        self.assertTrue((parsed[:2] == expected).all())
+        self.assertTrue(pd.isnull(parsed[2:]).all())
+
+    def test_chunks(self):
+        chunks = list(self.processor.iter_df_chunks(
+            self.make_file(self.lines), chunk_size=2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        self.assertEqual(list(chunks[2]["id"]), [5])
+
+    def test_seen_index(self):
+        seen_index = SeenIndex()
+        seen_index.add(2)
+        dataframe = self.processor.make_df(
+            self.make_file(self.lines + self.lines[:1]), None, seen_index,
+            chunk_size=2)
+        self.assertEqual(list(dataframe["id"]), [1, 3, 4, 5])
+
+
+class TestDecoder(unittest.TestCase):
+
+    def setUp(self):
+        self.decoder = Decoder(fields=ROW_FIELDS)
+        self.status = {
+            "created_at": "Thu Jan 01 00:00:01 +0000 2015",
+            "id": 5,
+            "text": "a \"quoted\" {status}",
+            "user": {"id": 7, "screen_name": "someone",
+                     "entities": {"url": {"urls": []}}},
+            "geo": {"type": "Point", "coordinates": [52.2, -0.9]},
+            "coordinates": {"type": "Point", "coordinates": [-0.9, 52.2]},
+            "retweeted_status": {"id": 4, "text": "older",
+                                 "user": {"screen_name": "other"}},
+            "entities": {"hashtags": []},
+        }
+        self.expected = {
+            "created_at": "Thu Jan 01 00:00:01 +0000 2015",
+            "id": 5,
+            "text": "a \"quoted\" {status}",
+            "user": {"screen_name": "someone"},
+            "geo": {"type": "Point", "coordinates": [52.2, -0.9]},
+            "coordinates": {"type": "Point", "coordinates": [-0.9, 52.2]},
+        }
+
+    def test_fields(self):
+        for line in [json.dumps(self.status),
+                     json.dumps(self.status, separators=(',', ':')),
+                     tag_line(json.dumps(self.status), stream_id="x")]:
+            self.assertEqual(self.decoder.decode(line), self.expected)
+        self.assertEqual(self.decoder.fallbacks, 0)
+
+    def test_key_order(self):
+        # Nested statuses before the status' own fields are skipped over
+        line = '{"retweeted_status": %s, %s' % (
+            json.dumps(self.status["retweeted_status"]),
+            json.dumps(self.status)[1:])
+        self.assertEqual(self.decoder.decode(line), self.expected)
+
+    def test_other_messages(self):
+        notice = {"limit": {"track": 5}}
+        self.assertEqual(self.decoder.decode(json.dumps(notice)), notice)
+        self.assertEqual(self.decoder.fallbacks, 1)
+        self.assertRaises(ValueError, self.decoder.decode, '{"id": 5')
+        self.assertRaises(ValueError, self.decoder.decode, 'not json')
+
+    def test_truncated(self):
+        # Damaged after the fields: as much an error as decoded in full
+        line = json.dumps(self.status, separators=(',', ':'))
+        for damaged in [line[:-1], line[:line.index('"entities"') + 5],
+                        line[:line.rindex('}}') + 1]]:
+            self.assertRaises(ValueError, self.decoder.decode, damaged)
+        lines = '%s\n%s\n' % (line, line[:-2])
+        full = Processor()
+        fields = Processor(self.decoder)
+        self.assertEqual(len(full.make_df(StringIO(lines))),
+                         len(fields.make_df(StringIO(lines))))
+        self.assertEqual((full.errors, fields.errors), (1, 1))
+
+    def test_full(self):
+        line = json.dumps(self.status)
+        self.assertEqual(Decoder().decode(line), json.loads(line))
+        self.assertEqual(Decoder("json").backend, json)
+        self.assertRaises(ImportError, Decoder, "no_such_json")
+
+    def test_make_df(self):
+        lines = ''.join(make_status(tid, [52.0, -1.0]) + '\n'
+                        for tid in range(10))
+        full = Processor().make_df(StringIO(lines))
+        fields = Processor(self.decoder).make_df(StringIO(lines))
+        self.assertTrue(full.equals(fields))
+
+
+class TestParallelProcessor(unittest.TestCase):
+
+    def setUp(self):
+        (handle, self.path) = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(handle, "w") as results_file:
+            for tid in range(1, 1001):
+                results_file.write(make_status(tid, [52.0, -1.0]
+                                               if tid % 5 else None) + '\n')
+                if tid % 97 == 0:
+                    results_file.write('{"id": %d, "truncated\n' % tid)
+                if tid % 101 == 0:
+                    results_file.write('{"limit":{"track":1}}\n\n')
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_newline_ranges(self):
+        ranges = newline_ranges(self.path, 7)
+        self.assertEqual(len(ranges), 7)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], os.path.getsize(self.path))
+        with open(self.path, "rb") as results_file:
+            data = results_file.read()
+        for ((_, end), (start, _)) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(data[start - 1], '\n')
+
+    def test_matches_serial(self):
+        serial = Processor()
+        with open(self.path, "r") as results_file:
+            expected = serial.make_df(results_file, None)
+        parallel = Processor()
+        with open(self.path, "r") as results_file:
+            dataframe = parallel.make_df(results_file, None, processes=3)
+        self.assertEqual(len(dataframe), 1000)
+        self.assertTrue(dataframe.equals(expected))
+        self.assertEqual((parallel.lines_read, parallel.errors,
+                          parallel.skipped),
+                         (serial.lines_read, serial.errors, serial.skipped))
+        self.assertEqual((serial.errors, serial.skipped), (10 + 9, 9))
+
+    def test_seen_index(self):
+        seen_index = SeenIndex()
+        seen_index.add_many(range(1, 501))
+        dataframe = Processor().make_df(self.path, None, seen_index,
+                                        processes=2)
+        self.assertEqual(list(dataframe["id"]), range(501, 1001))
@@ -0,0 +1,193 @@
+import unittest
+import logging
+import logging.config
+import json
+import threading
+import time
+import gzip
+import StringIO
+import BaseHTTPServer
+
+from analysis.datafetch.twitter_stream import StreamClient, StreamError, \
+    tag_line, get_tweet_id, status_line
+
+D_LOG = {
+    'version': 1,
+    'disable_existing_loggers': True,
+    'formatters': {
+        'standard': {
+            'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+        },
+    },
+    'handlers': {
+        'default': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        '': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+        'analysis.datafetch.twitter_stream': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+    },
+}
+
+logging.config.dictConfig(D_LOG)
+
+STATUSES = ['{"id":%d,"text":"status %d"}' % (i, i) for i in range(1, 6)]
+
+
+class FakeStreamHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    ''' Serves STATUSES as a chunked stream, interleaved with keep-alives,
+    with lines split across chunk boundaries
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def write_chunk(self, data):
+        self.wfile.write('%x\r\n%s\r\n' % (len(data), data))
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        if self.path.startswith('/hang'):
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            self.write_chunk(STATUSES[0] + '\r\n')
+            self.wfile.flush()
+            time.sleep(1)
+            return
+        if self.path.startswith('/search'):
+            body = '{"statuses":[]}'
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('X-Rate-Limit-Remaining', '179')
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.path.startswith('/denied'):
+            self.send_response(401)
+            self.send_header('Content-Length', '12')
+            self.end_headers()
+            self.wfile.write('Unauthorized')
+            return
+
+        body = '\r\n' + '\r\n'.join(STATUSES) + '\r\n'
+        compress = 'gzip' in self.headers.get('Accept-Encoding', '')
+
+        self.send_response(200)
+        self.send_header('Transfer-Encoding', 'chunked')
+        if compress:
+            self.send_header('Content-Encoding', 'gzip')
+            buf = StringIO.StringIO()
+            gz_file = gzip.GzipFile(fileobj=buf, mode='wb')
+            gz_file.write(body)
+            gz_file.close()
+            body = buf.getvalue()
+        self.end_headers()
+
+        for i in range(0, len(body), 7):
+            self.write_chunk(body[i:i + 7])
+        self.wfile.write('0\r\n\r\n')
+
+
+class TestStreamClient(unittest.TestCase):
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                FakeStreamHandler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base_url = 'http://127.0.0.1:%d' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def authorizer(self, req_type, url, req_args):
+        return 'OAuth test="%s %s %s"' % (req_type, url, req_args['track'])
+
+    def test_stream_lines(self):
+        for compressed in (False, True):
+            client = StreamClient(self.base_url + '/1.1/statuses/filter.json',
+                                  authorizer=self.authorizer,
+                                  stall_timeout=5,
+                                  compressed=compressed)
+            lines = [l for l in client.stream({'track': 'northampton'})]
+            self.assertEqual(lines, STATUSES)
+            self.assertEqual(client.lines_read, len(STATUSES))
+            self.assertEqual(client.keep_alives, 1)
+
+        (path, headers) = self.server.requests[0]
+        self.assertEqual(path, '/1.1/statuses/filter.json?track=northampton')
+        self.assertEqual(headers['authorization'],
+                         'OAuth test="GET %s/1.1/statuses/filter.json '
+                         'northampton"' % self.base_url)
+
+    def test_http_error(self):
+        client = StreamClient(self.base_url + '/denied',
+                              authorizer=self.authorizer,
+                              stall_timeout=5)
+        with self.assertRaises(StreamError) as ctx:
+            client.connect({'track': 'northampton'})
+        self.assertEqual(ctx.exception.status, 401)
+        self.assertEqual(ctx.exception.body, 'Unauthorized')
+
+    def test_fetch(self):
+        client = StreamClient(self.base_url + '/search',
+                              authorizer=self.authorizer)
+        (body, headers) = client.fetch({'track': 'northampton'})
+        self.assertEqual(body, '{"statuses":[]}')
+        self.assertEqual(headers['x-rate-limit-remaining'], '179')
+
+    def test_abort(self):
+        client = StreamClient(self.base_url + '/hang',
+                              authorizer=self.authorizer,
+                              stall_timeout=5,
+                              compressed=False)
+        lines = []
+        started = time.time()
+        for line in client.stream({'track': 'northampton'}):
+            lines.append(line)
+            threading.Timer(0.1, client.abort).start()
+        self.assertEqual(lines, STATUSES[:1])
+        self.assertTrue(time.time() - started < 1.5)
+
+
+class TestTagLine(unittest.TestCase):
+
+    def test_tag_line(self):
+        self.assertEqual(tag_line('{"id":1}', stream_id='corby'),
+                         '{"stream_id":"corby","id":1}')
+        self.assertEqual(tag_line('{}', stream_id='corby'),
+                         '{"stream_id":"corby"}')
+        self.assertEqual(tag_line('{"id":1}'), '{"id":1}')
+        self.assertEqual(tag_line('junk', stream_id='corby'), 'junk')
+
+
+class TestTweetId(unittest.TestCase):
+
+    def test_get_tweet_id(self):
+        self.assertEqual(get_tweet_id('{"created_at":"x","id":5}'), 5)
+        self.assertEqual(get_tweet_id('{"created_at": "x", "id": 5}'), 5)
+        self.assertEqual(get_tweet_id('{"limit":{"track":3}}'), None)
+
+    def test_status_line(self):
+        status = {'text': 'hi', 'id': 5, 'user': {'id': 7},
+                  'entities': {'user_mentions': [{'id': 9}]}}
+        line = status_line(status)
+        self.assertTrue(line.startswith('{"id":5,'))
+        self.assertEqual(get_tweet_id(line), 5)
+        self.assertEqual(json.loads(line), status)
+        self.assertEqual(status_line({'id': 5}), '{"id":5}')
@@ -0,0 +1,172 @@
+import unittest
+import logging
+import logging.config
+import os
+import shutil
+import tempfile
+import threading
+
+from analysis.datafetch.writequeue import QueuedWriter, SPILL, DROP, BLOCK
+
+D_LOG = {
+    'version': 1,
+    'disable_existing_loggers': True,
+    'formatters': {
+        'standard': {
+            'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+        },
+    },
+    'handlers': {
+        'default': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        '': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+        'analysis.datafetch.writequeue': {
+            'handlers': ['default'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+    },
+}
+
+logging.config.dictConfig(D_LOG)
+
+
+class SlowDisk(object):
+    ''' A write_many which holds up the writer until released, and fails
+    the next failures writes (all of them, if negative)
+    '''
+
+    def __init__(self):
+        self.lines = []
+        self.batches = []
+        self.released = threading.Event()
+        self.failures = 0
+
+    def write_many(self, batch):
+        self.released.wait()
+        if self.failures:
+            self.failures -= 1
+            raise IOError("Disk full")
+        self.batches.append(len(batch))
+        self.lines.extend(batch)
+
+
+class TestQueuedWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.disk = SlowDisk()
+        self.lines = ['{"id":%d}' % i for i in range(100)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_writer(self, policy):
+        return QueuedWriter(self.disk.write_many,
+                            maxsize=10,
+                            batch_size=8,
+                            policy=policy,
+                            spill_dir=self.tmpdir,
+                            poll_interval=0.01)
+
+    def test_batches(self):
+        self.disk.released.set()
+        with self.make_writer(BLOCK) as writer:
+            for line in self.lines:
+                writer.put(line)
+                self.assertTrue(writer.depth <= 10)
+        self.assertEqual(self.disk.lines, self.lines)
+        self.assertEqual(writer.written, 100)
+        self.assertEqual(max(self.disk.batches), 8)
+
+    def test_drop(self):
+        with self.make_writer(DROP) as writer:
+            accepted = [writer.put(line) for line in self.lines]
+            self.assertTrue(writer.depth <= 10)
+            self.disk.released.set()
+        self.assertTrue(writer.dropped >= 100 - 10 - 8)
+        self.assertEqual(accepted.count(False), writer.dropped)
+        self.assertEqual(len(self.disk.lines) + writer.dropped, 100)
+        self.assertEqual(writer.max_depth, 10)
+
+    def test_spill(self):
+        with self.make_writer(SPILL) as writer:
+            for line in self.lines[:50]:
+                writer.put(line)
+            self.assertTrue(writer.spilled > 0)
+            self.assertEqual(writer.spill_depth, writer.spilled)
+            self.disk.released.set()
+            for line in self.lines[50:]:
+                writer.put(line)
+        # Everything is written, in order, and the spill files are gone
+        self.assertEqual(self.disk.lines, self.lines)
+        self.assertEqual(writer.spill_depth, 0)
+        self.assertEqual(writer.dropped, 0)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_failed_batch(self):
+        self.disk.released.set()
+        self.disk.failures = 1
+        writer = QueuedWriter(self.disk.write_many,
+                              maxsize=10,
+                              batch_size=4,
+                              policy=DROP,
+                              spill_dir=self.tmpdir,
+                              poll_interval=0.01,
+                              low_water=5)
+        for line in self.lines[:10]:
+            writer.put(line)
+        # Keep the queue busy: it never empties before the feed does
+        feed = iter(self.lines[10:])
+        fed = threading.Event()
+
+        def busy_write_many(batch):
+            for line in feed:
+                writer.put(line)
+                break
+            else:
+                fed.set()
+            self.disk.write_many(batch)
+
+        writer.write_many = busy_write_many
+        writer.start()
+        self.assertTrue(fed.wait(5))
+        writer.close()
+        # The failed batch is spilled, and retried under load
+        self.assertEqual(writer.write_errors, 1)
+        self.assertEqual(sorted(self.disk.lines), sorted(self.lines))
+        self.assertTrue(self.disk.lines.index(self.lines[0]) <
+                        self.disk.lines.index(self.lines[-1]))
+        self.assertEqual(writer.spill_depth, 0)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_leftover_spill(self):
+        # Unable to write when closed: the lines are left spilled
+        self.disk.released.set()
+        self.disk.failures = -1
+        with self.make_writer(SPILL) as writer:
+            for line in self.lines[:5]:
+                writer.put(line)
+        self.assertEqual(writer.written, 0)
+        self.assertEqual(len(os.listdir(self.tmpdir)), 1)
+
+        # and the next writer picks them up, before its own
+        self.disk.failures = 0
+        with self.make_writer(SPILL) as writer:
+            for line in self.lines[5:]:
+                writer.put(line)
+        self.assertEqual(self.disk.lines, self.lines)
+        self.assertEqual(writer.spill_depth, 0)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_bad_policy(self):
+        self.assertRaises(ValueError, QueuedWriter, self.disk.write_many,
+                          policy='ignore')
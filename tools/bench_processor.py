@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+''' Benchmark the Processor: rows/sec building the results DataFrame,
+for the dict-per-row path, and make_df with each installed JSON backend,
+decoding whole statuses or only the row fields, and reading through
+the memory mapped LineReader.
+
+    python tools/bench_processor.py [--results-file FILE] [--rows N]
+
+Without a results file, N synthetic statuses (in the streaming API's key
+order) are written to a temporary file.
+'''
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import pandas as pd
+
+from analysis.twitter_processor import Processor, Decoder, ROW_FIELDS, \
+    JSON_BACKENDS
+from analysis.line_reader import LineReader
+
+
+def make_status(tid):
+    ''' Make a status shaped like the stream's, with entities and (for
+    every fourth status) a retweeted status
+    '''
+    user = {
+        "id": 1000 + tid % 500, "id_str": str(1000 + tid % 500),
+        "name": "User %d" % (tid % 500),
+        "screen_name": "user%d" % (tid % 500),
+        "location": "Northampton, UK", "url": None,
+        "description": "Tweeting about Northamptonshire " * 3,
+        "protected": False, "verified": False,
+        "followers_count": 120, "friends_count": 300, "listed_count": 2,
+        "favourites_count": 50, "statuses_count": 4000,
+        "created_at": "Mon Mar 02 10:00:00 +0000 2009", "utc_offset": 0,
+        "time_zone": "London", "geo_enabled": True, "lang": "en",
+        "profile_background_color": "C0DEED",
+        "profile_image_url": "http://pbs.twimg.com/profile_images/1/a.jpg",
+        "default_profile": True,
+    }
+    entities = {
+        "hashtags": [{"text": "northampton", "indices": [10, 22]}],
+        "trends": [], "urls": [], "symbols": [],
+        "user_mentions": [{"screen_name": "nccnews", "name": "NCC",
+                           "id": 42, "id_str": "42", "indices": [0, 8]}],
+    }
+    status = [
+        ("created_at", "Thu Jan 01 00:00:00 +0000 2015"),
+        ("id", 550000000000000000 + tid),
+        ("id_str", str(550000000000000000 + tid)),
+        ("text", "@nccnews #northampton status number %d" % tid),
+        ("source", "<a href=\"http://twitter.com\">Twitter Web Client</a>"),
+        ("truncated", False),
+        ("in_reply_to_status_id", None),
+        ("in_reply_to_user_id", None),
+        ("in_reply_to_screen_name", None),
+        ("user", user),
+        ("geo", {"type": "Point", "coordinates": [52.24, -0.9]}
+         if tid % 3 == 0 else None),
+        ("coordinates", None),
+        ("place", {"id": "abc", "full_name": "Northampton, England",
+                   "bounding_box": {"type": "Polygon",
+                                    "coordinates": [[[-0.98, 52.19],
+                                                     [-0.78, 52.19],
+                                                     [-0.78, 52.29],
+                                                     [-0.98, 52.29]]]}}),
+        ("contributors", None),
+    ]
+    if tid % 4 == 0:
+        status.append(("retweeted_status", dict(status)))
+    status.extend([
+        ("retweet_count", 0), ("favorite_count", 0),
+        ("entities", entities), ("favorited", False), ("retweeted", False),
+        ("filter_level", "low"), ("lang", "en"),
+        ("timestamp_ms", "1420070400000"),
+    ])
+    return '{' + ','.join(json.dumps(key) + ':' + json.dumps(value)
+                          for (key, value) in status) + '}'
+
+
+def time_run(name, build, results_filename):
+    with open(results_filename, "r") as results_file:
+        start = time.time()
+        rows = len(build(results_file))
+        elapsed = time.time() - start
+    print("%-32s %8d rows %8.2fs %10.0f rows/sec" %
+          (name, rows, elapsed, rows / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Processor.')
+    parser.add_argument('--results-file', metavar='FILE', type=str,
+                        default=None, help='Results file to read')
+    parser.add_argument('--rows', metavar='N', type=int, default=100000,
+                        help='Number of statuses to read (or generate)')
+    args = parser.parse_args()
+
+    results_filename = args.results_file
+    if results_filename is None:
+        (handle, results_filename) = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(handle, "w") as results_file:
+            for tid in range(args.rows):
+                results_file.write(make_status(tid) + '\n')
+
+    try:
+        processor = Processor(Decoder("json"))
+        time_run("dict per row (json)",
+                 lambda fp: pd.DataFrame(processor.make_result_rows(
+                     fp, processor.simple_results_iterator, args.rows)),
+                 results_filename)
+        for backend in JSON_BACKENDS:
+            try:
+                decoders = [("full", Decoder(backend)),
+                            ("fields", Decoder(backend, ROW_FIELDS))]
+            except ImportError:
+                continue
+            for (mode, decoder) in decoders:
+                processor = Processor(decoder)
+                time_run("make_df (%s, %s)" % (backend, mode),
+                         lambda fp: processor.make_df(fp, args.rows),
+                         results_filename)
+        # Through the memory mapped reader (building its line index first)
+        with LineReader(results_filename, save_index=False) as reader:
+            processor = Processor(Decoder(fields=ROW_FIELDS))
+            time_run("make_df (LineReader, fields)",
+                     lambda fp: processor.make_df(reader, args.rows),
+                     results_filename)
+    finally:
+        if args.results_file is None:
+            os.remove(results_filename)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,21 @@
 import argparse
 import sys
 import os
+import signal
+import threading
 import analysis.datafetch.twitter_fetch as tw
+from analysis.datafetch.twitter_stream import tag_line
+from analysis.datafetch.segments import SegmentWriter
+from analysis.datafetch.supervisor import StreamSupervisor, PidFile
+from analysis.datafetch.backfill import SearchBackfill, Checkpoints
+from analysis.datafetch.scheduler import tile_geocodes, RateLimiter, \
+    TileScheduler
+from analysis.dedup import SeenIndex, Deduplicator
+from analysis.geofence import Geofence
+from analysis.trends import TrendDetector, TrendsReporter
+from analysis.datafetch.writequeue import QueuedWriter, POLICIES, SPILL
+from analysis.datafetch.metrics import Metrics, IngestMetrics, \
+    StatsReporter, MetricsServer, COUNTER
 import logging
 import logging.config
 import json
@@ -12,6 +26,8 @@ import settings
 
 LOG = logging.getLogger(__name__)
 
+DEFAULT_PIDFILE = 'twitterd.pid'
+
 
 class Twitterd(object):
     ''' Twitter Daemon Class
@@ -19,6 +35,7 @@ class Twitterd(object):
 
     CMDS = ['stream_filter', 'search']
     NORTHANTS_BOX = '-1.386293,51.985165,-0.282167,52.650010'
+    NORTHANTS_GEOCODE = '52.240477,-0.902656,50km'
 
     def __init__(self, args):
         self.init_args()
@@ -27,6 +44,17 @@ class Twitterd(object):
         self.settings = self.read_settings(self.args.settings[0])
         self.init_logging(settings.LOGGING)
         self.fetcher = tw.create_datafetcher(self.settings["twitter"])
+        self.supervisors = []
+        self.seen_index = None
+        self.deduplicator = None
+        self.geofence = None
+        self.out_of_area = 0
+        self.trends = None
+        self.clients = []
+        self.write_queues = []
+        self.metrics = Metrics()
+        self.ingest_metrics = IngestMetrics(self.metrics)
+        self.register_metrics()
 
         self.cmd_map = {
             self.CMDS[0]: tw.DataFetcher.Cmd.stream_filter,
@@ -53,7 +81,8 @@ class Twitterd(object):
                             type=int, nargs='?',
                             required=False,
                             help='Number of Seconds to run ' +
-                            'before termination')
+                            'before termination (with --native, ' +
+                            'before reconnecting)')
 
         parser.add_argument('--cmd',
                             metavar='CMD',
@@ -70,6 +99,152 @@ class Twitterd(object):
                             required=True,
                             help='Command Name')
 
+        parser.add_argument('--native',
+                            action='store_true',
+                            default=False,
+                            help='Stream in-process over a persistent ' +
+                            'connection instead of running cURL')
+
+        parser.add_argument('--segment-size',
+                            metavar='MB',
+                            type=int,
+                            default=256,
+                            help='Roll native output segments after ' +
+                            'this many (uncompressed) megabytes')
+
+        parser.add_argument('--segment-time',
+                            metavar='SECONDS',
+                            type=int,
+                            default=3600,
+                            help='Roll native output segments after ' +
+                            'this many seconds (a Follower of the ' +
+                            'manifest only sees a segment once rolled)')
+
+        parser.add_argument('--stall-timeout',
+                            metavar='SECONDS',
+                            type=int,
+                            default=90,
+                            help='Reconnect when nothing, not even a ' +
+                            'keep-alive, arrives for this many seconds')
+
+        parser.add_argument('--checkpoints',
+                            metavar='CHECKPOINTSFILE',
+                            type=str,
+                            default=None,
+                            help='Search backfill checkpoints ' +
+                            '(default: OUTDIR/search_checkpoints.json)')
+
+        parser.add_argument('--max-pages',
+                            metavar='PAGES',
+                            type=int,
+                            default=None,
+                            help='Most result pages to fetch per search ' +
+                            'query, in one run')
+
+        parser.add_argument('--tile-radius',
+                            metavar='KM',
+                            type=float,
+                            default=None,
+                            help='Search the county box as overlapping ' +
+                            'geocode tiles of this radius, instead of ' +
+                            'the configured searches')
+
+        parser.add_argument('--max-requests',
+                            metavar='REQUESTS',
+                            type=int,
+                            default=180,
+                            help='Number of tile searches to make, in one ' +
+                            'run (default: one rate limit window)')
+
+        parser.add_argument('--dedup-index',
+                            metavar='INDEXFILE',
+                            type=str,
+                            default=None,
+                            help='Persistent index of seen tweet ids; ' +
+                            'tweets already in it are not written again')
+
+        parser.add_argument('--geofence',
+                            metavar='SHAPEFILE',
+                            type=str,
+                            default=None,
+                            help='Boundary shapefile (in lon/lat) to ' +
+                            'check geotagged tweets against')
+
+        parser.add_argument('--geofence-name',
+                            metavar='NAME',
+                            type=str,
+                            default='Northamptonshire',
+                            help='Name of the boundary shape to use')
+
+        parser.add_argument('--geofence-field',
+                            metavar='FIELD',
+                            type=str,
+                            default='CTYUA12NM',
+                            help='Shapefile field holding the name')
+
+        parser.add_argument('--geofence-mode',
+                            choices=['drop', 'flag'],
+                            default='drop',
+                            help='Drop tweets geotagged outside the ' +
+                            'boundary, or flag each geotagged tweet ' +
+                            'with a "geofence" of "in" or "out"')
+
+        parser.add_argument('--queue-size',
+                            metavar='LINES',
+                            type=int,
+                            default=10000,
+                            help='Most lines to hold between the stream ' +
+                            'readers and the disk writer')
+
+        parser.add_argument('--queue-policy',
+                            choices=POLICIES,
+                            default=SPILL,
+                            help='When the queue is full: spill lines to ' +
+                            'a local temp file, drop them, or block ' +
+                            'the readers')
+
+        parser.add_argument('--spill-dir',
+                            metavar='DIR',
+                            type=str,
+                            default=None,
+                            help='Directory for spill files (default: ' +
+                            'the system temp directory). Spill files ' +
+                            'left in it are written at startup')
+
+        parser.add_argument('--batch-size',
+                            metavar='LINES',
+                            type=int,
+                            default=500,
+                            help='Most lines to write to disk at once')
+
+        parser.add_argument('--metrics-port',
+                            metavar='PORT',
+                            type=int,
+                            default=None,
+                            help='Serve live metrics on this local port')
+
+        parser.add_argument('--stats-file',
+                            metavar='STATSFILE',
+                            type=str,
+                            default=None,
+                            help='Append a snapshot of the metrics ' +
+                            'to this file every --stats-interval')
+
+        parser.add_argument('--stats-interval',
+                            metavar='SECONDS',
+                            type=int,
+                            default=60,
+                            help='Seconds over which to report rates')
+
+        parser.add_argument('--trends-file',
+                            metavar='TRENDSFILE',
+                            type=str,
+                            default=None,
+                            help='Append the trending hashtags and words ' +
+                            'to this file every --stats-interval')
+
+        add_pidfile_arg(parser)
+
         self.parser = parser
 
     def get_args(self, args):
@@ -82,12 +257,93 @@ class Twitterd(object):
         """
         # pdb.set_trace()
         LOG.info("starting up...")
+        pidfile = PidFile(self.args.pidfile)
+        pidfile.acquire()
+        signal.signal(signal.SIGTERM, self.handle_signal)
         try:
             self.download_data()
         except:
             LOG.exception("Unable to exec command")
+        finally:
+            pidfile.release()
         return
 
+    def handle_signal(self, signum, frame):
+        """ Stop cleanly on SIGTERM, closing the current segment
+        """
+        LOG.info("Received signal %d", signum)
+        if self.supervisors:
+            for supervisor in self.supervisors:
+                supervisor.stop()
+        else:
+            raise SystemExit(1)
+
+    def register_metrics(self):
+        """ Register the counts kept by the daemon and its streams as
+        metrics
+        """
+        def total(attr, objs):
+            return lambda: sum(getattr(obj, attr) for obj in objs())
+
+        supervisors = lambda: self.supervisors
+        clients = lambda: self.clients
+        queues = lambda: self.write_queues
+        for (name, func, help_text) in [
+                ('connections_total', total('connections', supervisors),
+                 'Stream connections made'),
+                ('reconnects_total', total('reconnects', supervisors),
+                 'Stream reconnections'),
+                ('stalls_total', total('stalls', supervisors),
+                 'Stream stalls'),
+                ('stream_errors_total', total('errors', supervisors),
+                 'Stream connection errors'),
+                ('network_bytes_total', total('bytes_read', clients),
+                 'Bytes read from the network'),
+                ('keep_alives_total', total('keep_alives', clients),
+                 'Keep-alive newlines read'),
+                ('duplicates_total',
+                 lambda: self.deduplicator.duplicates
+                 if self.deduplicator is not None else 0,
+                 'Statuses skipped as already seen'),
+                ('out_of_area_total', lambda: self.out_of_area,
+                 'Statuses geotagged outside the geofence'),
+                ('queue_dropped_total', total('dropped', queues),
+                 'Lines dropped as the write queue was full'),
+                ('queue_spilled_total', total('spilled', queues),
+                 'Lines spilled as the write queue was full'),
+                ('write_errors_total', total('write_errors', queues),
+                 'Failed batch writes (spilled to be retried)')]:
+            self.metrics.register(name, func, COUNTER, help_text)
+        for (name, func, help_text) in [
+                ('queue_depth', total('depth', queues),
+                 'Lines waiting in the write queue'),
+                ('queue_max_depth', total('max_depth', queues),
+                 'Most lines ever waiting in the write queue'),
+                ('queue_spill_depth', total('spill_depth', queues),
+                 'Lines waiting in spill files')]:
+            self.metrics.register(name, func, help_text=help_text)
+        self.metrics.counter('written_total', 'Lines written to disk')
+
+    def start_metrics(self):
+        """ Start serving and/or reporting the metrics, as configured.
+        Returns the started objects, to stop when done
+        """
+        started = []
+        if self.args.metrics_port is not None:
+            started.append(MetricsServer(self.metrics,
+                                         self.args.metrics_port))
+        if self.args.stats_file is not None or started:
+            started.append(StatsReporter(self.metrics,
+                                         self.args.stats_file,
+                                         self.args.stats_interval))
+        if self.trends is not None:
+            started.append(TrendsReporter(self.trends,
+                                          self.args.trends_file,
+                                          self.args.stats_interval))
+        for reporter in started:
+            reporter.start()
+        return started
+
     def download_data(self):
         """ Run a twitter command and concatenate results to file
         """
@@ -107,11 +363,39 @@ class Twitterd(object):
         kwargs["track"] = None
         kwargs["include_entities"] = 1
 
-        out_file = open(output_filename, "w")
+        command = self.cmd_map[self.args.cmd[0]]
 
-        err_file = open(errors_filename, "w")
+        if self.args.native:
+            if self.args.dedup_index is not None:
+                self.seen_index = SeenIndex(self.args.dedup_index)
+                self.deduplicator = Deduplicator(self.seen_index)
+            if self.args.geofence is not None:
+                self.geofence = Geofence.from_shapefile(
+                    self.args.geofence,
+                    self.args.geofence_name,
+                    self.args.geofence_field)
+            if self.args.trends_file is not None:
+                self.trends = TrendDetector()
+            reporters = self.start_metrics()
+            try:
+                if command == tw.DataFetcher.Cmd.search:
+                    self.backfill_search()
+                else:
+                    self.stream_segments(command, max_time)
+            finally:
+                for reporter in reporters:
+                    reporter.stop()
+                if self.seen_index is not None:
+                    self.seen_index.save()
+                    LOG.info("duplicates=%d", self.deduplicator.duplicates)
+                if self.geofence is not None:
+                    LOG.info("out_of_area=%d", self.out_of_area)
+            return
 
-        command = self.cmd_map[self.args.cmd[0]]
+        # Append, so that a restart does not truncate earlier data
+        out_file = open(output_filename, "a")
+
+        err_file = open(errors_filename, "a")
 
         try:
             status = self.fetcher.download_data(out_file,
@@ -124,6 +408,243 @@ class Twitterd(object):
             out_file.close()
             err_file.close()
 
+    def make_write(self, write):
+        """ Wrap write (of a status line) with the ingest metrics and
+        filters: the geofence, then de-duplication. The trend detector
+        sees the lines which pass them. Each line is parsed once, by the
+        ingest metrics, and the filters are given the decoded message
+        along with it
+        """
+        write = self.make_counted_write('written_total', write)
+        if self.trends is not None:
+            write = self.make_trends_write(write)
+        if self.seen_index is not None:
+            write = self.make_dedup_write(write)
+        if self.geofence is not None:
+            write = self.make_geofence_write(write)
+
+        def observed_write(line):
+            return write(line, self.ingest_metrics.observe(line))
+
+        return observed_write
+
+    def make_counted_write(self, name, write):
+        """ Wrap write to count the lines written in a metric (all but
+        those write refuses, by returning False)
+        """
+        def counted_write(line, message):
+            accepted = write(line)
+            if accepted is not False:
+                self.metrics.inc(name)
+            return accepted
+
+        return counted_write
+
+    def make_trends_write(self, write):
+        """ Wrap write to count the terms of statuses in the trend detector
+        """
+        def trends_write(line, message):
+            self.trends.add_status(message)
+            return write(line, message)
+
+        return trends_write
+
+    def make_dedup_write(self, write):
+        """ Wrap write to skip statuses already in the seen index. A
+        status is only recorded as seen once write accepts its line, so
+        one dropped by a full write queue (--queue-policy drop) can still
+        be had from a later search or backfill
+        """
+        def dedup_write(line, message):
+            downstream = lambda line: write(line, message)
+            if not isinstance(message, dict):
+                # Not parsed: fall back to reading the id from the line
+                return self.deduplicator.write_new(line, downstream)
+            tweet_id = message.get("id")
+            if tweet_id is None:
+                return downstream(line)
+            return self.deduplicator.write_new(line, downstream, tweet_id)
+
+        return dedup_write
+
+    def make_geofence_write(self, write):
+        """ Wrap write with the geofence: statuses geotagged outside the
+        boundary are dropped, refused as write would (or flagged); the rest
+        pass through as is
+        """
+        flag = self.args.geofence_mode == 'flag'
+
+        def geofence_write(line, message):
+            try:
+                inside = self.geofence.check(message)
+            except (ValueError, TypeError, AttributeError):
+                # Not a status (e.g. a limit notice)
+                inside = None
+            if inside is False:
+                self.out_of_area += 1
+                if not flag:
+                    return False
+            if flag and inside is not None:
+                line = tag_line(line, geofence="in" if inside else "out")
+            return write(line, message)
+
+        return geofence_write
+
+    def get_searches(self):
+        """ Get the configured search queries: a list of dicts, each with
+        an "id" and the search args (q, geocode...) of that query.
+        Defaults to a single search around Northampton.
+        """
+        return self.settings.get("searches",
+                                 [{"id": "northants",
+                                   "q": "",
+                                   "geocode": self.NORTHANTS_GEOCODE}])
+
+    def backfill_search(self):
+        """ Fetch the search results that are newer than each query's
+        checkpoint into segment files
+        """
+        checkpoints_filename = self.args.checkpoints
+        if checkpoints_filename is None:
+            checkpoints_filename = os.path.join(self.args.outdir[0],
+                                                "search_checkpoints.json")
+        writer = SegmentWriter(self.args.outdir[0],
+                               prefix='twitter_search',
+                               max_bytes=self.args.segment_size * 1024 * 1024,
+                               max_seconds=self.args.segment_time)
+        backfill = SearchBackfill(
+            lambda **kwargs: self.fetcher.get_json(tw.DataFetcher.Cmd.search,
+                                                   **kwargs),
+            Checkpoints(checkpoints_filename),
+            self.make_write(writer.write),
+            max_pages=self.args.max_pages)
+        with writer:
+            if self.args.tile_radius is not None:
+                scheduler = TileScheduler(
+                    tile_geocodes(tw.DataFetcher.Locations.NORTHAMPTONSHIRE,
+                                  self.args.tile_radius),
+                    backfill,
+                    RateLimiter(),
+                    scores_path=os.path.join(self.args.outdir[0],
+                                             "tile_scores.json"))
+                statuses = scheduler.run(self.args.max_requests)
+            else:
+                statuses = backfill.run(self.get_searches())
+        LOG.info("statuses=%d, requests=%d", statuses, backfill.requests)
+
+    def get_streams(self):
+        """ Get the configured streams: a list of dicts, each with an "id"
+        and the request args (locations, track, follow...) of that stream.
+        Defaults to a single stream over the Northamptonshire box.
+        """
+        return self.settings.get("streams",
+                                 [{"id": "northants",
+                                   "locations": self.NORTHANTS_BOX}])
+
+    def make_supervisor(self, command, stream, write, max_time):
+        """ Make the supervisor for one configured stream, tagging each of
+        its records with the stream id
+        """
+        stream_args = dict(stream)
+        stream_id = stream_args.pop("id")
+        stream_args.setdefault("include_entities", 1)
+        req_args = self.fetcher.encode_request_args(**stream_args)
+        client = self.fetcher.create_stream_client(command,
+                                                   self.args.stall_timeout)
+        self.clients.append(client)
+
+        def handle_line(line):
+            write(tag_line(line, stream_id=stream_id))
+
+        return StreamSupervisor(lambda: client.stream(req_args, max_time),
+                                handle_line,
+                                abort=client.abort,
+                                name=stream_id)
+
+    def stream_segments(self, command, max_time):
+        """ Stream statuses in-process into rolling segment files, running
+        every configured stream in its own thread, into one shared writer.
+        The streams hand their lines to the writer through a bounded
+        queue, so that a slow disk does not hold up reading
+        """
+        writer = SegmentWriter(self.args.outdir[0],
+                               max_bytes=self.args.segment_size * 1024 * 1024,
+                               max_seconds=self.args.segment_time)
+        write_queue = QueuedWriter(writer.write_many,
+                                   maxsize=self.args.queue_size,
+                                   batch_size=self.args.batch_size,
+                                   policy=self.args.queue_policy,
+                                   spill_dir=self.args.spill_dir)
+        self.write_queues.append(write_queue)
+        write = self.make_write(write_queue.put)
+        self.supervisors = [self.make_supervisor(command,
+                                                 stream,
+                                                 write,
+                                                 max_time)
+                            for stream in self.get_streams()]
+        threads = [threading.Thread(target=supervisor.run,
+                                    name=supervisor.name)
+                   for supervisor in self.supervisors]
+        with writer, write_queue:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                # Join with a timeout, so that signals are still handled
+                while thread.is_alive():
+                    thread.join(1.0)
+        for supervisor in self.supervisors:
+            LOG.info("%s: connections=%d, stalls=%d, errors=%d",
+                     supervisor.name,
+                     supervisor.connections,
+                     supervisor.stalls,
+                     supervisor.errors)
+
+
+def add_pidfile_arg(parser):
+    """ Add the pid file argument, shared by all daemon commands
+    """
+    parser.add_argument('--pidfile',
+                        metavar='PIDFILE',
+                        type=str,
+                        default=DEFAULT_PIDFILE,
+                        help='Pid file of the running daemon')
+
+
+def stop(args):
+    """ Stop the daemon whose pid is in the pid file
+    """
+    parser = argparse.ArgumentParser(description='Stop the daemon.')
+    add_pidfile_arg(parser)
+    (known_args, _) = parser.parse_known_args(args)
+    return PidFile(known_args.pidfile).stop()
+
+
+def start(args):
+    """ Start the daemon
+    """
+    twitterd = Twitterd(args)
+
+    def entry():
+        twitterd.main()
+
+    LOG.info("Daemonizing")
+    """
+    daemon = Daemonize(app=program_name,
+                       pid="twitter_daemon.pid",
+                       action=entry,
+                       keep_fds=keep_fds)
+    LOG.info("Daemonized")
+    import pdb
+    pdb.set_trace()
+    daemon.start()
+    LOG.error("Exiting")
+    """
+    try:
+        entry()
+    except:
+        LOG.exception("Fatal Exception")
+        raise
+
 
 def main():
     """ Read the command line args and start off the daemon
@@ -135,32 +656,14 @@ def main():
     # keep_fds = [handler.stream.fileno() for handler in handlers]
 
     if daemon_cmd == "start":
-        twitterd = Twitterd(sys.argv[2:])
-
-        def entry():
-            twitterd.main()
-
-        LOG.info("Daemonizing")
-        """
-        daemon = Daemonize(app=program_name,
-                           pid="twitter_daemon.pid",
-                           action=entry,
-                           keep_fds=keep_fds)
-        LOG.info("Daemonized")
-        import pdb
-        pdb.set_trace()
-        daemon.start()
-        LOG.error("Exiting")
-        """
-        try:
-            entry()
-        except:
-            LOG.exception("Fatal Exception")
-            raise
+        start(sys.argv[2:])
     elif daemon_cmd == "stop":
-        pass
+        if not stop(sys.argv[2:]):
+            sys.exit(1)
     elif daemon_cmd == "restart":
-        pass
+        if not stop(sys.argv[2:]):
+            sys.exit(1)
+        start(sys.argv[2:])
 
 if __name__ == '__main__':
     main()